@@ -0,0 +1,26 @@
+# _bench_util.py
+# ベンチマーク共通処理: lambda_function の読み込みと計測ヘルパー
+
+import os, sys, time
+from typing import Any, Callable, Tuple
+
+HANDLER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sap-claude-handler")
+if HANDLER_DIR not in sys.path:
+    sys.path.insert(0, HANDLER_DIR)
+
+import lambda_function as lf  # noqa: E402
+
+
+def best_of(fn: Callable[[], Any], repeat: int = 5) -> Tuple[float, Any]:
+    """repeat回実行して最短時間（秒）と最後の戻り値を返す"""
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def report(label: str, seconds: float, units: int, unit_name: str) -> None:
+    rate = units / seconds if seconds > 0 else float("inf")
+    print(f"{label:<40} {seconds * 1000:10.2f} ms  {rate:14,.0f} {unit_name}/s")
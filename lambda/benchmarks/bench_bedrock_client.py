@@ -0,0 +1,77 @@
+# bench_bedrock_client.py
+# Bedrock 呼び出し1回あたりのクライアント側オーバーヘッド（呼び出し/秒）:
+# 毎回 boto3.client を生成する旧実装 vs モジュール単位で再利用するクライアント
+# ローカルのスタブエンドポイント（HTTP、keep-alive）に向けるため、AWS認証情報やネットワークは不要。
+# 注: スタブは平文HTTPのため、本番で毎回発生していたTLSハンドシェイク分は含まれない（実際の差はより大きい）
+#   python lambda/benchmarks/bench_bedrock_client.py [calls]
+
+import json, os, sys, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONVERSE_RESPONSE = json.dumps({
+    "output": {"message": {"role": "assistant", "content": [{"text": "OK"}]}},
+    "stopReason": "end_turn",
+    "usage": {"inputTokens": 10, "outputTokens": 1, "totalTokens": 11},
+    "metrics": {"latencyMs": 1},
+}).encode()
+
+
+class StubBedrockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive（接続の再利用を観測できるように）
+    wbufsize = -1                   # ヘッダーと本文を1回で送る（遅延ACKによる40ms待ちを避ける）
+    disable_nagle_algorithm = True
+    connections = 0
+
+    def setup(self) -> None:
+        super().setup()
+        StubBedrockHandler.connections += 1
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(CONVERSE_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(CONVERSE_RESPONSE)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def start_stub() -> str:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubBedrockHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main() -> None:
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    # boto3 の標準的なエンドポイント上書きとダミー認証情報（lambda_function の読み込み前に設定）
+    os.environ["AWS_ENDPOINT_URL_BEDROCK_RUNTIME"] = start_stub()
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+
+    from _bench_util import best_of, lf, report  # noqa: E402
+
+    def legacy_converse(prompt: str) -> str:
+        """変更前の実装（比較用）: 呼び出しごとにクライアントを生成"""
+        client = lf.boto3.client("bedrock-runtime", region_name=lf.REGION)
+        resp = client.converse(modelId=lf.MODEL_ID, messages=[{"role": "user", "content": [{"text": prompt}]}],
+                               inferenceConfig={"maxTokens": lf.MAX_TOKENS, "temperature": lf.TEMPERATURE})
+        return resp["output"]["message"]["content"][0]["text"]
+
+    print(f"--- {calls:,} converse calls against local stub ---")
+    StubBedrockHandler.connections = 0
+    t, _ = best_of(lambda: [legacy_converse("ping") for _ in range(calls)], repeat=3)
+    report("before: boto3.client per call", t, calls, "calls")
+    print(f"{'':<40} {StubBedrockHandler.connections:,} TCP connections opened")
+
+    lf._CLIENTS.clear()
+    StubBedrockHandler.connections = 0
+    t, _ = best_of(lambda: [lf._bedrock_converse(lf.MODEL_ID, lf.REGION, "ping") for _ in range(calls)], repeat=3)
+    report("after:  reused _aws_client", t, calls, "calls")
+    print(f"{'':<40} {StubBedrockHandler.connections:,} TCP connections opened")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+# bench_dates.py
+# 日付バケット化のベンチマーク（行/秒）: 旧実装（"/"→"-" と先頭10文字）vs メモ化した正規化
+#   python lambda/benchmarks/bench_dates.py [rows]
+
+import random, sys
+from datetime import date, timedelta
+from typing import Any
+
+from _bench_util import best_of, lf, report
+
+
+def legacy_day_key(raw: Any) -> str:
+    """変更前の実装（比較用）"""
+    dt = str(raw).strip().replace("/", "-")
+    return dt[:10] if len(dt) >= 10 else dt
+
+
+def make_dates(n: int, style: str, days: int = 365) -> list:
+    """1年分の日付を n 行に繰り返し出現させる（SAPの明細は同じ日付が大量に並ぶ）"""
+    rnd = random.Random(7)
+    base = date(2025, 1, 1)
+    out = []
+    for _ in range(n):
+        d = base + timedelta(days=rnd.randrange(days))
+        if style == "iso":
+            out.append(d.isoformat())
+        elif style == "sap":  # 0埋めなし・スラッシュ区切り
+            out.append(f"{d.year}/{d.month}/{d.day}")
+        elif style == "compact":
+            out.append(d.strftime("%Y%m%d"))
+        elif style == "wareki":
+            out.append(f"令和{d.year - 2018}年{d.month}月{d.day}日")
+        else:  # タイムスタンプ（時刻付きで値の種類が多い）
+            out.append(f"{d.isoformat()} {rnd.randrange(24):02d}:{rnd.randrange(60):02d}:00")
+    return out
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    # 注: 旧実装は 2025/1/1・20250101・和暦を正しくバケット化できないため、結果自体が異なる
+    for style in ("iso", "sap", "compact", "wareki", "timestamp"):
+        cells = make_dates(n, style)
+        print(f"--- {style} ({n:,} rows, {len(set(cells)):,} distinct) ---")
+        t, _ = best_of(lambda: [legacy_day_key(c) for c in cells], repeat=3)
+        report("before: legacy day key per row", t, n, "rows")
+        for bucket in ("day", "month"):
+            lf._date_bucket.cache_clear()
+            t, _ = best_of(lambda: [lf._day_key(c, bucket) for c in cells], repeat=3)
+            report(f"after:  _day_key per row ({bucket})", t, n, "rows")
+        table = lf._ColumnarTable.from_rows({"日付": c, "売上": "1"} for c in cells)
+        lf._date_bucket.cache_clear()
+        t, _ = best_of(lambda: lf._compute_stats(table, bucket="day"), repeat=3)
+        report("after:  _compute_stats(table) total", t, n, "rows")
+
+
+if __name__ == "__main__":
+    main()
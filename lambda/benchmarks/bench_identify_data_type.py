@@ -0,0 +1,75 @@
+# bench_identify_data_type.py
+# _identify_data_type のベンチマーク（呼び出し/秒）: 旧実装（キーワードごとの in ループ）vs コンパイル済みマッチャ
+#   python lambda/benchmarks/bench_identify_data_type.py [calls]
+
+import random, sys
+from typing import Any, Dict, List
+
+from _bench_util import best_of, lf, report
+
+# SAP抽出でよく見る列名（英字フィールド名と日本語ラベルの混在）
+SAP_FIELDS = ["MANDT", "BUKRS", "GJAHR", "BELNR", "BUZEI", "KUNNR", "MATNR", "WERKS", "LGORT", "CHARG",
+              "VKORG", "VTWEG", "SPART", "NETWR", "WAERK", "MENGE", "MEINS", "KOSTL", "PRCTR", "AUFNR"]
+JA_LABELS = ["会社コード", "会計年度", "伝票番号", "得意先", "品目", "プラント", "保管場所", "販売組織",
+             "正味額", "通貨", "数量", "単位", "原価センタ", "利益センタ", "受注番号", "転記日付", "顧客名", "地域"]
+
+
+def legacy_identify_data_type(columns: List[str], sample_data: List[Dict[str, Any]]) -> str:
+    """変更前の実装（比較用、キーワード表は同一）"""
+    if not columns:
+        return "financial_data"
+    col_lower = [col.lower() for col in columns]
+    col_str = " ".join(col_lower) + " " + " ".join(columns)
+    scores = {t: 0 for t in ("hr_data", "marketing_data", "sales_data", "financial_data", "inventory_data", "customer_data")}
+    for data_type, weight, keywords in lf._HEADER_KEYWORD_RULES:
+        for keyword in keywords:
+            if keyword in col_str:
+                scores[data_type] += weight
+    if sample_data:
+        for key, value in sample_data[0].items():
+            str_value = str(value).lower()
+            for group, data_type, weight, keywords in lf._VALUE_KEYWORD_RULES:
+                if group == "risk" and not ("リスク" in key or "risk" in key.lower()):
+                    continue
+                if any(k in str_value for k in keywords) or group == "age" and str_value.isdigit() and 18 <= int(str_value) <= 80:
+                    scores[data_type] += weight
+            if "%" in str_value and any(metric in key.lower() for metric in ["roi", "達成率", "満足度"]):
+                scores["marketing_data"] += 2
+            if "商品" in key or "product" in key.lower():
+                scores["sales_data"] += 3
+            if key.lower() in ["店舗", "store"] and str_value:
+                scores["sales_data"] += 4
+            if "warehouse" in key.lower() or "倉庫" in key:
+                scores["inventory_data"] += 3
+            if "@" in str_value:
+                scores["customer_data"] += 4
+    if max(scores.values()) > 0:
+        return max(scores, key=scores.get)
+    return "financial_data"
+
+
+def make_extract(width: int, seed: int = 3) -> tuple:
+    rnd = random.Random(seed)
+    cols = []
+    for i in range(width):
+        base = rnd.choice(SAP_FIELDS) if rnd.random() < 0.5 else rnd.choice(JA_LABELS)
+        cols.append(f"{base}_{i}")
+    values = ["1000", "東京", "2025/01/01", "株式会社A", "JPY", "12個", "EA", "", "営業部", "30代"]
+    sample = [{c: rnd.choice(values) for c in cols}]
+    return cols, sample
+
+
+def main() -> None:
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    for width in (10, 50, 200, 500):
+        cols, sample = make_extract(width)
+        assert legacy_identify_data_type(cols, sample) == lf._identify_data_type(cols, sample)
+        print(f"--- {width} columns ({calls:,} calls) ---")
+        t, _ = best_of(lambda: [legacy_identify_data_type(cols, sample) for _ in range(calls)], repeat=3)
+        report("before: keyword loops", t, calls, "calls")
+        t, _ = best_of(lambda: [lf._identify_data_type(cols, sample) for _ in range(calls)], repeat=3)
+        report("after:  compiled _KeywordMatcher", t, calls, "calls")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# bench_json_extract.py
+# LLM応答からのJSON取り出し: 旧実装（フェンス除去→json.loads→{～}の再解析）vs _TolerantJsonParser
+# 速度（応答/秒）と、途中で切れた応答から取り戻せたトップレベル項目を比較する
+#   python lambda/benchmarks/bench_json_extract.py [responses]
+
+import json, sys
+from typing import Any, Dict, Optional
+
+from _bench_util import best_of, lf, report
+
+
+def legacy_extract(ai_text: str) -> Dict[str, Any]:
+    """変更前の実装（比較用）"""
+    text = ai_text.strip()
+    if text.startswith("```"):
+        text = text.strip("`").lstrip("json").strip()
+    try:
+        return json.loads(text)
+    except Exception:
+        start = text.find("{"); end = text.rfind("}")
+        if start != -1 and end != -1 and end > start:
+            try: return json.loads(text[start:end+1])
+            except Exception: return {"overview": ai_text}
+        return {"overview": ai_text}
+
+
+def tolerant_extract(ai_text: str) -> Optional[Dict[str, Any]]:
+    return lf._parse_analysis_json(ai_text).value
+
+
+def make_answer() -> str:
+    answer = {
+        "overview": "売上合計は1,064,700円で、ノートPCが全体の7割を占めています。" * 8,
+        "findings": [f"所見{i}: 1月中旬に大口受注が集中し、前月比{i * 3}%増加しました。" for i in range(12)],
+        "kpis": {"total_sales": 1064700, "top_products": [{"name": f"商品{i}", "sales": 100000 - i * 5000} for i in range(10)]},
+        "trend": [{"date": f"2025-01-{d:02d}", "sales": d * 1000.0} for d in range(1, 32)],
+    }
+    return "```json\n" + json.dumps(answer, ensure_ascii=False, indent=2) + "\n```"
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000
+    full = make_answer()
+    cases = [("complete (fenced)", full),
+             ("truncated in trend", full[:full.index('"trend"') + 60]),
+             ("truncated in findings", full[:full.index("所見6")])]
+    for name, text in cases:
+        print(f"--- {name}: {len(text):,} chars ---")
+        t, legacy = best_of(lambda: [legacy_extract(text) for _ in range(n)], repeat=3)
+        report("before: strip + json.loads + {..} rescan", t, n, "responses")
+        t, _ = best_of(lambda: [tolerant_extract(text) for _ in range(n)], repeat=3)
+        report("after:  _parse_analysis_json", t, n, "responses")
+        chunks = [text[i:i + 16] for i in range(0, len(text), 16)]  # ストリーミングの差分相当
+        t, _ = best_of(lambda: [_feed_all(chunks) for _ in range(n)], repeat=3)
+        report("after:  fed as 16-char stream deltas", t, n, "responses")
+        parsed = lf._parse_analysis_json(text)
+        usable = sorted(k for k in legacy[-1] if legacy[-1] is not None and legacy[-1].get(k) != text)
+        print(f"{'':<40} fields recovered: before {usable}, after {sorted(parsed.complete)}"
+              + (" (+partial findings)" if parsed.truncated and "findings" in (parsed.value or {})
+                 and "findings" not in parsed.complete else ""))
+
+
+def _feed_all(chunks) -> Optional[Dict[str, Any]]:
+    p = lf._TolerantJsonParser()
+    for c in chunks:
+        p.feed(c)
+    return p.close().value
+
+
+if __name__ == "__main__":
+    main()
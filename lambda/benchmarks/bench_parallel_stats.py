@@ -0,0 +1,71 @@
+# bench_parallel_stats.py
+# mmap＋プロセス並列のcsv集計スループット（1/2/4/6ワーカー）
+#   python lambda/benchmarks/bench_parallel_stats.py [rows]
+#   python lambda/benchmarks/bench_parallel_stats.py --crossover  # PARALLEL_MIN_BYTES の目安（損益分岐サイズ）
+# 注: スケールは実行環境のvCPU数が上限（Lambdaは10GBメモリ設定で6vCPU）
+
+import os, random, sys
+from typing import Tuple
+
+from _bench_util import best_of, lf, report
+
+
+def make_csv(n: int) -> str:
+    rnd = random.Random(7)
+    lines = ["日付,商品名,売上金額,数量,顧客名,地域"]
+    for _ in range(n):
+        lines.append(
+            f"2025-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d},商品{rnd.randint(1, 5000)},"
+            f"\"{rnd.randint(100, 900000):,}\",{rnd.randint(1, 9)},顧客{rnd.randint(1, 30000)},地域{rnd.randint(1, 47)}"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def crossover() -> None:
+    """単一プロセスの処理時間（ms/MB）と並列経路の固定費・追加費用を測り、ワーカー数ごとの損益分岐サイズを推定する
+    並列経路 ≒ 固定費（spool・プロセス起動・Pipe）+ サイズ × (単一プロセス時間 / ワーカー数 + 追加費用（マージ・サンプル候補）)
+    比例部分は1ワーカーで測るのでvCPUが1つの環境でも推定できる"""
+    def measure(n: int, workers: int = 1) -> Tuple[float, float, float]:
+        text = make_csv(n)
+        mb = len(text) / 1e6  # _should_parallelize と同じく文字数で測る
+        single, _ = best_of(lambda: lf._compute_stats(lf._ColumnarTable.from_csv(text)), repeat=5)
+        par1, _ = best_of(lambda: lf._parallel_csv_stats(text, workers=workers, sample=[]), repeat=5)
+        print(f"{mb:6.2f} M chars: single {single * 1000:8.1f} ms, parallel path with {workers} worker(s) {par1 * 1000:8.1f} ms")
+        return mb, single * 1000, par1 * 1000
+
+    _, s0, p0 = measure(200, workers=2)  # 固定費（2プロセスの起動・Pipe・spool）。行数が少ないので並列度は無関係
+    mb, s1, p1 = measure(50_000)
+    fixed = p0 - s0
+    per_mb = s1 / mb
+    extra = max(0.0, (p1 - s1 - fixed) / mb)
+    print(f"single {per_mb:.0f} ms/M chars, parallel path fixed cost {fixed:.0f} ms + {extra:.0f} ms/M chars")
+    for workers in (2, 4, 6):
+        gain = per_mb - per_mb / workers - extra
+        print(f"{workers} workers: break-even at " + (f"{fixed / gain:.2f} M chars" if gain > 0 else "never"))
+
+
+def main() -> None:
+    if "--crossover" in sys.argv:
+        crossover()
+        return
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    text = make_csv(n)
+    print(f"rows={n:,} size={len(text.encode('utf-8')) / 1e6:.1f} MB cpu_count={os.cpu_count()}")
+
+    t, serial = best_of(lambda: lf._compute_stats(lf._ColumnarTable.from_csv(text)), repeat=3)
+    report("single process (in-memory table)", t, n, "rows")
+
+    path = lf._spool_csv_to_tmp(text)
+    try:
+        base = None
+        for workers in (1, 2, 4, 6):
+            t, acc = best_of(lambda: lf._parallel_csv_stats_file(path, workers), repeat=3)
+            assert acc.finalize() == serial, "parallel result differs from single-process result"
+            base = base or t
+            report(f"mmap partitions, {workers} worker(s)  x{base / t:.2f}", t, n, "rows")
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
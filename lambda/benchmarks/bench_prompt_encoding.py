@@ -0,0 +1,71 @@
+# bench_prompt_encoding.py
+# プロンプトに埋め込むサンプル行・時系列の形式（json / csv / columnar）の比較
+#   既定: 推定トークン数と文字数のみ（オフライン）
+#   --bedrock: 実際に Bedrock を呼び、usage.inputTokens とレイテンシを計測（AWS認証情報が必要・課金あり）
+#   python lambda/benchmarks/bench_prompt_encoding.py [--bedrock] [--repeat N]
+
+import argparse, os, random, time
+from typing import Any, Dict, List, Tuple
+
+from _bench_util import lf
+
+TEST_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "test-data", "sample-sales.csv")
+
+
+def load_cases() -> List[Tuple[str, List[Dict[str, Any]]]]:
+    cases = []
+    with open(TEST_DATA, encoding="utf-8-sig") as f:
+        cases.append(("test-data/sample-sales.csv", lf._parse_csv_simple(f.read())))
+    # 幅の広いSAP抽出（200列、1年分の日次明細）
+    rnd = random.Random(18)
+    fields = [f"FIELD{i:03d}" for i in range(196)]
+    rows = []
+    for day in range(365):
+        for _ in range(20):
+            row = {"転記日付": f"2025-{day // 31 % 12 + 1:02d}-{day % 28 + 1:02d}", "品目": f"MAT{rnd.randint(1, 300):05d}",
+                   "正味額": str(rnd.randint(1000, 999999)), "プラント": rnd.choice(["1000", "1100", "2000"])}
+            row.update({f: rnd.choice(["", "X", "JPY", "EA", "01", str(rnd.randint(0, 99))]) for f in fields})
+            rows.append(row)
+    cases.append(("synthetic SAP extract (200 columns)", rows))
+    return cases
+
+
+def build(rows: List[Dict[str, Any]], encoding: str) -> Tuple[str, Dict[str, Any]]:
+    table = lf._ColumnarTable.from_rows(rows)
+    stats = lf._compute_stats(table)
+    stats = {**stats, "timeseries": lf._downsample_timeseries(stats["timeseries"])[0]}
+    sample = lf._representative_sample(table, lf.SAMPLE_ROWS)
+    return lf._assemble_prompt(lf._build_prompt_json, stats, sample, "sales_data", budget=10**9, encoding=encoding)
+
+
+def bedrock_call(prompt: str) -> Tuple[float, int]:
+    """出力は短く切って入力側の差だけを見る"""
+    client = lf._aws_client("bedrock-runtime", lf.REGION)
+    t0 = time.perf_counter()
+    resp = client.converse(modelId=lf.MODEL_ID, system=lf._SYSTEM_JA,
+                           messages=[{"role": "user", "content": [{"text": prompt}]}],
+                           inferenceConfig={"maxTokens": 64, "temperature": lf.TEMPERATURE})
+    return time.perf_counter() - t0, resp.get("usage", {}).get("inputTokens", 0)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--bedrock", action="store_true")
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+    for name, rows in load_cases():
+        print(f"--- {name}: {len(rows):,} rows ---")
+        print(f"{'encoding':<10} {'chars':>9} {'est.tokens':>11} {'stats':>7} {'sample':>7}"
+              + (f" {'inputTokens':>12} {'latency':>9}" if args.bedrock else ""))
+        for encoding in lf.PROMPT_DATA_FORMATS:
+            prompt, info = build(rows, encoding)
+            line = (f"{encoding:<10} {len(prompt):>9,} {info['input_tokens']:>11,} "
+                    f"{info['components']['stats']:>7,} {info['components']['sample']:>7,}")
+            if args.bedrock:
+                runs = [bedrock_call(prompt) for _ in range(args.repeat)]
+                line += f" {runs[-1][1]:>12,} {min(t for t, _ in runs) * 1000:>7.0f}ms"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
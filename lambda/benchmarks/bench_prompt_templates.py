@@ -0,0 +1,73 @@
+# bench_prompt_templates.py
+# プロンプト固定部分の事前生成: 起動時（モジュール読み込み）のコストとリクエストごとの組み立てコスト
+# 旧実装は呼び出しのたびに分析指示の辞書・スキーマ辞書を作り直し、JSON化とf-string展開をしていた
+#   python lambda/benchmarks/bench_prompt_templates.py [requests] [--imports N]
+
+import argparse, json, os, subprocess, sys
+from typing import Any, Dict, List
+
+from _bench_util import HANDLER_DIR, best_of, lf, report
+
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import lambda_function; print(time.perf_counter() - t)"
+
+
+def legacy_build_prompt_json(stats: Dict[str, Any], sample: List[Dict[str, Any]], data_type: str = "sales_data",
+                             encoding: str = "json") -> str:
+    """変更前の実装（比較用）: 指示文の表・スキーマ・前半部分を毎回組み立てる"""
+    instructions = dict(lf._ANALYSIS_INSTRUCTIONS)
+    schema_hint = json.loads(lf._PROMPT_SCHEMA_HINT_JSON)
+    analysis_instructions = instructions.get(data_type, instructions["financial_data"])
+    head = lf._json_prompt_head(lf._get_data_type_name(data_type), analysis_instructions)
+    head = head.replace(lf._PROMPT_SCHEMA_HINT_JSON, json.dumps(schema_hint, ensure_ascii=False))
+    return (f"{head}統計サマリー: {lf._encode_stats(stats, encoding)}\n"
+            f"サンプルデータ: {lf._encode_rows(sample, encoding)}{lf._JSON_PROMPT_TAIL}")
+
+
+def import_seconds(runs: int) -> float:
+    """新しいプロセスで lambda_function を読み込む時間（コールドスタート相当、boto3 の読み込みを含む）"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [HANDLER_DIR, os.environ.get("PYTHONPATH")])))
+    times = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], env=env, cwd=HANDLER_DIR,
+                             capture_output=True, text=True, check=True)
+        times.append(float(out.stdout.strip().splitlines()[-1]))
+    return min(times)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("requests", type=int, nargs="?", default=20_000)
+    ap.add_argument("--imports", type=int, default=5)
+    args = ap.parse_args()
+    n = args.requests
+    data_types = list(lf._JSON_PROMPT_HEADS)
+
+    print("--- startup ---")
+    report("module import (fresh process)", import_seconds(args.imports), 1, "imports")
+    t, _ = best_of(lambda: {dt: lf._json_prompt_head(lf._get_data_type_name(dt), lf._get_analysis_instructions(dt))
+                            for dt in data_types}, repeat=20)
+    report(f"compile {len(data_types)} JSON prompt heads", t, len(data_types), "templates")
+
+    # 統計・サンプルが小さいほど固定部分の組み立てコストの比率が大きい
+    stats = {"total_records": 16, "total_sales": 1064700.0, "top_products": [{"name": "ノートPC", "sales": 750000.0}],
+             "timeseries": [{"date": "2025-01-01", "sales": 250000.0}]}
+    sample = [{"日付": "2025-01-01", "商品": "ノートPC", "売上": "250000"}] * 16
+    for dt in data_types:
+        assert legacy_build_prompt_json(stats, sample, dt) == lf._build_prompt_json(stats, sample, dt)
+
+    print(f"--- per request ({n:,} prompts, small stats/sample) ---")
+    t, _ = best_of(lambda: [legacy_build_prompt_json(stats, sample, data_types[i % len(data_types)]) for i in range(n)],
+                   repeat=3)
+    report("before: build templates per call", t, n, "prompts")
+    t, _ = best_of(lambda: [lf._build_prompt_json(stats, sample, data_types[i % len(data_types)]) for i in range(n)],
+                   repeat=3)
+    report("after:  _build_prompt_json", t, n, "prompts")
+    t, _ = best_of(lambda: [lf._build_prompt_markdown(stats, sample) for _ in range(n)], repeat=3)
+    report("after:  _build_prompt_markdown", t, n, "prompts")
+    t, _ = best_of(lambda: [lf._assemble_prompt(lf._build_prompt_json, stats, sample, "sales_data") for _ in range(n)],
+                   repeat=3)
+    report("after:  _assemble_prompt (json)", t, n, "prompts")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# bench_to_number.py
+# _to_number のマイクロベンチマーク（セル/秒）: 旧実装 vs 変換テーブル版 vs 列単位変換
+#   python lambda/benchmarks/bench_to_number.py [cells]
+
+import random, sys
+from typing import Any
+
+from _bench_util import best_of, lf, report
+
+
+def legacy_to_number(x: Any) -> float:
+    """変更前の実装（比較用）"""
+    try:
+        s = str(x).replace(",", "").replace("¥", "").replace("円", "").strip()
+        return float(s)
+    except Exception:
+        return 0.0
+
+
+def make_cells(n: int, style: str, distinct: int = 0) -> list:
+    """distinct>0 なら値の種類数を制限（SAP帳票のように同じ金額が繰り返されるケース）"""
+    rnd = random.Random(42)
+    out = []
+    for _ in range(n):
+        v = rnd.randint(100, 100 + distinct) if distinct else rnd.randint(100, 9_999_999)
+        if style == "plain":
+            out.append(str(v))
+        elif style == "comma":
+            out.append(f"{v:,}")
+        else:  # 日本の会計帳票風の混在データ
+            r = rnd.random()
+            if r < 0.3:
+                out.append(f"{v:,}")
+            elif r < 0.5:
+                out.append(f"¥{v:,}")
+            elif r < 0.65:
+                out.append(str(v).translate(str.maketrans("0123456789", "０１２３４５６７８９")))
+            elif r < 0.8:
+                out.append(f"△{v:,}")
+            elif r < 0.9:
+                out.append(f"({v:,})")
+            else:
+                out.append(f"{v // 1000:,}千円")
+    return out
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    # 注: 旧実装は全角・△・括弧・千円などを 0.0 にしていたため、japanese では結果自体が異なる
+    for style, distinct in (("plain", 0), ("comma", 0), ("japanese", 0), ("japanese", 2_000)):
+        cells = make_cells(n, style, distinct)
+        label = f"{style}, {distinct:,} distinct" if distinct else style
+        print(f"--- {label} ({n:,} cells) ---")
+        t, _ = best_of(lambda: [legacy_to_number(c) for c in cells])
+        report("before: legacy _to_number per cell", t, n, "cells")
+        t, _ = best_of(lambda: [lf._to_number(c) for c in cells])
+        report("after:  _to_number per cell", t, n, "cells")
+        t, _ = best_of(lambda: lf._column_to_numbers(cells))
+        report("after:  _column_to_numbers (column)", t, n, "cells")
+        table = lf._ColumnarTable.from_rows({"v": c} for c in cells)
+        t, _ = best_of(lambda: (table._numeric.clear(), table.numeric("v")), repeat=3)
+        report("after:  _ColumnarTable.numeric (dict-encoded)", t, n, "cells")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,29 @@
 # lambda_function.py
 # Stable, no external deps. Reads salesData (array) or csv (string). Bedrock converse. CORS/OPTIONS ready.
-
-import json, os, base64, logging, boto3, urllib.request, urllib.parse
-from collections import Counter, defaultdict
-from typing import Any, Dict, List, Optional, Tuple
+# NumPy is optional: if present (e.g. via Lambda layer) stats aggregation is vectorized.
+
+import json, os, re, time, base64, logging, boto3, urllib.request, urllib.parse, csv, io, mmap, tempfile, math, random, hashlib
+import multiprocessing, threading, sqlite3
+from array import array
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ReadTimeoutError
+from collections import OrderedDict, defaultdict, deque
+from datetime import date
+from functools import lru_cache, reduce
+from heapq import nlargest
+from itertools import chain, islice, zip_longest
+from json.decoder import scanstring
+from operator import add
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# NumPy（任意）: 無ければ純Pythonの集計にフォールバック
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    np = None
+    NUMPY_AVAILABLE = False
 
 # ====== ENV ======
 MODEL_ID       = os.environ.get("BEDROCK_MODEL_ID", "us.deepseek.r1-v1:0")
@@ -12,6 +32,42 @@ DEFAULT_FORMAT = (os.environ.get("DEFAULT_FORMAT", "json") or "json").lower()  #
 MAX_TOKENS     = int(os.environ.get("MAX_TOKENS", "8000"))  # 戦略レベル分析用に大幅増加
 TEMPERATURE    = float(os.environ.get("TEMPERATURE", "0.15"))
 LINE_NOTIFY_TOKEN = os.environ.get("LINE_NOTIFY_TOKEN", "")
+SAMPLE_ROWS    = int(os.environ.get("SAMPLE_ROWS", "50"))  # プロンプトに載せるサンプル行数
+SAMPLE_MODE    = (os.environ.get("SAMPLE_MODE", "stratified") or "stratified").lower()  # 'stratified'|'head'
+STATS_BACKEND  = (os.environ.get("STATS_BACKEND", "auto") or "auto").lower()  # 'auto'|'numpy'|'python'
+TOPK_EXACT_LIMIT   = int(os.environ.get("TOPK_EXACT_LIMIT", "50000"))  # 商品の種類数がこれを超えたら近似top-Kへ
+TOPK_CAPACITY      = int(os.environ.get("TOPK_CAPACITY", "2000"))     # 近似時に追跡する商品数
+STATS_SKETCHES     = os.environ.get("STATS_SKETCHES", "0").lower() in ("1", "true")  # 分布スケッチ（HLL/KLL）を出力
+SKETCH_MAX_COLUMNS = int(os.environ.get("SKETCH_MAX_COLUMNS", "32"))  # スケッチ対象の最大列数（メモリ固定のため）
+TS_BUCKET          = (os.environ.get("TS_BUCKET", "day") or "day").lower()  # 'day'|'week'|'month'|'quarter'|'fiscal'
+TS_MAX_POINTS      = int(os.environ.get("TS_MAX_POINTS", "120"))  # プロンプト・応答に載せる時系列の最大点数（0で無制限）
+TS_DOWNSAMPLE      = (os.environ.get("TS_DOWNSAMPLE", "auto") or "auto").lower()  # 'auto'|'rollup'|'lttb'
+FISCAL_START_MONTH = int(os.environ.get("FISCAL_START_MONTH", "4"))  # 会計年度の開始月（日本企業は4月が多い）
+HEADER_CACHE_SIZE  = int(os.environ.get("HEADER_CACHE_SIZE", "256"))  # ヘッダー構成ごとの判定結果キャッシュ（コンテナ単位）
+AWS_READ_TIMEOUT   = int(os.environ.get("AWS_READ_TIMEOUT", "300"))  # 長文生成（MAX_TOKENS）が既定の60秒を超えるため
+AWS_MAX_ATTEMPTS   = int(os.environ.get("AWS_MAX_ATTEMPTS", "3"))    # 初回＋リトライ（standardモード）
+AWS_MAX_POOL       = int(os.environ.get("AWS_MAX_POOL", "10"))       # クライアントごとのHTTP接続プール
+LLM_CACHE_TTL      = int(os.environ.get("LLM_CACHE_TTL", "3600"))     # LLM応答キャッシュの有効期間（秒、0で無効）
+LLM_CACHE_SIZE     = int(os.environ.get("LLM_CACHE_SIZE", "128"))     # メモリ層・SQLite層の最大件数（LRU）
+LLM_CACHE_BACKEND  = (os.environ.get("LLM_CACHE_BACKEND", "memory") or "memory").lower()  # 'memory'|'sqlite'|'dynamodb'
+LLM_CACHE_SQLITE   = os.environ.get("LLM_CACHE_SQLITE", "/tmp/llm_cache.sqlite3")
+LLM_CACHE_TABLE    = os.environ.get("LLM_CACHE_TABLE", "")            # DynamoDBテーブル名（パーティションキー cache_key、TTL属性 expires_at）
+PROMPT_DATA_FORMAT  = (os.environ.get("PROMPT_DATA_FORMAT", "json") or "json").lower()  # サンプル・時系列の埋め込み形式 'json'|'csv'|'columnar'
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "24000"))  # 入力トークン上限（推定）。超える分は低優先の要素から削る
+PRICE_INPUT_PER_1K  = float(os.environ.get("PRICE_INPUT_PER_1K", "0.00135"))  # USD/1Kトークン（DeepSeek-R1 on Bedrock）
+PRICE_OUTPUT_PER_1K = float(os.environ.get("PRICE_OUTPUT_PER_1K", "0.0054"))
+MAX_COST_USD        = float(os.environ.get("MAX_COST_USD", "0"))  # 1回の推定コスト上限（0で無制限）。超える場合は出力上限を下げる
+MIN_OUTPUT_TOKENS   = int(os.environ.get("MIN_OUTPUT_TOKENS", "1000"))  # 出力上限をこれ未満に下げる必要があれば拒否
+PROMPT_CACHE        = (os.environ.get("PROMPT_CACHE", "auto") or "auto").lower()  # Bedrockプロンプトキャッシュ 'auto'|'1'|'0'（autoは対応モデルのみ）
+STRUCTURED_OUTPUT   = (os.environ.get("STRUCTURED_OUTPUT", "auto") or "auto").lower()  # JSON形式をtool useで受け取る 'auto'|'1'|'0'（autoは対応モデルのみ）
+STRUCTURED_REPAIR   = int(os.environ.get("STRUCTURED_REPAIR", "1"))  # スキーマ不適合時に送る修正ターンの上限（0で無効）
+DEADLINE_RESERVE_MS = int(os.environ.get("DEADLINE_RESERVE_MS", "1500"))  # Lambdaの残り時間のうち応答の組み立て・返却に残す分
+LLM_TOKENS_PER_SEC  = float(os.environ.get("LLM_TOKENS_PER_SEC", "40"))  # 出力速度の見積もり（残り時間→出力トークン上限の換算）
+GENERATION_PROFILES = os.environ.get("GENERATION_PROFILES", "")  # 形式・分析タイプ別の生成設定（JSON文字列またはJSONファイルのパス）
+# これ以上（文字数）のcsvは並列集計。損益分岐は約0.25M文字（bench_parallel_stats.py --crossover）なので余裕を見て1M。
+# Lambdaのリクエスト上限（6MB）より十分小さくする
+PARALLEL_MIN_BYTES = int(os.environ.get("PARALLEL_MIN_BYTES", str(1024 * 1024)))
+PARALLEL_WORKERS   = int(os.environ.get("PARALLEL_WORKERS", "0") or "0") or (os.cpu_count() or 1)
 
 # ====== LOG ======
 logger = logging.getLogger()
@@ -28,6 +84,29 @@ def response_json(status: int, body: Dict[str, Any]) -> Dict[str, Any]:
         "body": json.dumps(body, ensure_ascii=False)
     }
 
+def response_sse(events: Iterable[str], status: int = 200) -> Dict[str, Any]:
+    """Server-Sent Events 形式のレスポンス（events は _sse_event で整形済みの文字列）
+    注: Python の管理ランタイムにはレスポンスストリーミングが無いため、全イベントを1つの本文にまとめて返す
+    （バッファ済みSSE。クライアントに届くのは生成完了後）。逐次配信にはストリーミング対応の前段が必要"""
+    return {
+        "statusCode": status,
+        "headers": {
+            "Content-Type": "text/event-stream; charset=utf-8",
+            "Cache-Control": "no-cache"
+        },
+        "body": "".join(events)
+    }
+
+def _sse_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _respond(status: int, body: Dict[str, Any], stream_events: Optional[List[str]]) -> Dict[str, Any]:
+    """stream=true のリクエストにはエラーを含めて常にSSE形式（final イベント）で返す"""
+    if stream_events is None:
+        return response_json(status, body)
+    stream_events.append(_sse_event("final", body))
+    return response_sse(stream_events, status)
+
 # ====== Debug early echo (enable with LAMBDA_DEBUG_ECHO=1 or ?echo=1) ======
 def _early_echo(event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     try:
@@ -62,18 +141,100 @@ def _early_echo(event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         return None
 
 # ====== Helpers ======
+# 数値正規化テーブル: 全角数字・全角記号→半角、桁区切り・通貨記号（SJISの円記号 \ を含む）・空白は削除、△▲は負号
+_NUM_TRANS = str.maketrans({
+    **{chr(0xFF10 + i): str(i) for i in range(10)},
+    ",": None, "，": None, "¥": None, "￥": None, "\\": None, "円": None,
+    " ": None, "\u3000": None,
+    "．": ".", "－": "-", "−": "-", "＋": "+",
+    "△": "-", "▲": "-",
+    "（": "(", "）": ")",
+})
+# 日本の会計帳票でよく使われる金額単位（末尾一致、百万円は万円より先に判定）
+_YEN_UNITS = (("百万円", 1e6), ("千円", 1e3), ("万円", 1e4), ("億円", 1e8))
+
+def _parse_number(x: Any) -> Optional[float]:
+    """数値セルを1パスで正規化して float にする。数値として解釈できなければ None"""
+    if type(x) is int or type(x) is float:
+        return float(x)
+    s = x if type(x) is str else str(x)
+    # 高速パス: 半角のみのセルは桁区切りを除いて float() で確定する（例外を起こさない分岐を優先）
+    if s.isascii() and "(" not in s:
+        if "," in s:
+            s = s.replace(",", "")
+        try:
+            return float(s)
+        except ValueError:
+            pass
+    # 一般パス: 変換テーブルで全角・通貨記号・負数表記を1パスで正規化
+    s = s.strip()
+    if not s:
+        return None
+    scale = 1.0
+    if s[-1] == "円":
+        for unit, mult in _YEN_UNITS:
+            if s.endswith(unit):
+                s, scale = s[:-len(unit)], mult
+                break
+    t = s.translate(_NUM_TRANS)
+    if t[:1] == "(" and t[-1:] == ")":  # (1,200) / （1,200） は負数
+        t = "-" + t[1:-1]
+    try:
+        v = float(t)
+    except ValueError:
+        return None
+    return v * scale if scale != 1.0 else v
+
 def _to_number(x: Any) -> float:
+    v = _parse_number(x)
+    return 0.0 if v is None else v
+
+def _infer_number_kind(values: List[Any], probe: int = 32) -> str:
+    """列のユニーク値の先頭を調べ、数値形式を列単位で1回だけ判定する
+    'plain': float() でそのまま読める / 'comma': 半角カンマ除去だけで読める /
+    'ja': 全角・△・括弧・単位などの正規化が必要 / 'text': 数値でない"""
+    kind = "plain"
+    for v in islice(values, probe):
+        if type(v) is int or type(v) is float or v == "":
+            continue
+        if type(v) is str and v.isascii() and "(" not in v:
+            try:
+                float(v.replace(",", "") if "," in v else v)
+                if "," in v and kind == "plain":
+                    kind = "comma"
+                continue
+            except ValueError:
+                pass
+        if _parse_number(v) is None:
+            return "text"
+        kind = "ja"
+    return kind
+
+def _column_to_numbers(values: List[Any]) -> List[float]:
+    """列の値をまとめて数値化。判定した形式の一括変換を試し、失敗時のみ値ごとの正規化へ"""
+    kind = _infer_number_kind(values) if values else "text"
     try:
-        s = str(x).replace(",", "").replace("¥", "").replace("円", "").strip()
-        return float(s)
-    except Exception:
-        return 0.0
+        if kind == "plain":
+            return list(map(float, values))
+        if kind == "comma":
+            return [float(v.replace(",", "")) for v in values]
+    except (AttributeError, TypeError, ValueError):
+        pass
+    return list(map(_to_number, values))
 
 def _detect_columns(rows: List[Dict[str, Any]]) -> Dict[str, str]:
-    colmap: Dict[str, str] = {}
     if not rows:
-        return colmap
-    for c in rows[0].keys():
+        return {}
+    return _detect_columns_from_headers(rows[0].keys())
+
+def _detect_columns_from_headers(headers: Iterable[Any]) -> Dict[str, str]:
+    """列の役割（date/sales/product）を判定。同じヘッダー構成の2回目以降はキャッシュから返す"""
+    headers = list(headers)
+    return dict(_HEADER_CACHE.get(headers, "colmap", lambda: _detect_column_roles(headers)))
+
+def _detect_column_roles(headers: List[Any]) -> Dict[str, str]:
+    colmap: Dict[str, str] = {}
+    for c in headers:
         name = str(c)
         lc = name.lower()
         if ("日" in name) or ("date" in lc):
@@ -82,68 +243,1153 @@ def _detect_columns(rows: List[Dict[str, Any]]) -> Dict[str, str]:
             colmap.setdefault("sales", name)
         if ("商" in name) or ("品" in name) or ("product" in lc) or ("item" in lc) or ("name" in lc):
             colmap.setdefault("product", name)
+        if ("地域" in name) or ("エリア" in name) or ("都道府県" in name) or ("支店" in name) or ("店舗" in name) \
+                or ("region" in lc) or ("area" in lc) or ("store" in lc):
+            colmap.setdefault("region", name)
     return colmap
 
-def _compute_stats(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
-    total = len(rows)
-    if total == 0:
-        return {"total_rows": 0, "total_sales": 0.0, "avg_row_sales": 0.0, "top_products": [], "timeseries": []}
+# ====== Header-signature cache ======
+# 同じテナントは毎日同じレイアウトのSAPエクスポートをアップロードするため、列の役割判定と
+# データ種別判定の結果をヘッダー構成ごとにLRUで保持する（ウォームコンテナ間で再利用）。
+def _header_signature(headers: Iterable[Any]) -> str:
+    """format-learning-handler の generate_format_signature と同じ正規化・ハッシュ"""
+    normalized = [str(h).lower().strip().replace(" ", "").replace("_", "").replace("-", "") for h in headers if h]
+    return hashlib.md5("|".join(sorted(normalized)).encode()).hexdigest()
+
+class _HeaderCache:
+    """ヘッダーシグネチャ → 判定結果（colmap / data_type）のLRU
+    シグネチャは表記ゆれ・列順を無視するため、列名そのものを返す colmap の取り違えを防ぐ目的で
+    エントリには元のヘッダー列も保持し、一致しなければミス扱いで作り直す。"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.hits: Dict[str, int] = defaultdict(int)
+        self.misses: Dict[str, int] = defaultdict(int)
+
+    def get(self, headers: List[Any], field: str, compute: Callable[[], Any]) -> Any:
+        key = _header_signature(headers)
+        raw = tuple(map(str, headers))
+        entry = self.entries.get(key)
+        if entry is None or entry["headers"] != raw:
+            entry = self.entries[key] = {"headers": raw}
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        self.entries.move_to_end(key)
+        if field in entry:
+            self.hits[field] += 1
+            return entry[field]
+        self.misses[field] += 1
+        value = entry[field] = compute()
+        return value
+
+    def info(self) -> Dict[str, Any]:
+        fields = sorted(set(self.hits) | set(self.misses))
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            **{f: {"hits": self.hits[f], "misses": self.misses[f]} for f in fields},
+        }
 
-    colmap = _detect_columns(rows)
-    dcol, scol, pcol = colmap.get("date"), colmap.get("sales"), colmap.get("product")
+_HEADER_CACHE = _HeaderCache(HEADER_CACHE_SIZE)
+
+# ====== Date normalization ======
+# SAP帳票の日付表記（2025/1/1, 20250101, 2025年1月1日, 令和7年1月1日, R7.1.1, タイムスタンプ）を
+# date に正規化し、day/week/month/fiscal のバケットキーに変換する。同じ日付文字列が大量に
+# 繰り返されるため、生文字列→キーの変換結果を lru_cache でメモ化する。
+TS_BUCKETS = ("day", "week", "month", "quarter", "fiscal")
+_DATE_TRANS = str.maketrans({
+    **{chr(0xFF10 + i): str(i) for i in range(10)},
+    "／": "/", "－": "-", "．": ".", "\u3000": " ",
+})
+_ERA_BASE = {"令和": 2018, "R": 2018, "平成": 1988, "H": 1988, "昭和": 1925, "S": 1925}
+_DATE_ERA_RE = re.compile(r"(令和|平成|昭和|[RHS])\s*(元|\d{1,2})\s*[年./-]\s*(\d{1,2})\s*[月./-]\s*(\d{1,2})", re.I)
+_DATE_YMD_RE = re.compile(r"(\d{4})\s*[-/.年]\s*(\d{1,2})\s*[-/.月]\s*(\d{1,2})(?!\d)")
+_DATE_COMPACT_RE = re.compile(r"(\d{4})(\d{2})(\d{2})(?:$|[T\s_]|\d{4,6}$)")
+_TIME_PART_RE = re.compile(r"[T\s]+\d{1,2}:\d{2}.*$", re.S)
+
+def _parse_date(s: str) -> Optional[date]:
+    """日付文字列を date に変換（解釈できなければ None）。時刻部分は無視する"""
+    s = s.strip().translate(_DATE_TRANS)
+    m = _DATE_YMD_RE.match(s)
+    if m:
+        y, mo, d = int(m.group(1)), int(m.group(2)), int(m.group(3))
+    else:
+        m = _DATE_COMPACT_RE.match(s)
+        if m:
+            y, mo, d = int(m.group(1)), int(m.group(2)), int(m.group(3))
+        else:
+            m = _DATE_ERA_RE.match(s)
+            if not m:
+                return None
+            era = m.group(1)
+            n = 1 if m.group(2) == "元" else int(m.group(2))
+            y, mo, d = _ERA_BASE[era.upper() if len(era) == 1 else era] + n, int(m.group(3)), int(m.group(4))
+    try:
+        return date(y, mo, d)
+    except ValueError:
+        return None
+
+def _bucket_of(d: date, bucket: str) -> str:
+    if bucket == "month":
+        return f"{d.year:04d}-{d.month:02d}"
+    if bucket == "week":
+        iso = d.isocalendar()
+        return f"{iso[0]:04d}-W{iso[1]:02d}"
+    if bucket == "quarter":
+        return f"{d.year:04d}-Q{(d.month - 1) // 3 + 1}"
+    if bucket == "fiscal":
+        # 年度は開始月の年で呼ぶ（2025年4月〜2026年3月 = FY2025）
+        fy = d.year if d.month >= FISCAL_START_MONTH else d.year - 1
+        q = (d.month - FISCAL_START_MONTH) % 12 // 3 + 1
+        return f"FY{fy}-Q{q}"
+    return d.isoformat()
+
+@lru_cache(maxsize=65536)
+def _date_bucket(s: str, bucket: str) -> str:
+    d = _parse_date(s)
+    if d is None:
+        # 解釈できない値は従来どおりの文字列キー（"/"→"-"、先頭10文字）
+        dt = s.strip().replace("/", "-")
+        return dt[:10] if len(dt) >= 10 else dt
+    return _bucket_of(d, bucket)
+
+def _day_key(raw: Any, bucket: str = "day") -> str:
+    """時系列集計のバケットキー（bucket: day/week/month/fiscal）"""
+    if raw is None:
+        return ""
+    s = raw if type(raw) is str else str(raw)
+    if len(s) > 10:
+        # タイムスタンプは時刻を落としてからキャッシュを引く（時刻付きの値はほぼ一意でヒットしない）
+        if s[10] in " T" and s[4] in "-/" and s[7] in "-/":
+            s = s[:10]
+        elif ":" in s:
+            s = _TIME_PART_RE.sub("", s)
+    return _date_bucket(s, bucket)
+
+# ====== Columnar table ======
+# 行dictのリストは全行でヘッダー文字列をキーとして重複保持するため、アップロードデータは
+# 列指向で保持する。整数列は array('q')、それ以外は辞書エンコード（ユニーク値＋コード配列）。
+# 数値配列・辞書コードは統計やプロンプトが触れた列だけ遅延生成してキャッシュする。
+INGEST_CHUNK_ROWS = 4096
+
+class _IntColumn:
+    """整数のみの列（元がCSV文字列なら text=True で文字列として復元）"""
+    __slots__ = ("data", "text")
+
+    def __init__(self, text: bool):
+        self.data = array("q")
+        self.text = text
+
+    def try_extend(self, vals: List[Any]) -> bool:
+        # 文字列へ完全に復元できる10進整数だけを受け付ける（"007" "1,200" 全角数字などは辞書列へ）
+        try:
+            if self.text:
+                ints = list(map(int, vals))
+                if list(map(str, ints)) != vals:
+                    return False
+            else:
+                if not all(type(v) is int for v in vals):
+                    return False
+                ints = vals
+            # 先に別配列へ変換する（int64を超える値で途中まで追加された状態を残さない）
+            self.data.extend(array("q", ints))
+        except (ValueError, TypeError, OverflowError):
+            return False
+        return True
+
+    def get(self, i: int) -> Any:
+        v = self.data[i]
+        return str(v) if self.text else v
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+class _DictColumn:
+    """辞書エンコード列: ユニーク値（挿入順＝コード順）+ 行ごとのコード配列"""
+    __slots__ = ("codes", "index", "_values")
+
+    def __init__(self):
+        self.codes = array("I")
+        self.index: Dict[Any, int] = {}
+        self._values: Optional[List[Any]] = None
+
+    def extend(self, vals: List[Any]) -> None:
+        self._values = None
+        idx = self.index
+        keys = vals
+        if {*map(type, vals)} - {str}:
+            # 1 / 1.0 / True は辞書キーとして同一視されるため、文字列以外は (型, 値) で登録する
+            # dict/listなどハッシュ不可の値はJSON文字列として保持する
+            keys = [v if type(v) is str else (type(v), _hashable(v)) for v in vals]
+        uniq = dict.fromkeys(keys)
+        # 新規値の登録はユニーク値だけのループ、コード化はCレベルのmapで行う
+        for v in uniq:
+            if v not in idx:
+                idx[v] = len(idx)
+        self.codes.extend(map(idx.__getitem__, keys))
+
+    @property
+    def values(self) -> List[Any]:
+        if self._values is None:
+            self._values = [k[1] if type(k) is tuple else k for k in self.index]
+        return self._values
+
+    def get(self, i: int) -> Any:
+        return self.values[self.codes[i]]
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+def _hashable(v: Any) -> Any:
+    try:
+        hash(v)
+        return v
+    except TypeError:
+        return json.dumps(v, ensure_ascii=False, default=str)
+
+class _ColumnarTable:
+    """アップロードデータの列指向テーブル（行はチャンク単位で列へ追加）"""
+
+    def __init__(self, columns: List[str]):
+        self.columns = list(columns)
+        self._cols: Dict[str, Any] = {}
+        self._numeric: Dict[str, array] = {}
+        self._encoded: Dict[str, Tuple[array, List[Any]]] = {}
+        self._len = 0
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Dict[str, Any]]) -> "_ColumnarTable":
+        """行dictのストリームから構築（保持するのは INGEST_CHUNK_ROWS 行分だけ）"""
+        it = iter(rows)
+        first = next(it, None)
+        table = cls(list(first.keys()) if first else [])
+        if first is None:
+            return table
+        it = chain((first,), it)
+        while True:
+            chunk = list(islice(it, INGEST_CHUNK_ROWS))
+            if not chunk:
+                return table
+            table._extend({h: [r.get(h, "") for r in chunk] for h in table.columns}, len(chunk))
+
+    @classmethod
+    def from_csv(cls, csv_text: str, headers: Optional[List[str]] = None) -> "_ColumnarTable":
+        """CSVテキストから行dictを作らずに構築（_iter_csv_rows と同じ解釈）
+        headers を渡すとテキストはヘッダー行を含まないデータ部分として扱う（並列集計のパーティション用）"""
+        cells_iter = _iter_csv_cells(csv_text, has_header=headers is None)
+        if headers is None:
+            headers = next(cells_iter, None)
+        table = cls(headers or [])
+        if not headers:
+            return table
+        width = len(headers)
+        while True:
+            chunk = list(islice(cells_iter, INGEST_CHUNK_ROWS))
+            if not chunk:
+                return table
+            for cells in chunk:
+                if len(cells) != width:
+                    cells[width:] = []
+                    cells.extend([""] * (width - len(cells)))
+            by_col = zip(*chunk)
+            table._extend({h: list(map(str.strip, col)) for h, col in zip(headers, by_col)}, len(chunk))
+
+    def _extend(self, by_col: Dict[str, List[Any]], n: int) -> None:
+        cols = self._cols
+        for h, vals in by_col.items():
+            col = cols.get(h)
+            if col is None:
+                col = cols[h] = _IntColumn(text=type(vals[0]) is str)
+            if type(col) is _IntColumn and not col.try_extend(vals):
+                col = cols[h] = self._demote(col)
+            if type(col) is _DictColumn:
+                col.extend(vals)
+        self._len += n
+
+    @staticmethod
+    def _demote(col: _IntColumn) -> _DictColumn:
+        out = _DictColumn()
+        out.extend([col.get(i) for i in range(len(col))])
+        return out
+
+    def __len__(self) -> int:
+        return self._len
+
+    def column(self, col: str) -> Any:
+        return self._cols[col]
+
+    def value(self, col: str, i: int) -> Any:
+        return self._cols[col].get(i)
+
+    def rows(self, start: int = 0, stop: Optional[int] = None) -> List[Dict[str, Any]]:
+        """指定範囲だけ行dictを復元（サンプル用）"""
+        stop = self._len if stop is None else min(stop, self._len)
+        return self.take(range(start, stop))
+
+    def take(self, indices: Iterable[int]) -> List[Dict[str, Any]]:
+        """指定した行番号の行dictを復元"""
+        cols = [(h, self._cols[h]) for h in self.columns]
+        return [{h: c.get(i) for h, c in cols} for i in indices]
+
+    def numeric(self, col: str) -> array:
+        """列を _to_number 相当で数値化した array('d')（ユニーク値ごとに1回だけ変換）"""
+        arr = self._numeric.get(col)
+        if arr is None:
+            c = self._cols[col]
+            if type(c) is _IntColumn:
+                arr = array("d", c.data)
+            else:
+                lut = _column_to_numbers(c.values)
+                arr = array("d", map(lut.__getitem__, c.codes))
+            self._numeric[col] = arr
+        return arr
+
+    def encoded(self, col: str) -> Tuple[array, List[Any]]:
+        """(コード配列, ユニーク値リスト) を返す。整数列はここで初めて辞書化する"""
+        enc = self._encoded.get(col)
+        if enc is None:
+            c = self._cols[col]
+            if type(c) is _IntColumn:
+                c = self._demote(c)
+            enc = self._encoded[col] = (c.codes, c.values)
+        return enc
+
+# ====== Heavy hitters (top products) ======
+class _TopK:
+    """商品別売上の top-K 集計。種類数が exact_limit 以下なら厳密（Counter と同じ結果・同順位）、
+    超えたら重み付き Misra-Gries に切り替えてメモリを capacity*2 件に制限する。
+    近似時の各商品の値は真値の下限で、真値との差は最大 max_undercount（非負の売上を前提）。"""
+    __slots__ = ("counts", "capacity", "limit", "max_undercount", "approximate")
+
+    def __init__(self, exact_limit: Optional[int] = None, capacity: Optional[int] = None):
+        self.counts: Dict[str, float] = {}
+        self.capacity = max(5, capacity or TOPK_CAPACITY)
+        self.limit = max(self.capacity, exact_limit or TOPK_EXACT_LIMIT)
+        self.max_undercount = 0.0
+        self.approximate = False
+
+    def add(self, key: str, v: float) -> None:
+        counts = self.counts
+        counts[key] = counts.get(key, 0) + v
+        if len(counts) > self.limit:
+            self.compact()
+
+    def compact(self) -> None:
+        """(capacity+1) 番目の値を全件から引き、0以下を捨てる（Misra-Gries の一括減算）"""
+        counts, k = self.counts, self.capacity
+        if len(counts) <= k:
+            return
+        t = nlargest(k + 1, counts.values())[-1]
+        if t > 0:
+            kept = {key: c - t for key, c in counts.items() if c > t}
+            self.max_undercount += t
+        else:
+            kept = {key: c for key, c in counts.items() if c > 0}
+        counts.clear()
+        counts.update(kept)
+        self.approximate = True
+        self.limit = 2 * k
+
+    def merge(self, other: "_TopK") -> None:
+        # Misra-Gries の要約は加算後に再圧縮すればマージ可能（誤差上限は足し合わせ）
+        counts = self.counts
+        for key, c in other.counts.items():
+            counts[key] = counts.get(key, 0) + c
+        self.max_undercount += other.max_undercount
+        self.approximate = self.approximate or other.approximate
+        if self.approximate:
+            self.limit = min(self.limit, 2 * self.capacity)
+        if len(counts) > self.limit:
+            self.compact()
+
+    def most_common(self, n: int) -> List[Tuple[str, float]]:
+        # Counter.most_common と同じく同額は挿入順（初出順）
+        return nlargest(n, self.counts.items(), key=lambda kv: kv[1])
+
+    def error_info(self) -> Dict[str, Any]:
+        return {
+            "approximate": True,
+            "max_undercount": float(self.max_undercount),
+            "tracked": len(self.counts),
+            "capacity": self.capacity,
+        }
 
-    ts = defaultdict(float)
-    by_product: Counter = Counter()
-    total_sales = 0.0
+    def to_state(self) -> Dict[str, Any]:
+        return {"items": list(self.counts.items()), "max_undercount": self.max_undercount, "approximate": self.approximate}
+
+    @classmethod
+    def from_state(cls, state: Any) -> "_TopK":
+        tk = cls()
+        if isinstance(state, list):  # 旧形式（items のみ）
+            state = {"items": state}
+        tk.counts.update(dict(state.get("items", [])))
+        tk.max_undercount = float(state.get("max_undercount", 0.0))
+        tk.approximate = bool(state.get("approximate", False))
+        if tk.approximate:
+            tk.limit = 2 * tk.capacity
+        return tk
+
+# ====== Distribution sketches (distinct counts / quantiles) ======
+# 固定メモリ・1パス・マージ可能なスケッチ。ディメンション列は HyperLogLog で概算ユニーク数、
+# 数値列は KLL で分位点を求める。ハッシュはプロセス間で一致させるため blake2b を使う。
+_SKETCH_QUANTILES = (("p10", 0.1), ("p25", 0.25), ("p50", 0.5), ("p75", 0.75), ("p90", 0.9))
+
+class _HyperLogLog:
+    """HyperLogLog（p=12 で 4KB、標準誤差 約1.6%）"""
+    __slots__ = ("p", "registers")
+
+    def __init__(self, p: int = 12):
+        self.p = p
+        self.registers = bytearray(1 << p)
+
+    def add(self, value: Any) -> None:
+        x = int.from_bytes(hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest(), "big")
+        p = self.p
+        idx = x >> (64 - p)
+        w = x & ((1 << (64 - p)) - 1)
+        rank = (64 - p) - w.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other: "_HyperLogLog") -> None:
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        est = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if est <= 2.5 * m and zeros:
+            est = m * math.log(m / zeros)  # 小さい基数の補正（linear counting）
+        return int(round(est))
+
+    def to_state(self) -> str:
+        return base64.b64encode(bytes(self.registers)).decode("ascii")
+
+    @classmethod
+    def from_state(cls, state: str) -> "_HyperLogLog":
+        raw = base64.b64decode(state)
+        hll = cls(int(math.log2(len(raw))))
+        hll.registers = bytearray(raw)
+        return hll
+
+class _KLLSketch:
+    """KLL 分位点スケッチ（k=200 で順位誤差 約1%、保持数は O(k)）"""
+    __slots__ = ("k", "levels", "size", "max_size", "rng")
+
+    def __init__(self, k: int = 200, seed: int = 0x5EED):
+        self.k = k
+        self.levels: List[List[float]] = [[]]
+        self.size = 0
+        self.max_size = 0
+        self.rng = random.Random(seed)
+        self._recalc()
+
+    def _capacity(self, h: int) -> int:
+        depth = len(self.levels) - h - 1
+        return int(math.ceil((2.0 / 3.0) ** depth * self.k)) + 1
+
+    def _recalc(self) -> None:
+        self.max_size = sum(self._capacity(h) for h in range(len(self.levels)))
+
+    def extend(self, values: Iterable[float], chunk: int = 1024) -> None:
+        it = iter(values)
+        while True:
+            batch = list(islice(it, chunk))
+            if not batch:
+                return
+            self.levels[0].extend(batch)
+            self.size += len(batch)
+            while self.size >= self.max_size:
+                self._compress()
+
+    def _compress(self) -> None:
+        for h in range(len(self.levels)):
+            if len(self.levels[h]) >= self._capacity(h):
+                if h + 1 >= len(self.levels):
+                    self.levels.append([])
+                    self._recalc()
+                items = sorted(self.levels[h])
+                keep = items[:1] if len(items) % 2 else []
+                items = items[len(keep):]
+                # 隣接ペアから片方をランダムに昇格（重みは2倍）
+                self.levels[h + 1].extend(items[self.rng.random() < 0.5::2])
+                self.levels[h] = keep
+                self.size = sum(map(len, self.levels))
+                if self.size < self.max_size:
+                    return
+
+    def merge(self, other: "_KLLSketch") -> None:
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+        self._recalc()
+        for h, items in enumerate(other.levels):
+            self.levels[h].extend(items)
+        self.size = sum(map(len, self.levels))
+        while self.size >= self.max_size:
+            self._compress()
+
+    def quantiles(self, qs: Iterable[float]) -> List[Optional[float]]:
+        weighted = sorted((v, 1 << h) for h, items in enumerate(self.levels) for v in items)
+        total = sum(w for _, w in weighted)
+        out: List[Optional[float]] = []
+        for q in qs:
+            if not total:
+                out.append(None)
+                continue
+            target, cum = q * total, 0
+            val = weighted[-1][0]
+            for v, w in weighted:
+                cum += w
+                if cum >= target:
+                    val = v
+                    break
+            out.append(float(val))
+        return out
+
+    def to_state(self) -> Dict[str, Any]:
+        return {"k": self.k, "levels": self.levels}
+
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> "_KLLSketch":
+        kll = cls(int(state.get("k", 200)))
+        kll.levels = [list(map(float, lv)) for lv in state.get("levels") or [[]]]
+        kll.size = sum(map(len, kll.levels))
+        kll._recalc()
+        return kll
+
+class _ColumnSketches:
+    """列ごとのスケッチ群。列の役割（ディメンション/数値）は最初のデータで1回だけ決める"""
+
+    def __init__(self):
+        self.dims: Dict[str, _HyperLogLog] = {}
+        self.nums: Dict[str, Dict[str, Any]] = {}
+        self.ready = False
+
+    def _assign(self, numeric_cols: List[str], dim_cols: List[str]) -> None:
+        budget = SKETCH_MAX_COLUMNS
+        for c in numeric_cols[:budget]:
+            self.nums[c] = {"kll": _KLLSketch(), "count": 0, "min": None, "max": None}
+        for c in dim_cols[:max(0, budget - len(self.nums))]:
+            self.dims[c] = _HyperLogLog()
+        self.ready = True
+
+    def _add_numbers(self, col: str, values: List[float]) -> None:
+        if not values:
+            return
+        st = self.nums[col]
+        st["kll"].extend(values)
+        st["count"] += len(values)
+        lo, hi = min(values), max(values)
+        st["min"] = lo if st["min"] is None else min(st["min"], lo)
+        st["max"] = hi if st["max"] is None else max(st["max"], hi)
+
+    def add_row(self, row: Dict[str, Any]) -> None:
+        if not self.ready:
+            nums = [c for c, v in row.items() if _parse_number(v) is not None]
+            self._assign(nums, [c for c in row if c not in nums])
+        for c, hll in self.dims.items():
+            hll.add(str(row.get(c, "")).strip())
+        for c in self.nums:
+            v = _parse_number(row.get(c, ""))
+            if v is not None:
+                self._add_numbers(c, [v])
+
+    def add_table(self, table: "_ColumnarTable") -> None:
+        if not self.ready:
+            nums, dims = [], []
+            for c in table.columns:
+                col = table.column(c)
+                is_num = type(col) is _IntColumn or _infer_number_kind(col.values) != "text"
+                (nums if is_num else dims).append(c)
+            self._assign(nums, dims)
+        for c, hll in self.dims.items():
+            if c in table.columns:
+                # ユニーク値だけをハッシュすればよい（辞書エンコードの恩恵）
+                for u in dict.fromkeys(str(v).strip() for v in table.encoded(c)[1]):
+                    hll.add(u)
+        for c in self.nums:
+            if c not in table.columns:
+                continue
+            col = table.column(c)
+            if type(col) is _IntColumn:
+                self._add_numbers(c, list(map(float, col.data)))
+            else:
+                lut = [_parse_number(v) for v in col.values]
+                self._add_numbers(c, [x for x in map(lut.__getitem__, col.codes) if x is not None])
+
+    def merge(self, other: "_ColumnSketches") -> None:
+        if not self.ready:
+            self.dims, self.nums, self.ready = other.dims, other.nums, other.ready
+            return
+        for c, hll in other.dims.items():
+            if c in self.dims:
+                self.dims[c].merge(hll)
+        for c, st in other.nums.items():
+            if c in self.nums and st["count"]:
+                mine = self.nums[c]
+                mine["kll"].merge(st["kll"])
+                mine["count"] += st["count"]
+                mine["min"] = st["min"] if mine["min"] is None else min(mine["min"], st["min"])
+                mine["max"] = st["max"] if mine["max"] is None else max(mine["max"], st["max"])
+
+    def finalize(self) -> Dict[str, Any]:
+        quantiles = {}
+        for c, st in self.nums.items():
+            if not st["count"]:
+                continue
+            q = dict(zip((name for name, _ in _SKETCH_QUANTILES), st["kll"].quantiles(q for _, q in _SKETCH_QUANTILES)))
+            quantiles[c] = {"count": st["count"], "min": st["min"], **q, "max": st["max"]}
+        return {
+            "approximate": True,
+            "distinct_counts": {c: hll.estimate() for c, hll in self.dims.items()},
+            "quantiles": quantiles,
+        }
 
-    for r in rows:
-        v = _to_number(r.get(scol, 0)) if scol else 0.0
-        total_sales += v
+    def to_state(self) -> Dict[str, Any]:
+        return {
+            "dims": {c: h.to_state() for c, h in self.dims.items()},
+            "nums": {c: {**st, "kll": st["kll"].to_state()} for c, st in self.nums.items()},
+            "ready": self.ready,
+        }
+
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> "_ColumnSketches":
+        sk = cls()
+        sk.dims = {c: _HyperLogLog.from_state(h) for c, h in (state.get("dims") or {}).items()}
+        sk.nums = {c: {**st, "kll": _KLLSketch.from_state(st["kll"])} for c, st in (state.get("nums") or {}).items()}
+        sk.ready = bool(state.get("ready"))
+        return sk
+
+# ====== Stats accumulator ======
+class _StatsAccumulator:
+    """マージ可能な集計状態（map-reduce用）
+    add(row) で1行ずつ、add_table(table) で列指向テーブルごと加算し、merge(other) で部分集計を
+    結合、finalize() で _compute_stats と同じ形の dict を返す。チャンク・ワーカー・過去の
+    アップロードの部分結果を生データを再走査せずに結合できる（to_state/from_state でJSON化可能）。"""
+
+    def __init__(self, colmap: Optional[Dict[str, str]] = None, sketches: bool = False, bucket: Optional[str] = None):
+        self.colmap = colmap
+        self.bucket = bucket or TS_BUCKET  # 時系列の粒度（day/week/month/fiscal）
+        self.total = 0
+        self.total_sales = 0.0
+        self.by_product = _TopK()
+        self.ts: Dict[str, float] = defaultdict(float)
+        self.sketches: Optional[_ColumnSketches] = _ColumnSketches() if sketches else None
+
+    def add(self, row: Dict[str, Any]) -> None:
+        if self.colmap is None:
+            self.colmap = _detect_columns([row])
+        colmap = self.colmap
+        dcol, scol, pcol = colmap.get("date"), colmap.get("sales"), colmap.get("product")
+        self.total += 1
+        v = _to_number(row.get(scol, 0)) if scol else 0.0
+        self.total_sales += v
         if pcol:
-            by_product[str(r.get(pcol, "")).strip()] += v
+            self.by_product.add(str(row.get(pcol, "")).strip(), v)
         if dcol:
-            dt = str(r.get(dcol, "")).strip().replace("/", "-")
-            day = dt[:10] if len(dt) >= 10 else dt
+            day = _day_key(row.get(dcol, ""), self.bucket)
             if day:
-                ts[day] += v
+                self.ts[day] += v
+        if self.sketches is not None:
+            self.sketches.add_row(row)
+
+    def add_rows(self, rows: Iterable[Dict[str, Any]]) -> "_StatsAccumulator":
+        # add() のループを展開した高速版（列判定は最初の1行で1回だけ）
+        it = iter(rows)
+        if self.colmap is None:
+            first = next(it, None)
+            if first is None:
+                return self
+            self.add(first)
+        if self.sketches is not None:
+            # スケッチ有効時は行ごとに全列を見るため add() を使う
+            for r in it:
+                self.add(r)
+            return self
+        dcol, scol, pcol = self.colmap.get("date"), self.colmap.get("sales"), self.colmap.get("product")
+        ts, by_product, bucket = self.ts, self.by_product, self.bucket
+        counts = by_product.counts
+        total, total_sales = self.total, self.total_sales
+        for r in it:
+            total += 1
+            v = _to_number(r.get(scol, 0)) if scol else 0.0
+            total_sales += v
+            if pcol:
+                key = str(r.get(pcol, "")).strip()
+                counts[key] = counts.get(key, 0) + v
+                if len(counts) > by_product.limit:
+                    by_product.compact()
+            if dcol:
+                day = _day_key(r.get(dcol, ""), bucket)
+                if day:
+                    ts[day] += v
+        self.total, self.total_sales = total, total_sales
+        return self
+
+    def add_table(self, table: "_ColumnarTable") -> "_StatsAccumulator":
+        """列指向テーブルを列単位で加算する: 売上・商品・日付の3列だけをデコード"""
+        n = len(table)
+        if n == 0:
+            return self
+        if self.colmap is None:
+            self.colmap = _detect_columns_from_headers(table.columns)
+        dcol, scol, pcol = self.colmap.get("date"), self.colmap.get("sales"), self.colmap.get("product")
+
+        if _use_numpy():
+            vals = _numeric_np(table, scol) if scol else np.zeros(n)
+            # cumsum/bincount は先頭から順に加算するため、純Python版と浮動小数点の結果まで一致する
+            self.total_sales = float(np.cumsum(np.concatenate(([self.total_sales], vals)))[-1])
+            group_sum = _group_sum_np
+        else:
+            vals = table.numeric(scol) if scol else array("d", bytes(8 * n))
+            self.total_sales = reduce(add, vals, self.total_sales)
+            group_sum = _group_sum
+        self.total += n
 
-    top_products = [{"name": k, "sales": float(v)} for k, v in by_product.most_common(5)]
-    trend = [{"date": d, "sales": float(v)} for d, v in sorted(ts.items())]
-    avg = float(total_sales / total) if total else 0.0
+        if pcol:
+            codes, uniq = table.encoded(pcol)
+            for u, v in zip(uniq, group_sum(codes, vals, len(uniq))):
+                self.by_product.add(str(u).strip(), v)
+        if dcol:
+            codes, uniq = table.encoded(dcol)
+            for u, v in zip(uniq, group_sum(codes, vals, len(uniq))):
+                day = _day_key(u, self.bucket)
+                if day:
+                    self.ts[day] += v
+        if self.sketches is not None:
+            self.sketches.add_table(table)
+        return self
+
+    def merge(self, other: "_StatsAccumulator") -> "_StatsAccumulator":
+        """別の部分集計を加算する（加算順が変わるため小数の売上は丸め誤差の範囲で異なり得る）"""
+        if self.colmap is None:
+            self.colmap = other.colmap
+        self.total += other.total
+        self.total_sales += other.total_sales
+        self.by_product.merge(other.by_product)
+        for d, v in other.ts.items():
+            self.ts[d] += v
+        if other.sketches is not None:
+            if self.sketches is None:
+                self.sketches = _ColumnSketches()
+            self.sketches.merge(other.sketches)
+        return self
+
+    def finalize(self) -> Dict[str, Any]:
+        total, total_sales = self.total, self.total_sales
+        if total == 0:
+            return {"total_rows": 0, "total_sales": 0.0, "avg_row_sales": 0.0, "top_products": [], "timeseries": []}
+        top_products = [{"name": k, "sales": float(v)} for k, v in self.by_product.most_common(5)]
+        trend = [{"date": d, "sales": float(v)} for d, v in sorted(self.ts.items())]
+        avg = float(total_sales / total) if total else 0.0
+
+        stats = {
+            "total_rows": total,
+            "total_sales": float(total_sales),
+            "avg_row_sales": avg,
+            "top_products": top_products,
+            "timeseries": trend
+        }
+        if self.by_product.approximate:
+            # 高カーディナリティ時のみ: top_products の値は下限、誤差上限を併記
+            stats["top_products_error"] = self.by_product.error_info()
+        if self.sketches is not None:
+            stats["distribution"] = self.sketches.finalize()
+        return stats
+
+    def to_state(self) -> Dict[str, Any]:
+        """永続化・プロセス間受け渡し用のJSON互換表現"""
+        return {
+            "colmap": self.colmap,
+            "bucket": self.bucket,
+            "total": self.total,
+            "total_sales": self.total_sales,
+            "by_product": self.by_product.to_state(),
+            "ts": dict(self.ts),
+            "sketches": self.sketches.to_state() if self.sketches is not None else None,
+        }
 
-    return {
-        "total_rows": total,
-        "total_sales": float(total_sales),
-        "avg_row_sales": avg,
-        "top_products": top_products,
-        "timeseries": trend
-    }
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> "_StatsAccumulator":
+        acc = cls(state.get("colmap"), bucket=state.get("bucket"))
+        acc.total = int(state.get("total", 0))
+        acc.total_sales = float(state.get("total_sales", 0.0))
+        acc.by_product = _TopK.from_state(state.get("by_product") or {})
+        for d, v in (state.get("ts") or {}).items():
+            acc.ts[d] += float(v)
+        if state.get("sketches"):
+            acc.sketches = _ColumnSketches.from_state(state["sketches"])
+        return acc
+
+def _compute_stats(rows: Iterable[Dict[str, Any]], sketches: Optional[bool] = None,
+                   bucket: Optional[str] = None) -> Dict[str, Any]:
+    """行イテレータ（リスト・ジェネレータ）または列指向テーブルを1パスで集計
+    sketches=True で distribution（列別の概算ユニーク数・分位点）も同じパスで出力する
+    bucket で timeseries の粒度（day/week/month/fiscal、既定は TS_BUCKET）を指定する"""
+    acc = _StatsAccumulator(sketches=STATS_SKETCHES if sketches is None else sketches, bucket=bucket)
+    if isinstance(rows, _ColumnarTable):
+        return acc.add_table(rows).finalize()
+    return acc.add_rows(rows).finalize()
+
+def _group_sum(codes: array, values: array, n_groups: int) -> List[float]:
+    sums = [0.0] * n_groups
+    for c, v in zip(codes, values):
+        sums[c] += v
+    return sums
+
+def _use_numpy() -> bool:
+    return NUMPY_AVAILABLE and STATS_BACKEND != "python"
+
+# ====== NumPy stats backend ======
+def _np_view(arr: array) -> Any:
+    kind = "i" if arr.typecode == "q" else "u"
+    return np.frombuffer(arr, dtype=f"{kind}{arr.itemsize}")
+
+def _numeric_np(table: _ColumnarTable, col: str) -> Any:
+    """_to_number 相当の数値化をユニーク値の変換表＋ファンシーインデックスで行う"""
+    c = table.column(col)
+    if type(c) is _IntColumn:
+        return _np_view(c.data).astype(np.float64)
+    lut = np.array(_column_to_numbers(c.values), dtype=np.float64)
+    return lut[_np_view(c.codes)]
+
+def _group_sum_np(codes: array, values: Any, n_groups: int) -> List[float]:
+    return np.bincount(_np_view(codes), weights=values, minlength=n_groups).tolist()
+
+# ====== Representative sampling ======
+# 先頭N行（日付順のSAP出力では最初の1〜2日分）ではなく、日付・商品・地域の各層を代表する行を選ぶ。
+# 層ごとの代表行は辞書エンコードのコード配列から1パス（dict構築がCレベルで走る）で求め、
+# 日付は期間全体に均等、商品・地域は売上の大きい順に層を巡回して選ぶ。残り枠は一様ランダムで埋める。
+# 乱数は固定シードなので同じデータからは同じサンプル（＝同じプロンプトでLLMキャッシュが効く）になる。
+# サンプルは優先順（どの先頭部分を取っても層が偏らない順）で返す。予算超過時の縮約（sample_20 など）は先頭を使う。
+def _spread_order(items: List[Any]) -> List[Any]:
+    """粗い順に並べ替える（両端→中央→四分位→…）。先頭 m 個が全体に散らばる"""
+    n = len(items)
+    if n <= 2:
+        return list(items)
+    order, queue = [0, n - 1], deque([(0, n - 1)])
+    while queue:
+        lo, hi = queue.popleft()
+        if hi - lo < 2:
+            continue
+        mid = (lo + hi) // 2
+        order.append(mid)
+        queue.append((lo, mid))
+        queue.append((mid, hi))
+    return [items[i] for i in order]
+
+def _first_index_by_code(codes: array, start: int) -> Dict[int, int]:
+    """各コードについて、行 start から循環的に見て最初に現れる行番号"""
+    n = len(codes)
+    rotated = codes[start:] + codes[:start]
+    # dict は後勝ちなので逆順に流すと最初の出現が残る
+    backwards = chain(range(start - 1, -1, -1), range(n - 1, start - 1, -1))
+    return dict(zip(reversed(rotated), backwards))
+
+def _stratified_sample_indices(table: _ColumnarTable, colmap: Dict[str, str], k: int, seed: int = 0) -> List[int]:
+    n = len(table)
+    if n <= k:
+        return list(range(n))
+    rng = random.Random(seed)
+    start = rng.randrange(n)
+    lanes: List[List[int]] = []
+    used_cols = set()
+
+    dcol = colmap.get("date")
+    if dcol in table.columns:
+        codes, uniq = table.encoded(dcol)
+        first = _first_index_by_code(codes, start)
+        for bucket in ("day", "week", "month"):
+            reps: Dict[str, int] = {}
+            for code, i in first.items():
+                reps.setdefault(_day_key(uniq[code], bucket), i)
+            if len(reps) <= k:
+                break
+        ordered = [reps[d] for d in sorted(reps)]
+        if len(ordered) > k:
+            ordered = [ordered[j * len(ordered) // k] for j in range(k)]
+        lanes.append(_spread_order(ordered))
+        used_cols.add(dcol)
+
+    scol = colmap.get("sales")
+    weights_src = table.numeric(scol) if scol in table.columns else array("d", [1.0]) * n
+    for role in ("product", "region"):
+        col = colmap.get(role)
+        if col not in table.columns or col in used_cols:
+            continue
+        codes, uniq = table.encoded(col)
+        first = _first_index_by_code(codes, start)
+        weights = _group_sum(codes, weights_src, len(uniq))
+        lanes.append([first[c] for c in sorted(first, key=lambda c: -weights[c])[:k]])
+        used_cols.add(col)
+
+    # 層の代表で最大3/4を埋め、残りは一様ランダム（典型的な行も見せる）
+    chosen: Dict[int, None] = {}
+    quota = k - k // 4
+    for picks in zip_longest(*lanes):
+        for i in picks:
+            if i is not None and len(chosen) < quota:
+                chosen.setdefault(i)
+        if len(chosen) >= quota:
+            break
+    for i in rng.sample(range(n), min(n, 2 * k)):
+        if len(chosen) >= k:
+            break
+        chosen.setdefault(i)
+    return list(chosen)
+
+def _representative_sample(table: _ColumnarTable, k: int = 0) -> List[Dict[str, Any]]:
+    """プロンプト用サンプル行（SAMPLE_MODE=head なら従来どおり先頭 k 行）"""
+    k = k or SAMPLE_ROWS
+    if SAMPLE_MODE == "head" or len(table) <= k:
+        return table.rows(0, k)
+    colmap = _detect_columns_from_headers(table.columns)
+    return table.take(_stratified_sample_indices(table, colmap, k))
+
+# ====== Parallel CSV aggregation ======
+# 大きなcsvは /tmp に書き出して mmap し、行境界（引用符の外の改行）でパーティション分割して
+# ワーカープロセスごとに列指向テーブル化＋集計し、_StatsAccumulator の部分結果をマージする。
+# Lambda には /dev/shm が無く multiprocessing.Pool / Queue が使えないため Process + Pipe で実装。
+_QUOTE_SCAN_BYTES = 8 * 1024 * 1024
+
+def _should_parallelize(csv_text: str) -> bool:
+    return PARALLEL_WORKERS > 1 and len(csv_text) >= PARALLEL_MIN_BYTES
+
+def _spool_csv_to_tmp(csv_text: str) -> str:
+    """csvテキストをUTF-8で /tmp に書き出す（約1MBずつエンコードし全体のbytesコピーを作らない）"""
+    fd, path = tempfile.mkstemp(prefix="upload-", suffix=".csv")
+    with os.fdopen(fd, "wb") as f:
+        for block in _iter_text_blocks(csv_text):
+            f.write(block.encode("utf-8"))
+    return path
+
+def _count_quotes(mm: mmap.mmap, start: int, end: int) -> int:
+    n = 0
+    for pos in range(start, end, _QUOTE_SCAN_BYTES):
+        n += mm[pos:min(end, pos + _QUOTE_SCAN_BYTES)].count(b'"')
+    return n
+
+def _next_record_end(mm: mmap.mmap, pos: int, parity: int) -> Tuple[int, int]:
+    """pos以降で引用符の外にある最初の改行の直後を返す（(位置, 位置までの引用符パリティ)）"""
+    while True:
+        nl = mm.find(b"\n", pos)
+        if nl == -1:
+            return len(mm), parity
+        parity ^= _count_quotes(mm, pos, nl) & 1
+        if parity == 0:
+            return nl + 1, 0
+        pos = nl + 1
+
+def _csv_header(mm: mmap.mmap) -> Tuple[List[str], int]:
+    """先頭の空でないレコードをヘッダーとして読み、(ヘッダー, データ開始位置) を返す"""
+    pos = 0
+    while pos < len(mm):
+        end, _ = _next_record_end(mm, pos, 0)
+        cells = next(_iter_csv_cells(mm[pos:end].decode("utf-8", errors="ignore")), None)
+        if cells:
+            return cells, end
+        pos = end
+    return [], len(mm)
+
+def _csv_partitions(mm: mmap.mmap, data_start: int, n: int) -> List[Tuple[int, int]]:
+    """データ部分をおおよそ等分し、各境界を次のレコード境界まで進める"""
+    size = len(mm)
+    bounds = [data_start]
+    counted, parity = data_start, 0
+    for k in range(1, n):
+        target = data_start + (size - data_start) * k // n
+        if target <= bounds[-1]:
+            continue
+        parity ^= _count_quotes(mm, counted, target) & 1
+        end, parity = _next_record_end(mm, target, parity)
+        counted = end
+        if end >= size:
+            break
+        bounds.append(end)
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if b > a]
+
+# 並列集計時のサンプル候補: ファイル全体の等間隔の位置（レコード境界）から数行ずつ読む
+_STRIDE_BLOCK_ROWS  = 8
+_STRIDE_BLOCK_BYTES = 64 * 1024
+
+def _csv_stride_rows(mm: mmap.mmap, data_start: int, headers: List[str], blocks: int) -> List[Dict[str, Any]]:
+    """先頭だけに偏らないサンプル候補（blocks 箇所 × 最大 _STRIDE_BLOCK_ROWS 行）"""
+    rows: List[Dict[str, Any]] = []
+    for start, end in _csv_partitions(mm, data_start, max(1, blocks)):
+        stop = min(end, start + _STRIDE_BLOCK_BYTES)
+        cells_list = list(islice(_iter_csv_cells(mm[start:stop].decode("utf-8", errors="ignore")),
+                                 _STRIDE_BLOCK_ROWS + 1))
+        if stop < end:
+            cells_list = cells_list[:-1]  # 読み取り窓の端で切れた行は使わない
+        for cells in cells_list[:_STRIDE_BLOCK_ROWS]:
+            ncell = len(cells)
+            rows.append({h: (cells[i].strip() if i < ncell else "") for i, h in enumerate(headers)})
+    return rows
 
-def _build_prompt_json(stats: Dict[str, Any], sample: List[Dict[str, Any]], data_type: str = "sales_data") -> str:
-    schema_hint = {
-        "type": "object",
-        "properties": {
-            "overview": {"type": "string"},
-            "findings": {"type": "array", "items": {"type": "string"}},
-            "kpis": {
-                "type": "object",
-                "properties": {
-                    "total_sales": {"type": "number"},
-                    "top_products": {
-                        "type": "array",
-                        "items": {"type": "object", "properties": {"name": {"type": "string"}, "sales": {"type": "number"}}}
-                    }
+def _aggregate_csv_partition(path: str, start: int, end: int, headers: List[str], sketches: bool = False,
+                            bucket: Optional[str] = None) -> Dict[str, Any]:
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        text = mm[start:end].decode("utf-8", errors="ignore")
+    table = _ColumnarTable.from_csv(text, headers=headers)
+    del text
+    acc = _StatsAccumulator(_detect_columns_from_headers(headers), sketches=sketches, bucket=bucket)
+    return acc.add_table(table).to_state()
+
+def _partition_worker(conn: Any, path: str, start: int, end: int, headers: List[str], sketches: bool,
+                      bucket: Optional[str]) -> None:
+    try:
+        conn.send(_aggregate_csv_partition(path, start, end, headers, sketches, bucket))
+    except Exception as e:
+        conn.send({"error": f"{type(e).__name__}: {e}"})
+    finally:
+        conn.close()
+
+def _parallel_csv_stats_file(path: str, workers: int, sketches: bool = False,
+                             bucket: Optional[str] = None, timeout: Optional[float] = None,
+                             sample: Optional[List[Dict[str, Any]]] = None) -> _StatsAccumulator:
+    """spool済みcsvファイルを workers 個のプロセスで集計してマージした結果を返す
+    timeout（秒）までに全パーティションが揃わなければ TimeoutError
+    sample にリストを渡すと、ワーカーの集計中にファイル全体からサンプル候補（_csv_stride_rows）を追加する"""
+    if os.path.getsize(path) == 0:
+        return _StatsAccumulator(bucket=bucket)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        headers, data_start = _csv_header(mm)
+        parts = _csv_partitions(mm, data_start, max(1, workers))
+    if not headers:
+        return _StatsAccumulator(bucket=bucket)
+    acc = _StatsAccumulator(_detect_columns_from_headers(headers), bucket=bucket)
+
+    def collect_sample() -> None:
+        if sample is not None:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                sample.extend(_csv_stride_rows(mm, data_start, headers, 4 * SAMPLE_ROWS))
+
+    if len(parts) <= 1:
+        for start, end in parts:
+            acc.merge(_StatsAccumulator.from_state(_aggregate_csv_partition(path, start, end, headers, sketches, bucket)))
+        collect_sample()
+        return acc
+
+    procs = []
+    finished = False
+    try:
+        for start, end in parts:
+            recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+            p = multiprocessing.Process(target=_partition_worker, args=(send_conn, path, start, end, headers, sketches, bucket))
+            p.start()
+            send_conn.close()
+            procs.append((p, recv_conn))
+        collect_sample()  # ワーカーの集計と並行して親プロセスで読む
+        # パーティション順にマージ（商品の初出順＝同額時の並びを単一パスと揃える）
+        expires = time.monotonic() + timeout if timeout is not None else None
+        for p, conn in procs:
+            if expires is not None and not conn.poll(max(0.0, expires - time.monotonic())):
+                raise TimeoutError(f"parallel stats did not finish within {timeout:.1f}s")
+            state = conn.recv()
+            if "error" in state:
+                raise RuntimeError(f"partition worker failed: {state['error']}")
+            acc.merge(_StatsAccumulator.from_state(state))
+        finished = True
+    finally:
+        for p, conn in procs:
+            conn.close()
+            if not finished and p.is_alive():
+                p.terminate()  # 期限切れ・失敗時は待たずに止める（1つずつ join すると期限を大きく超える）
+        for p, _ in procs:
+            p.join(timeout=1)
+            if p.is_alive():
+                p.terminate()
+    return acc
+
+def _parallel_csv_stats(csv_text: str, workers: Optional[int] = None, sketches: bool = False,
+                        bucket: Optional[str] = None, timeout: Optional[float] = None,
+                        sample: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    path = _spool_csv_to_tmp(csv_text)
+    try:
+        return _parallel_csv_stats_file(path, workers or PARALLEL_WORKERS, sketches, bucket, timeout, sample).finalize()
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+# ====== Prompt / parsing helpers ======
+# ====== Prompt data encoding ======
+# サンプル行・時系列をプロンプトに埋め込む形式。json は従来どおり（行ごとに列名を繰り返す）。
+# csv はヘッダー1行＋カンマ区切り行、columnar は列名リストと値辞書を共有する列指向JSON。
+PROMPT_DATA_FORMATS = ("json", "csv", "columnar")
+
+def _plain_cell(v: Any) -> Any:
+    """埋め込み用に値を簡約（整数値のfloatは整数、None は空）"""
+    if v is None:
+        return ""
+    if type(v) is float and v.is_integer():
+        return int(v)
+    return v
+
+def _csv_lines(header: List[str], rows: Iterable[Iterable[Any]]) -> str:
+    buf = io.StringIO()
+    w = csv.writer(buf, lineterminator="\n")
+    w.writerow(header)
+    w.writerows([_plain_cell(v) for v in row] for row in rows)
+    return buf.getvalue().rstrip("\n")
+
+def _encode_rows(rows: List[Dict[str, Any]], encoding: str = "json") -> str:
+    if encoding == "json" or not rows:
+        return json.dumps(rows, ensure_ascii=False)
+    columns = list(dict.fromkeys(k for r in rows for k in r))
+    if encoding == "csv":
+        return _csv_lines(columns, ([r.get(c, "") for c in columns] for r in rows))
+    # columnar: 値の種類が行数の半分以下の列は値辞書を共有し、行側はその番号を持つ
+    values: Dict[str, List[Any]] = {}
+    index: Dict[str, Dict[Any, int]] = {}
+    for c in columns:
+        uniq = list(dict.fromkeys(_hashable(_plain_cell(r.get(c, ""))) for r in rows))
+        if len(uniq) <= len(rows) // 2:
+            values[c] = uniq
+            index[c] = {v: i for i, v in enumerate(uniq)}
+    body = [[index[c][_hashable(_plain_cell(r.get(c, "")))] if c in index else _plain_cell(r.get(c, "")) for c in columns]
+            for r in rows]
+    return json.dumps({"columns": columns, "values": values, "rows": body}, ensure_ascii=False, separators=(",", ":"))
+
+def _encode_stats(stats: Dict[str, Any], encoding: str = "json") -> str:
+    ts = stats.get("timeseries")
+    if encoding == "json" or not ts:
+        return json.dumps(stats, ensure_ascii=False)
+    rest = json.dumps({k: v for k, v in stats.items() if k != "timeseries"}, ensure_ascii=False)
+    if encoding == "csv":
+        return rest + "\n時系列（date,sales）:\n" + _csv_lines(["date", "sales"], ((t.get("date"), t.get("sales")) for t in ts))
+    cols = {"date": [t.get("date") for t in ts], "sales": [_plain_cell(t.get("sales")) for t in ts]}
+    return rest + "\n時系列（列指向）: " + json.dumps(cols, ensure_ascii=False, separators=(",", ":"))
+
+# 指示文・スキーマなどの固定部分は読み込み時に組み立てておき、リクエストごとには統計とサンプルだけを埋める。
+# データタイプ別の JSON 用前半は分析指示の表の後（_JSON_PROMPT_HEADS）で生成する。
+_PROMPT_SCHEMA_HINT = {
+    "type": "object",
+    "properties": {
+        "overview": {"type": "string"},
+        "findings": {"type": "array", "items": {"type": "string"}},
+        "kpis": {
+            "type": "object",
+            "properties": {
+                "total_sales": {"type": "number"},
+                "top_products": {
+                    "type": "array",
+                    "items": {"type": "object", "properties": {"name": {"type": "string"}, "sales": {"type": "number"}}}
                 }
-            },
-            "trend": {"type": "array", "items": {"type": "object", "properties": {"date": {"type": "string"}, "sales": {"type": "number"}}}}
+            }
         },
-        "required": ["overview", "findings", "kpis"]
-    }
-    
-    # データタイプ別の戦略コンサルタント級分析指示
-    analysis_instructions = _get_analysis_instructions(data_type)
-    data_type_name = _get_data_type_name(data_type)
-    
+        "trend": {"type": "array", "items": {"type": "object", "properties": {"date": {"type": "string"}, "sales": {"type": "number"}}}}
+    },
+    "required": ["overview", "findings", "kpis"]
+}
+_PROMPT_SCHEMA_HINT_JSON = json.dumps(_PROMPT_SCHEMA_HINT, ensure_ascii=False)
+
+def _json_prompt_head(data_type_name: str, analysis_instructions: str) -> str:
+    """JSON 用プロンプトのうちデータより前の部分（データタイプごとに固定）"""
     return f"""【マッキンゼー級戦略コンサルティング実行指令】
 
 クライアント: 日本企業の経営陣
@@ -188,16 +1434,14 @@ def _build_prompt_json(stats: Dict[str, Any], sample: List[Dict[str, Any]], data
 • 日本企業の組織文化・商慣習を考慮した実現可能な提案
 • プロフェッショナルな文体（但し理解しやすい日本語）
 
-※JSON形式で出力: {json.dumps(schema_hint, ensure_ascii=False)}
+※JSON形式で出力: {_PROMPT_SCHEMA_HINT_JSON}
 
 【ANALYSIS TARGET DATA】
-統計サマリー: {json.dumps(stats, ensure_ascii=False)}
-サンプルデータ: {json.dumps(sample, ensure_ascii=False)}
+"""
 
-この分析は¥数百万円の戦略コンサルティング契約に匹敵する価値を提供してください。"""
+_JSON_PROMPT_TAIL = "\n\nこの分析は¥数百万円の戦略コンサルティング契約に匹敵する価値を提供してください。"
 
-def _build_prompt_markdown(stats: Dict[str, Any], sample: List[Dict[str, Any]], data_type: str = "sales_data") -> str:
-    return f"""あなたは会社の売上データを分析するビジネスアドバイザーです。以下の売上データを見て、社長や部長が読むレポートを、完全に日本語と数字だけで作成してください。
+_MARKDOWN_PROMPT_HEAD = """あなたは会社の売上データを分析するビジネスアドバイザーです。以下の売上データを見て、社長や部長が読むレポートを、完全に日本語と数字だけで作成してください。
 
 【重要】
 - Markdownや記号は一切使わず、普通の日本語文章で書いてください
@@ -207,14 +1451,9 @@ def _build_prompt_markdown(stats: Dict[str, Any], sample: List[Dict[str, Any]],
 - 数字は「○○万円」「○○%増加」など、日本人が話すときの表現で書いてください
 
 # 統計要約
-{json.dumps(stats, ensure_ascii=False)}
-
-# サンプル（最大50）
-{json.dumps(sample, ensure_ascii=False)}
 """
 
-def _build_prompt_text(stats: Dict[str, Any], sample: List[Dict[str, Any]], data_type: str = "sales_data") -> str:
-    return f"""あなたは会社の売上データを分析するビジネスアドバイザーです。以下の売上データを見て、上司に口頭で報告するように、完全に日本語だけで3行以内にまとめてください。
+_TEXT_PROMPT_HEAD = """あなたは会社の売上データを分析するビジネスアドバイザーです。以下の売上データを見て、上司に口頭で報告するように、完全に日本語だけで3行以内にまとめてください。
 
 【絶対守ること】
 - 記号、英語、カタカナ専門用語は一切使わないでください
@@ -223,33 +1462,739 @@ def _build_prompt_text(stats: Dict[str, Any], sample: List[Dict[str, Any]], data
 - 「です・ます」調で、丁寧に書いてください
 
 [統計要約]
-{json.dumps(stats, ensure_ascii=False)}
-
-[サンプル（最大50）]
-{json.dumps(sample, ensure_ascii=False)}
 """
 
+def _build_prompt_json(stats: Dict[str, Any], sample: List[Dict[str, Any]], data_type: str = "sales_data",
+                       encoding: str = "json", formats: Tuple[str, ...] = ()) -> str:
+    # データタイプ別の戦略コンサルタント級分析指示（未知のタイプは財務データ扱い）
+    head = _JSON_PROMPT_HEADS.get(data_type) or _JSON_PROMPT_HEADS["financial_data"]
+    if len(formats) > 1:
+        head = _multi_format_head(head, formats)
+    return (f"{head}統計サマリー: {_encode_stats(stats, encoding)}\n"
+            f"サンプルデータ: {_encode_rows(sample, encoding)}{_JSON_PROMPT_TAIL}")
+
+def _build_prompt_markdown(stats: Dict[str, Any], sample: List[Dict[str, Any]], data_type: str = "sales_data",
+                       encoding: str = "json") -> str:
+    return (f"{_MARKDOWN_PROMPT_HEAD}{_encode_stats(stats, encoding)}\n\n"
+            f"# サンプル（最大50）\n{_encode_rows(sample, encoding)}\n")
+
+def _build_prompt_text(stats: Dict[str, Any], sample: List[Dict[str, Any]], data_type: str = "sales_data",
+                       encoding: str = "json") -> str:
+    return (f"{_TEXT_PROMPT_HEAD}{_encode_stats(stats, encoding)}\n\n"
+            f"[サンプル（最大50）]\n{_encode_rows(sample, encoding)}\n")
+
+# ====== Deadline ======
+# Lambda の残り時間（context.get_remaining_time_in_millis()）を起点に、解析・集計・プロンプト・LLM の各段階へ
+# 期限を渡す。LLM の出力上限と読み取りタイムアウトは残り時間から決め、足りなければ集計結果だけを返す。
+class _Deadline:
+    """context が無い（ローカル実行・テスト）場合は期限なしとして振る舞う"""
+
+    def __init__(self, context: Any = None):
+        self.started = self._last = time.monotonic()
+        get_remaining = getattr(context, "get_remaining_time_in_millis", None)
+        self.expires = self.started + get_remaining() / 1000 if callable(get_remaining) else None
+        self.stages: Dict[str, int] = {}
+
+    def remaining_ms(self) -> float:
+        if self.expires is None:
+            return math.inf
+        return max(0.0, (self.expires - time.monotonic()) * 1000)
+
+    def budget_ms(self) -> float:
+        """応答の組み立て分（DEADLINE_RESERVE_MS）を除いて使える残り時間"""
+        return max(0.0, self.remaining_ms() - DEADLINE_RESERVE_MS)
+
+    def timeout_s(self) -> Optional[float]:
+        return None if self.expires is None else self.budget_ms() / 1000
+
+    def output_tokens(self, max_tokens: int) -> int:
+        """残り時間で生成しきれる出力トークン数（LLM_TOKENS_PER_SEC 換算）で max_tokens を抑える"""
+        if self.expires is None or LLM_TOKENS_PER_SEC <= 0:
+            return max_tokens
+        return min(max_tokens, int(self.budget_ms() / 1000 * LLM_TOKENS_PER_SEC))
+
+    def checkpoint(self, stage: str) -> None:
+        now = time.monotonic()
+        self.stages[stage] = int((now - self._last) * 1000)
+        self._last = now
+
+    def info(self) -> Dict[str, Any]:
+        remaining = self.remaining_ms()
+        return {"stages_ms": dict(self.stages), "remaining_ms": None if remaining == math.inf else int(remaining)}
+
+# ====== Structured output ======
+# JSON形式は tool use（toolConfig の inputSchema に _PROMPT_SCHEMA_HINT）で受け取り、読み込み時にコンパイルした
+# 検証関数でチェックする。不適合なら分析をやり直さず、修正だけを依頼する短いターンを送る。
+_ANALYSIS_TOOL = {
+    "toolSpec": {
+        "name": "submit_analysis",
+        "description": "分析結果（overview / findings / kpis / trend）を提出する",
+        "inputSchema": {"json": _PROMPT_SCHEMA_HINT},
+    }
+}
+
+_JSON_SCHEMA_TYPES: Dict[str, Any] = {
+    "object": dict, "array": list, "string": str, "number": (int, float), "integer": int, "boolean": bool,
+    "null": type(None),
+}
+
+def _compile_schema(schema: Dict[str, Any]) -> Callable[[Any, str], List[str]]:
+    """JSONスキーマ（type / properties / required / items）を検証関数に変換する
+    検証関数は (値, パス) を受け取り、不適合な箇所のメッセージのリストを返す（空なら適合）"""
+    kind = schema.get("type")
+    py_type = _JSON_SCHEMA_TYPES.get(kind, object)
+    numeric = kind in ("number", "integer")
+    props = {k: _compile_schema(v) for k, v in schema.get("properties", {}).items()}
+    required = tuple(schema.get("required", ()))
+    items = _compile_schema(schema["items"]) if "items" in schema else None
+
+    def validate(value: Any, path: str = "$") -> List[str]:
+        if not isinstance(value, py_type) or (numeric and isinstance(value, bool)):
+            return [f"{path}: {kind} ではありません"]
+        errors: List[str] = []
+        if isinstance(value, dict):
+            errors.extend(f"{path}.{k}: 必須項目がありません" for k in required if k not in value)
+            for k, check in props.items():
+                if k in value:
+                    errors.extend(check(value[k], f"{path}.{k}"))
+        elif items is not None and isinstance(value, list):
+            for i, v in enumerate(value):
+                errors.extend(items(v, f"{path}[{i}]"))
+        return errors
+
+    return validate
+
+_validate_analysis = _compile_schema(_PROMPT_SCHEMA_HINT)
+
+# 応答のJSONは途中で切れていることがある（MAX_TOKENS 到達など）。_TolerantJsonParser は出力を先頭から順に
+# 読み（ストリームの差分をそのまま渡せる）、閉じた値から組み立てる。切れた末尾の値だけを捨て、
+# それまでに完結したトップレベル項目は使える状態で残す。読み直し（{～} の再解析など）はしない。
+_JSON_WS = re.compile(r"\s*")  # 全角空白なども読み飛ばす（_JSON_TOKEN と同じ区切り）
+_JSON_TOKEN = re.compile(r"[^,:\[\]{}\"\s]+")
+_JSON_SCALAR = re.compile(r"-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?")
+_JSON_LITERALS = {"true": True, "false": False, "null": None}
+_JSON_DECODER = json.JSONDecoder(strict=False)
+
+class _TolerantJsonParser:
+    """LLMの出力から最初のJSONオブジェクトを組み立てる（前後の説明文・フェンスは無視）
+    feed() で差分を渡し、close() の後に value / truncated / complete を参照する"""
+
+    def __init__(self):
+        self.value: Optional[Dict[str, Any]] = None
+        self.complete: set = set()  # 値が閉じたトップレベルのキー
+        self.done = False
+        self.closed = False
+        self._buf = ""
+        self._started = False
+        self._stack: List[List[Any]] = []  # [コンテナ, 未使用のキー, 親でのキー]
+
+    @property
+    def truncated(self) -> bool:
+        return self.value is not None and not self.done
+
+    def feed(self, chunk: str) -> "_TolerantJsonParser":
+        if self.done or not chunk:
+            return self
+        buf = self._buf + chunk
+        if not self._started:
+            start = buf.find("{")
+            if start < 0:
+                self._buf = ""
+                return self
+            buf, self._started = buf[start:], True
+            try:
+                # 最初からオブジェクト全体が揃っていれば（通常の応答）Cの decoder で1回読んで終わり
+                value, _ = _JSON_DECODER.raw_decode(buf)
+            except ValueError:
+                pass
+            else:
+                if isinstance(value, dict):
+                    self.value, self.complete, self.done = value, set(value), True
+                    return self
+        self._buf = self._consume(buf)
+        return self
+
+    def close(self) -> "_TolerantJsonParser":
+        """入力の終わり。閉じていない文字列・末尾の数値（桁が欠けている可能性がある）は捨てる"""
+        self.closed = True
+        self._buf = ""
+        return self
+
+    def _attach(self, value: Any) -> None:
+        if not self._stack:
+            self.value = value if isinstance(value, dict) else None
+            return
+        top = self._stack[-1]
+        if isinstance(top[0], list):
+            top[0].append(value)
+        elif top[1] is not None:
+            top[0][top[1]] = value
+            if len(self._stack) == 1 and not isinstance(value, (dict, list)):
+                self.complete.add(top[1])
+            top[1] = None
+
+    def _consume(self, buf: str) -> str:
+        """buf を読めるところまで読み、読み残し（次の feed で続きと合わせて読む）を返す"""
+        pos, n = 0, len(buf)
+        while pos < n and not self.done:
+            pos = _JSON_WS.match(buf, pos).end()
+            if pos >= n:
+                break
+            c = buf[pos]
+            if c in "{[":
+                container: Any = {} if c == "{" else []
+                key = self._stack[-1][1] if self._stack else None
+                self._attach(container)
+                self._stack.append([container, None, key])
+                pos += 1
+            elif c in "}]":
+                if self._stack:
+                    _, _, key = self._stack.pop()
+                    if len(self._stack) == 1 and key is not None:
+                        self.complete.add(key)
+                    self.done = not self._stack
+                pos += 1
+            elif c in ",:":
+                pos += 1
+            elif c == '"':
+                try:
+                    text, end = scanstring(buf, pos + 1, False)
+                except ValueError as e:
+                    if e.msg.startswith("Invalid \\escape") and e.pos < n - 1:
+                        # 不正なエスケープはバックスラッシュを落として読み直す
+                        buf = buf[:e.pos] + buf[e.pos + 1:]
+                        n -= 1
+                        continue
+                    break  # 閉じていない（続きを待つ）
+                top = self._stack[-1] if self._stack else None
+                if top is not None and isinstance(top[0], dict) and top[1] is None:
+                    top[1] = text
+                else:
+                    self._attach(text)
+                pos = end
+            else:
+                end = _JSON_TOKEN.match(buf, pos).end()
+                if end >= n:
+                    break  # 続きがあるかもしれない
+                tok = buf[pos:end]
+                if tok in _JSON_LITERALS:
+                    self._attach(_JSON_LITERALS[tok])
+                elif _JSON_SCALAR.fullmatch(tok):
+                    self._attach(float(tok) if any(ch in tok for ch in ".eE") else int(tok))
+                # JSONとして読めない語（1円 など）は読み飛ばす
+                pos = end
+        return buf[pos:]
+
+def _parse_analysis_json(text: str) -> _TolerantJsonParser:
+    return _TolerantJsonParser().feed(text).close()
+
+# 出力が途中で切れた場合、箇条書きは完結した項目だけでも使う（他の項目は閉じたものだけ採用）
+_PARTIAL_OK_FIELDS = ("findings",)
+
+def _repair_prompt(text: str, errors: List[str], schema_json: str = "") -> str:
+    problems = "\n".join(f"- {e}" for e in errors[:20])
+    schema_json = schema_json or _PROMPT_SCHEMA_HINT_JSON
+    return f"""次の出力は指定のJSONスキーマに適合していません。分析はやり直さず、内容をできるだけ保ったまま、スキーマに適合するJSONだけを出力してください。
+
+【スキーマ】
+{schema_json}
+
+【不適合な箇所】
+{problems}
+
+【修正対象の出力】
+{text}"""
+
+class _OutputStats:
+    """JSON形式の応答の解析・検証・修正の回数（コンテナ単位の累計）"""
+
+    def __init__(self):
+        self.counts: Dict[str, int] = defaultdict(int)
+
+    def count(self, name: str) -> None:
+        self.counts[name] += 1
+
+    def info(self) -> Dict[str, Any]:
+        c = self.counts
+        responses = c["responses"] or 1
+        return {
+            **dict(c),
+            "parse_failure_rate": round(c["parse_failures"] / responses, 4),
+            "schema_failure_rate": round(c["schema_failures"] / responses, 4),
+            "repair_rate": round(c["repairs"] / responses, 4),
+            "repair_success_rate": round(c["repaired"] / c["repairs"], 4) if c["repairs"] else None,
+        }
+
+_OUTPUT_STATS = _OutputStats()
+
+def _structured_analysis(model_id: str, region: str, text: str, tool: Optional[Dict[str, Any]],
+                         max_tokens: int, use_cache: bool = True,
+                         parser: Optional[_TolerantJsonParser] = None,
+                         formats: Tuple[str, ...] = (),
+                         profile: Optional[Dict[str, Any]] = None,
+                         deadline: Optional[_Deadline] = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """JSON形式の応答を解析・検証し、不適合なら修正ターン（最大 STRUCTURED_REPAIR 回）を送る
+    parser にストリーミング中に差分を渡した _TolerantJsonParser を渡すと、text を読み直さない。
+    途中で切れた出力は、完結した項目が1つでもあれば修正ターンを送らずにそれを使う。
+    formats に複数形式を指定した場合は、その組み合わせのスキーマ（_analysis_schema）で検証する。
+    deadline の残りが修正ターンに足りなければ送らない。
+    戻り値は (解析結果, 状況)。最後まで解析できなければ従来どおり全文を overview に入れる"""
+    _, schema_json, validate = _analysis_schema(formats)
+    status: Dict[str, Any] = {"mode": "tool" if tool else "text", "repairs": 0}
+    parsed = parser.close() if parser is not None else _parse_analysis_json(text)
+    obj = parsed.value
+    _OUTPUT_STATS.count("responses")
+    if parsed.truncated:
+        obj = {k: v for k, v in obj.items() if k in parsed.complete or k in _PARTIAL_OK_FIELDS} or None
+        status["truncated"] = True
+        status["complete_fields"] = sorted(parsed.complete)
+        _OUTPUT_STATS.count("truncated")
+    errors = validate(obj) if obj is not None else ["$: JSONとして解析できません"]
+    _OUTPUT_STATS.count("parse_failures" if obj is None else "schema_failures" if errors else "valid")
+    # 途中で切れていても使える項目があれば、そのまま使う（何も取れなかったときだけ修正ターンを送る）
+    while errors and (obj is None or not parsed.truncated) and status["repairs"] < STRUCTURED_REPAIR:
+        timeout_s = deadline.timeout_s() if deadline is not None else None
+        if timeout_s is not None and timeout_s < 5:
+            status["repair_skipped"] = "deadline"
+            break
+        status["repairs"] += 1
+        _OUTPUT_STATS.count("repairs")
+        try:
+            fixed, fixed_status = _converse_cached(model_id, region, _repair_prompt(text, errors, schema_json),
+                                                   use_cache=use_cache, max_tokens=min(max_tokens, _estimate_tokens(text) + 1024),
+                                                   tool=tool, profile=profile, timeout_s=timeout_s, defer_store=True)
+        except Exception as e:
+            logger.warning(f"Structured output repair failed: {e}")
+            break
+        candidate = _parse_analysis_json(fixed)
+        if candidate.value is None or candidate.truncated:
+            continue
+        candidate_errors = validate(candidate.value)
+        if not candidate_errors:
+            _cache_store(fixed_status, fixed)  # 検証を通った修正結果だけをキャッシュする
+        if obj is not None and len(candidate_errors) >= len(errors):
+            continue  # 改善しなかった修正結果は採用しない
+        obj, text, errors = candidate.value, fixed, candidate_errors
+        if not errors:
+            _OUTPUT_STATS.count("repaired")
+    status["valid"] = not errors
+    if errors:
+        status["errors"] = errors[:10]
+    if obj is None:
+        _OUTPUT_STATS.count("fallbacks")
+        obj = {"overview": text}
+    return obj, status
+
+# ====== Multi-format output ======
+# 同じデータを json / markdown / text で続けて求められることが多い。responseFormats に複数指定された場合は
+# JSON のプロンプトに各形式の本文用の項目を足し、1回の呼び出しの結果から全形式の応答を作る。
+RESPONSE_FORMATS = ("json", "markdown", "text")
+
+# 形式 → (JSONの項目名, 書き方の指示)。json は overview などの既存項目をそのまま使う
+_FORMAT_FIELDS = {
+    "markdown": ("report", "社長や部長が読むレポート。Markdownや記号（##、**、|、- など）、英語、専門用語は使わず、"
+                           "部下が上司に口頭で報告するような自然な日本語の文章で、数字は「○○万円」「○○%増加」のように書く"),
+    "text": ("summary", "上司に口頭で報告するような3行以内のまとめ。記号、英語、カタカナ専門用語は使わず、"
+                        "「です・ます」調の自然な話し言葉で、数字は「○○万円」「○○%増加」のように書く"),
+}
+
+def _parse_response_formats(value: Any) -> Tuple[str, ...]:
+    """responseFormats（配列またはカンマ区切り）を重複なし・既知の形式だけのタプルにする"""
+    if isinstance(value, str):
+        value = value.split(",")
+    if not isinstance(value, list):
+        return ()
+    names = (str(v).strip().lower() for v in value)
+    return tuple(dict.fromkeys(n for n in names if n in RESPONSE_FORMATS))
+
+@lru_cache(maxsize=None)
+def _analysis_schema(formats: Tuple[str, ...] = ()) -> Tuple[Dict[str, Any], str, Callable[[Any, str], List[str]]]:
+    """出力形式の組み合わせごとのスキーマ（dict, JSON文字列, 検証関数）。組み合わせごとに1回だけ作る
+    追加の項目はモデルには必須として求めるが、欠けても overview から作れるため検証では任意とする
+    （欠けただけで修正ターンを送らない）"""
+    fields = [_FORMAT_FIELDS[f][0] for f in formats if f in _FORMAT_FIELDS] if len(formats) > 1 else []
+    if not fields:
+        return _PROMPT_SCHEMA_HINT, _PROMPT_SCHEMA_HINT_JSON, _validate_analysis
+    schema = json.loads(_PROMPT_SCHEMA_HINT_JSON)
+    for name in fields:
+        schema["properties"][name] = {"type": "string"}
+    validate = _compile_schema(schema)
+    schema["required"].extend(fields)
+    return schema, json.dumps(schema, ensure_ascii=False), validate
+
+@lru_cache(maxsize=None)
+def _analysis_tool(formats: Tuple[str, ...] = ()) -> Dict[str, Any]:
+    schema = _analysis_schema(formats)[0]
+    if schema is _PROMPT_SCHEMA_HINT:
+        return _ANALYSIS_TOOL
+    return {"toolSpec": {**_ANALYSIS_TOOL["toolSpec"], "inputSchema": {"json": schema}}}
+
+@lru_cache(maxsize=64)
+def _multi_format_head(head: str, formats: Tuple[str, ...]) -> str:
+    """JSON 用プロンプトの前半に、追加の項目の指示と拡張したスキーマを差し込む"""
+    marker = "※JSON形式で出力: " + _PROMPT_SCHEMA_HINT_JSON
+    extra = "\n".join(f"- {_FORMAT_FIELDS[f][0]}: {_FORMAT_FIELDS[f][1]}" for f in formats if f in _FORMAT_FIELDS)
+    return head.replace(marker, f"""【追加の出力項目】
+同じ分析結果から、JSONに次の項目も含めてください（分析は1回だけ行い、overview・findings と矛盾させない）:
+{extra}
+
+※JSON形式で出力: {_analysis_schema(formats)[1]}""")
+
+def _derive_format_text(fmt: str, ai_json: Dict[str, Any]) -> str:
+    """追加の項目が無い（出力が途中で切れた等）ときに overview・findings から本文を作る"""
+    overview = str(ai_json.get("overview") or "")
+    if fmt == "text":
+        sentences = [t for t in overview.split("。") if t.strip()]
+        return "。".join(sentences[:3]) + ("。" if sentences else "")
+    findings = [str(f) for f in ai_json.get("findings") or [] if f]
+    return "\n\n".join([overview] + findings).strip()
+
+def _format_response(fmt: str, summary_ai: str, presentation_md: str, findings: List[str], total: int,
+                     kpis: Dict[str, Any], trend: List[Dict[str, Any]], stats: Dict[str, Any]) -> Dict[str, Any]:
+    """形式ごとの response 部分。技術的な部分を最小化"""
+    if fmt == "markdown" or fmt == "text":
+        # Markdown/Text形式は純粋な日本語のみ
+        return {"summary_ai": summary_ai}
+    # JSON形式: 自然な説明群 + 区切り線 + データ証拠
+    separator_line = "---以下は読み込んだデータの証拠です---"
+    response = {
+        "summary_ai": summary_ai,
+        "presentation_md": presentation_md,
+        "key_insights": findings,
+        "separator": separator_line,
+        "data_analysis": {
+            "total_records": total,
+            "kpis": kpis,
+            "trend": trend
+        }
+    }
+    if "distribution" in stats:
+        response["data_analysis"]["distribution"] = stats["distribution"]
+    return response
+
+# ====== Prompt budget ======
+# プロンプトは 指示文 > 統計の中核（件数・合計・上位商品）> 分布 > 時系列 > サンプル行 の優先度で組み立て、
+# 推定トークン数が予算を超える場合は低優先の要素から縮約する（元の stats / sample は変更しない）。
+# トークン数はトークナイザを使わない概算: ASCII は4文字で1トークン、それ以外（日本語）は1文字1トークン。
+def _estimate_tokens(text: str) -> int:
+    n_chars = len(text)
+    n_wide = (len(text.encode("utf-8")) - n_chars) // 2  # 日本語（UTF-8で3バイト）の文字数の近似
+    ascii_chars = max(0, n_chars - n_wide)
+    return n_wide + (ascii_chars + 3) // 4
+
+# 集約済みの時系列キー（_bucket_of の week / month / quarter 形式）
+_PERIOD_KEY_RE = re.compile(r"(\d{4})-(?:W(\d{2})|Q([1-4])|(\d{2}))$")
+_PERIOD_ORDER = ("day", "week", "month", "quarter")
+
+def _period_anchor(label: str) -> Optional[Tuple[date, str]]:
+    """時系列キーの代表日と粒度（日付・"2025-W03"・"2025-01"・"2025-Q1"）。解釈できなければ None
+    週は ISO 週の年を決める木曜日を代表日にする（年・月をまたぐ週の振り分け先）"""
+    m = _PERIOD_KEY_RE.match(label.strip())
+    if m is None:
+        d = _parse_date(label)
+        return (d, "day") if d is not None else None
+    y = int(m.group(1))
+    try:
+        if m.group(2):
+            return date.fromisocalendar(y, int(m.group(2)), 4), "week"
+        if m.group(3):
+            return date(y, 3 * int(m.group(3)) - 2, 1), "quarter"
+        return date(y, int(m.group(4)), 1), "month"
+    except ValueError:
+        return None
+
+def _rollup_timeseries(trend: List[Dict[str, Any]], bucket: str) -> List[Dict[str, Any]]:
+    """時系列をより粗い粒度（week/month/quarter）に集約し直す（週・月単位のキーは代表日で振り分ける）"""
+    acc: Dict[str, float] = defaultdict(float)
+    for t in trend:
+        label = str(t.get("date", ""))
+        anchor = _period_anchor(label)
+        key = _bucket_of(anchor[0], bucket) if anchor is not None else _day_key(label, bucket)
+        acc[key] += float(t.get("sales", 0) or 0)
+    return [{"date": d, "sales": v} for d, v in sorted(acc.items())]
+
+def _lttb_indices(ys: List[float], n_out: int) -> List[int]:
+    """Largest-Triangle-Three-Buckets: 形（山・谷）を保ったまま n_out 点を選ぶ（x は等間隔とみなす）"""
+    n = len(ys)
+    if n_out >= n:
+        return list(range(n))
+    if n_out <= 0:
+        return []
+    if n_out == 1:
+        return [max(range(n), key=lambda i: abs(ys[i]))]  # 1点なら最も大きい点
+    if n_out == 2:
+        return [0, n - 1]  # 2点なら両端（期間の終わりを落とさない）
+    out = [0]
+    every = (n - 2) / (n_out - 2)
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = int(i * every) + 1, int((i + 1) * every) + 1
+        nlo, nhi = hi, min(int((i + 2) * every) + 1, n)
+        avg_x = (nlo + nhi - 1) / 2.0
+        avg_y = sum(ys[nlo:nhi]) / max(1, nhi - nlo)
+        ax, ay = a, ys[a]
+        best, best_area = lo, -1.0
+        for j in range(lo, hi):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - j) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        out.append(best)
+        a = best
+    out.append(n - 1)
+    return out
+
+def _downsample_timeseries(trend: List[Dict[str, Any]], max_points: int = 0,
+                           method: str = "") -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """時系列を max_points 点以下に縮約する。戻り値は (時系列, 縮約情報 or None)
+    rollup: 週→月→四半期の暦集約（売上合計が保存される）。lttb: 形状を保つ間引き（各点は元の値）。
+    auto: 日付として解釈できれば rollup、できない・四半期でも多すぎる場合は lttb"""
+    max_points = max_points or TS_MAX_POINTS
+    method = method or TS_DOWNSAMPLE
+    if max_points <= 0 or len(trend) <= max_points:
+        return trend, None
+    info = {"original_points": len(trend), "max_points": max_points}
+    ends = [_period_anchor(str(t.get("date", ""))) for t in trend[:1] + trend[-1:]]
+    coarser = _PERIOD_ORDER[_PERIOD_ORDER.index(ends[0][1]) + 1:] if all(ends) else ()
+    if method in ("auto", "rollup") and coarser:
+        # 元の粒度より粗いものだけを試す（週・月単位の時系列も暦で集約できる）
+        for bucket in coarser:
+            rolled = _rollup_timeseries(trend, bucket)
+            if len(rolled) <= max_points:
+                return rolled, {**info, "method": "rollup", "bucket": bucket}
+        trend = rolled
+        info["bucket"] = "quarter"
+    idx = _lttb_indices([float(t.get("sales", 0) or 0) for t in trend], max_points)
+    return [trend[i] for i in idx], {**info, "method": "lttb"}
+
+def _budget_steps() -> List[Tuple[str, Callable[[Dict[str, Any], List[Dict[str, Any]]], Tuple[Dict[str, Any], List[Dict[str, Any]]]]]]:
+    """予算超過時に順に適用する縮約（名前, (stats, sample) -> (stats, sample)）"""
+    def sample_to(n: int):
+        return lambda st, sm: (st, sm[:n])
+
+    def rollup(bucket: str):
+        return lambda st, sm: ({**st, "timeseries": _rollup_timeseries(st.get("timeseries", []), bucket),
+                                "timeseries_bucket": bucket}, sm)
+
+    def drop_distribution(st, sm):
+        return {k: v for k, v in st.items() if k != "distribution"}, sm
+
+    def tail_timeseries(st, sm):
+        ts = st.get("timeseries", [])
+        return ({**st, "timeseries": ts[-24:], "timeseries_truncated": len(ts)} if len(ts) > 24 else st), sm
+
+    return [
+        ("sample_20", sample_to(20)),
+        ("timeseries_week", rollup("week")),
+        ("sample_5", sample_to(5)),
+        ("timeseries_month", rollup("month")),
+        ("drop_distribution", drop_distribution),
+        ("timeseries_tail_24", tail_timeseries),
+        ("sample_0", sample_to(0)),
+    ]
+
+def _assemble_prompt(build: Callable[..., str], stats: Dict[str, Any], sample: List[Dict[str, Any]],
+                     data_type: str, budget: int = 0, encoding: str = "json") -> Tuple[str, Dict[str, Any]]:
+    """build（_build_prompt_*）で組み立てたプロンプトを入力トークン予算に収める
+    戻り値は (プロンプト, 内訳)。内訳には要素ごとの推定トークン数と適用した縮約を含む"""
+    budget = budget or PROMPT_TOKEN_BUDGET
+    system_tokens = _estimate_tokens(_SYSTEM_JA[0]["text"])
+    applied: List[str] = []
+    steps = iter(_budget_steps())
+    while True:
+        prompt = build(stats, sample, data_type, encoding)
+        total = system_tokens + _estimate_tokens(prompt)
+        if total <= budget:
+            break
+        step = next(steps, None)
+        if step is None:
+            break
+        stats, sample = step[1](stats, sample)
+        applied.append(step[0])
+    stats_tokens = _estimate_tokens(_encode_stats(stats, encoding))
+    sample_tokens = _estimate_tokens(_encode_rows(sample, encoding))
+    return prompt, {
+        "input_tokens": total,
+        "budget": budget,
+        "within_budget": total <= budget,
+        "components": {
+            "system": system_tokens,
+            "instructions": max(0, total - system_tokens - stats_tokens - sample_tokens),
+            "stats": stats_tokens,
+            "sample": sample_tokens,
+        },
+        "sample_rows": len(sample),
+        "encoding": encoding,
+        "reductions": applied,
+    }
+
+def _preflight(input_tokens: int, max_tokens: int,
+               prices: Optional[Tuple[float, float]] = None) -> Dict[str, Any]:
+    """呼び出し前のコスト見積もり（出力は上限まで生成した場合の最大値）
+    prices は (入力, 出力) の USD/1Kトークン（省略時は PRICE_INPUT_PER_1K / PRICE_OUTPUT_PER_1K）
+    decision: ok / downgrade（出力上限を下げてコスト上限に収めた）/ reject"""
+    price_in, price_out = prices or (PRICE_INPUT_PER_1K, PRICE_OUTPUT_PER_1K)
+
+    def cost(out_tokens: int) -> float:
+        return round(input_tokens / 1000 * price_in + out_tokens / 1000 * price_out, 6)
+
+    info = {"input_tokens_est": input_tokens, "max_output_tokens": max_tokens,
+            "cost_usd_est": cost(max_tokens), "decision": "ok"}
+    if MAX_COST_USD > 0 and info["cost_usd_est"] > MAX_COST_USD:
+        room = MAX_COST_USD - input_tokens / 1000 * price_in
+        out_tokens = int(room / price_out * 1000) if price_out > 0 else max_tokens
+        if out_tokens >= MIN_OUTPUT_TOKENS:
+            info.update(max_output_tokens=out_tokens, cost_usd_est=cost(out_tokens), decision="downgrade")
+        else:
+            info["decision"] = "reject"
+    return info
+
+def _iter_text_blocks(text: str, block_chars: int = 1 << 20) -> Iterator[str]:
+    """約1MB単位・行境界でテキストを切り出す（全行リストを作らない）"""
+    pos, n = 0, len(text)
+    while pos < n:
+        end = text.find("\n", pos + block_chars)
+        end = n if end == -1 else end + 1
+        yield text[pos:end]
+        pos = end
+
+def _iter_csv_records(csv_text: str) -> Iterator[List[str]]:
+    """RFC 4180準拠で1レコードずつセルリストを返す"""
+    blocks = _iter_text_blocks(csv_text)
+    for block in blocks:
+        if '"' in block:
+            # 引用符が現れたブロック以降は csv モジュールで厳密に解析（"1,200" や改行入りセル）
+            lines = chain.from_iterable(io.StringIO(b, newline="") for b in chain((block,), blocks))
+            yield from csv.reader(lines)
+            return
+        # 引用符のないブロックは単純分割と等価なので高速パス
+        for line in block.splitlines():
+            yield line.split(",")
+
+def _iter_csv_cells(csv_text: str, has_header: bool = True) -> Iterator[List[str]]:
+    """空行を除いたセルリストを返す（has_header なら先頭はBOM除去済みヘッダー）
+    空行は空白だけの行のみ。",,," のような区切りだけの行は従来どおり空セルの1行として数える"""
+    first = has_header
+    for cells in _iter_csv_records(csv_text):
+        if not cells or (len(cells) == 1 and not cells[0].strip()):
+            continue
+        if first:
+            first = False
+            cells = [h.strip() for h in cells]
+            cells[0] = cells[0].lstrip("\ufeff")
+        yield cells
+
+def _iter_csv_rows(csv_text: str) -> Iterator[Dict[str, Any]]:
+    """RFC 4180準拠（"1,200" のような引用符付きカンマ・改行・"" エスケープ対応）で1行ずつdictを返す"""
+    cells_iter = _iter_csv_cells(csv_text)
+    headers = next(cells_iter, None)
+    if not headers:
+        return
+    for cells in cells_iter:
+        ncell = len(cells)
+        yield {h: (cells[i].strip() if i < ncell else "") for i, h in enumerate(headers)}
+
 def _parse_csv_simple(csv_text: str) -> List[Dict[str, Any]]:
-    lines = [l for l in csv_text.splitlines() if l.strip() != ""]
-    if not lines: return []
-    headers = [h.strip() for h in lines[0].split(",")]
-    rows: List[Dict[str, Any]] = []
-    for line in lines[1:]:
-        cells = [c.strip() for c in line.split(",")]
-        row = {}
-        for i, h in enumerate(headers):
-            row[h] = cells[i] if i < len(cells) else ""
-        rows.append(row)
-    return rows
+    """後方互換: 全行をリストで返す（大きなデータでは _iter_csv_rows を使うこと）"""
+    return list(_iter_csv_rows(csv_text))
+
+# データ種別判定のキーワード表: (種別, 重み, キーワード群)。列名はキーワードごとに加点する
+_HEADER_KEYWORD_RULES = (
+    # 人事データの強いキーワード（高スコア）
+    ("hr_data", 3, ["社員id", "employee", "氏名", "部署", "給与", "salary", "賞与", "年収", "評価", "performance", "残業", "overtime", "有給", "離職", "昇進", "スキル", "チーム貢献", "人事"]),
+    # 人事データの中程度キーワード
+    ("hr_data", 2, ["勤怠", "attendance", "研修", "training", "目標達成", "職位", "入社", "年齢"]),
+    # マーケティングデータの強いキーワード
+    ("marketing_data", 3, ["キャンペーン", "campaign", "roi", "インプレッション", "impression", "クリック", "click", "cv数", "conversion", "顧客獲得", "cac", "roas", "広告", "媒体", "ターゲット"]),
+    # マーケティングデータの中程度キーワード
+    ("marketing_data", 1, ["予算", "budget", "支出", "cost", "facebook", "google", "youtube", "instagram", "tiktok", "twitter"]),
+    # 売上データの強いキーワード
+    ("sales_data", 3, ["売上", "sales", "revenue", "商品", "product", "顧客", "customer", "金額", "amount", "単価", "price", "数量", "quantity"]),
+    # 売上データの中程度キーワード
+    ("sales_data", 1, ["日付", "date", "店舗", "store", "地域", "region", "カテゴリ", "category"]),
+    # 統合戦略データ（財務データ）の強いキーワード
+    ("financial_data", 3, ["売上高", "revenue", "利益", "profit", "資産", "asset", "負債", "liability", "キャッシュ", "cash", "損益", "pl", "貸借", "bs"]),
+    # 在庫分析データの強いキーワード
+    ("inventory_data", 3, ["在庫", "inventory", "stock", "在庫数", "保有数", "倉庫", "warehouse", "回転率", "turnover", "滞留", "入庫", "出庫", "調達", "procurement"]),
+    # 在庫分析データの中程度キーワード
+    ("inventory_data", 1, ["商品コード", "sku", "ロット", "lot", "品番", "型番", "仕入", "supplier", "発注", "order", "納期", "delivery"]),
+    # 顧客分析データの強いキーワード
+    ("customer_data", 3, ["顧客", "customer", "会員", "member", "ユーザー", "user", "ltv", "lifetime", "churn", "離脱", "継続", "retention", "満足度", "satisfaction"]),
+    # 顧客分析データの中程度キーワード
+    ("customer_data", 1, ["セグメント", "segment", "年齢", "age", "性別", "gender", "地域", "region", "購入履歴", "purchase", "アクセス", "access", "クリック", "click"]),
+)
+# サンプル値のキーワード: (グループ名, 種別, 重み, キーワード群)。値ごとにグループ単位で1回だけ加点する
+_VALUE_KEYWORD_RULES = (
+    ("dept", "hr_data", 5, ["営業部", "it部", "人事部", "財務部", "マーケティング部"]),
+    ("position", "hr_data", 3, ["主任", "係長", "一般", "部長", "課長"]),
+    ("risk", "hr_data", 4, ["低", "中", "高"]),  # 列名に リスク/risk を含む場合のみ
+    ("media", "marketing_data", 5, ["google広告", "facebook広告", "youtube広告", "instagram広告", "line広告", "tiktok広告"]),
+    ("unit", "inventory_data", 2, ["個", "本", "kg", "箱", "セット", "台"]),
+    ("status", "inventory_data", 4, ["入荷待ち", "出荷済み", "在庫切れ", "調達中"]),
+    ("age", "customer_data", 3, ["20代", "30代", "40代", "50代", "60代"]),  # 18〜80の整数値も同じグループ
+    ("gender", "customer_data", 3, ["男性", "女性", "male", "female", "男", "女"]),
+)
+
+class _KeywordMatcher:
+    """複数キーワードの部分一致をまとめて判定する（キーワードごとの `kw in text` と同じ結果）
+    キーワード表をトライ木の形の正規表現に1回だけコンパイルし、search を1文字ずつずらして
+    キーワードの開始位置を列挙する（先頭文字の文字クラスで候補外の位置はCレベルで読み飛ばされる）。
+    各開始位置では最長一致を拾い、同じ位置から始まる短いキーワード（"売上高" に対する "売上"）は
+    事前計算した接頭辞表で補う。"""
+
+    def __init__(self, keywords: Iterable[str]):
+        words = sorted(set(keywords))
+        self._search = re.compile("(" + self._trie_pattern(words) + ")").search
+        self._prefixes = {w: tuple(k for k in words if w.startswith(k)) for w in words}
+
+    @staticmethod
+    def _trie_pattern(words: List[str]) -> str:
+        trie: Dict[str, Any] = {}
+        for w in words:
+            node = trie
+            for ch in w:
+                node = node.setdefault(ch, {})
+            node[""] = {}  # 語の終端
+
+        def build(node: Dict[str, Any]) -> str:
+            alts = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+            if not alts:
+                return ""
+            body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+            # 終端ノードの先は任意（貪欲なので最長のキーワードが優先される）
+            return "(?:" + body + ")?" if "" in node else body
+
+        return build(trie)
+
+    def find(self, text: str) -> set:
+        found: set = set()
+        prefixes, search = self._prefixes, self._search
+        m = search(text)
+        while m:
+            found.update(prefixes[m.group(1)])
+            m = search(text, m.start() + 1)
+        return found
+
+_HEADER_WEIGHTS: Dict[str, List[Tuple[str, int]]] = defaultdict(list)
+for _type, _weight, _words in _HEADER_KEYWORD_RULES:
+    for _w in _words:
+        _HEADER_WEIGHTS[_w].append((_type, _weight))
+_VALUE_GROUPS: Dict[str, List[str]] = defaultdict(list)
+for _group, _type, _weight, _words in _VALUE_KEYWORD_RULES:
+    for _w in _words:
+        _VALUE_GROUPS[_w].append(_group)
+_VALUE_GROUP_SCORE = {g: (t, w) for g, t, w, _ in _VALUE_KEYWORD_RULES}
+_HEADER_MATCHER = _KeywordMatcher(_HEADER_WEIGHTS)
+_VALUE_MATCHER = _KeywordMatcher(_VALUE_GROUPS)
+del _type, _weight, _words, _w, _group
 
 def _identify_data_type(columns: List[str], sample_data: List[Dict[str, Any]]) -> str:
-    """データの列名とサンプルから財務データの種類を自動判別（7つの分析タイプに特化）"""
+    """データの列名とサンプルから財務データの種類を自動判別（7つの分析タイプに特化）
+    キーワード表はモジュール読み込み時に _KeywordMatcher へコンパイル済み"""
     if not columns:
         return "financial_data"
     
     # 列名を小文字に変換して判別しやすくする
-    col_lower = [col.lower() for col in columns]
-    col_str = " ".join(col_lower) + " " + " ".join(columns)
+    col_str = " ".join(col.lower() for col in columns) + " " + " ".join(columns)
     
     # スコアベースの判定システム
     scores = {
@@ -261,113 +2206,38 @@ def _identify_data_type(columns: List[str], sample_data: List[Dict[str, Any]]) -
         "customer_data": 0
     }
     
-    # 人事データの強いキーワード（高スコア）
-    hr_strong_keywords = ["社員id", "employee", "氏名", "部署", "給与", "salary", "賞与", "年収", "評価", "performance", "残業", "overtime", "有給", "離職", "昇進", "スキル", "チーム貢献", "人事"]
-    for keyword in hr_strong_keywords:
-        if keyword in col_str:
-            scores["hr_data"] += 3
-    
-    # 人事データの中程度キーワード
-    hr_medium_keywords = ["勤怠", "attendance", "研修", "training", "目標達成", "職位", "入社", "年齢"]
-    for keyword in hr_medium_keywords:
-        if keyword in col_str:
-            scores["hr_data"] += 2
-    
-    # マーケティングデータの強いキーワード
-    marketing_strong_keywords = ["キャンペーン", "campaign", "roi", "インプレッション", "impression", "クリック", "click", "cv数", "conversion", "顧客獲得", "cac", "roas", "広告", "媒体", "ターゲット"]
-    for keyword in marketing_strong_keywords:
-        if keyword in col_str:
-            scores["marketing_data"] += 3
-    
-    # マーケティングデータの中程度キーワード
-    marketing_medium_keywords = ["予算", "budget", "支出", "cost", "facebook", "google", "youtube", "instagram", "tiktok", "twitter"]
-    for keyword in marketing_medium_keywords:
-        if keyword in col_str:
-            scores["marketing_data"] += 1
-    
-    # 売上データの強いキーワード
-    sales_strong_keywords = ["売上", "sales", "revenue", "商品", "product", "顧客", "customer", "金額", "amount", "単価", "price", "数量", "quantity"]
-    for keyword in sales_strong_keywords:
-        if keyword in col_str:
-            scores["sales_data"] += 3
-    
-    # 売上データの中程度キーワード
-    sales_medium_keywords = ["日付", "date", "店舗", "store", "地域", "region", "カテゴリ", "category"]
-    for keyword in sales_medium_keywords:
-        if keyword in col_str:
-            scores["sales_data"] += 1
-    
-    # 統合戦略データ（財務データ）の強いキーワード
-    financial_strong_keywords = ["売上高", "revenue", "利益", "profit", "資産", "asset", "負債", "liability", "キャッシュ", "cash", "損益", "pl", "貸借", "bs"]
-    for keyword in financial_strong_keywords:
-        if keyword in col_str:
-            scores["financial_data"] += 3
-    
-    # 在庫分析データの強いキーワード
-    inventory_strong_keywords = ["在庫", "inventory", "stock", "在庫数", "保有数", "倉庫", "warehouse", "回転率", "turnover", "滞留", "入庫", "出庫", "調達", "procurement"]
-    for keyword in inventory_strong_keywords:
-        if keyword in col_str:
-            scores["inventory_data"] += 3
-    
-    # 在庫分析データの中程度キーワード
-    inventory_medium_keywords = ["商品コード", "sku", "ロット", "lot", "品番", "型番", "仕入", "supplier", "発注", "order", "納期", "delivery"]
-    for keyword in inventory_medium_keywords:
-        if keyword in col_str:
-            scores["inventory_data"] += 1
-    
-    # 顧客分析データの強いキーワード  
-    customer_strong_keywords = ["顧客", "customer", "会員", "member", "ユーザー", "user", "ltv", "lifetime", "churn", "離脱", "継続", "retention", "満足度", "satisfaction"]
-    for keyword in customer_strong_keywords:
-        if keyword in col_str:
-            scores["customer_data"] += 3
-    
-    # 顧客分析データの中程度キーワード
-    customer_medium_keywords = ["セグメント", "segment", "年齢", "age", "性別", "gender", "地域", "region", "購入履歴", "purchase", "アクセス", "access", "クリック", "click"]
-    for keyword in customer_medium_keywords:
-        if keyword in col_str:
-            scores["customer_data"] += 1
+    # 列名: 出現したキーワードごとに加点（全キーワード表を1パスで照合）
+    for keyword in _HEADER_MATCHER.find(col_str):
+        for data_type, weight in _HEADER_WEIGHTS[keyword]:
+            scores[data_type] += weight
     
     # データの内容からも判定（サンプルデータが利用可能な場合）
     if sample_data and len(sample_data) > 0:
         sample = sample_data[0]
         
-        # 人事データの特徴的な値パターン
         for key, value in sample.items():
             str_value = str(value).lower()
+            key_lower = key.lower()
+            groups = {g for kw in _VALUE_MATCHER.find(str_value) for g in _VALUE_GROUPS[kw]}
             
-            # 人事系の値パターン
-            if any(dept in str_value for dept in ["営業部", "it部", "人事部", "財務部", "マーケティング部"]):
-                scores["hr_data"] += 5
-            if any(pos in str_value for pos in ["主任", "係長", "一般", "部長", "課長"]):
-                scores["hr_data"] += 3
-            if any(risk in str_value for risk in ["低", "中", "高"]) and ("リスク" in key or "risk" in key.lower()):
-                scores["hr_data"] += 4
+            # 値パターン（人事の部署・役職、広告媒体、在庫の単位・ステータス、性別）
+            if "risk" in groups and not ("リスク" in key or "risk" in key_lower):
+                groups.discard("risk")
+            if str_value.isdigit() and 18 <= int(str_value) <= 80:
+                groups.add("age")
+            for g in groups:
+                data_type, weight = _VALUE_GROUP_SCORE[g]
+                scores[data_type] += weight
                 
-            # マーケティング系の値パターン
-            if any(media in str_value for media in ["google広告", "facebook広告", "youtube広告", "instagram広告", "line広告", "tiktok広告"]):
-                scores["marketing_data"] += 5
-            if "%" in str_value and any(metric in key.lower() for metric in ["roi", "達成率", "満足度"]):
+            # 列名と値の組み合わせパターン
+            if "%" in str_value and any(metric in key_lower for metric in ["roi", "達成率", "満足度"]):
                 scores["marketing_data"] += 2
-                
-            # 売上系の値パターン（数値が大きく、商品名がある場合）
-            if "商品" in key or "product" in key.lower():
+            if "商品" in key or "product" in key_lower:
                 scores["sales_data"] += 3
-            if key.lower() in ["店舗", "store"] and str_value:
+            if key_lower in ["店舗", "store"] and str_value:
                 scores["sales_data"] += 4
-                
-            # 在庫系の値パターン
-            if any(unit in str_value for unit in ["個", "本", "kg", "箱", "セット", "台"]):
-                scores["inventory_data"] += 2
-            if "warehouse" in key.lower() or "倉庫" in key:
+            if "warehouse" in key_lower or "倉庫" in key:
                 scores["inventory_data"] += 3
-            if any(status in str_value for status in ["入荷待ち", "出荷済み", "在庫切れ", "調達中"]):
-                scores["inventory_data"] += 4
-                
-            # 顧客系の値パターン  
-            if any(age in str_value for age in ["20代", "30代", "40代", "50代", "60代"]) or str_value.isdigit() and 18 <= int(str_value) <= 80:
-                scores["customer_data"] += 3
-            if any(gender in str_value for gender in ["男性", "女性", "male", "female", "男", "女"]):
-                scores["customer_data"] += 3
             if "@" in str_value:  # メールアドレス
                 scores["customer_data"] += 4
     
@@ -378,22 +2248,30 @@ def _identify_data_type(columns: List[str], sample_data: List[Dict[str, Any]]) -
     # デフォルト
     return "financial_data"
 
+def _identify_data_type_cached(columns: List[str], sample_data: List[Dict[str, Any]]) -> str:
+    """_identify_data_type のヘッダーシグネチャ単位キャッシュ版
+    サンプル値による加点はそのレイアウトを初めて見たときのサンプルで評価される"""
+    if not columns:
+        return _identify_data_type(columns, sample_data)
+    return _HEADER_CACHE.get(columns, "data_type", lambda: _identify_data_type(columns, sample_data))
+
+_DATA_TYPE_NAMES = MappingProxyType({
+    "pl_statement": "損益計算書（PL表）",
+    "balance_sheet": "貸借対照表（BS）",
+    "cashflow_statement": "キャッシュフロー計算書",
+    "sales_data": "売上データ",
+    "inventory_data": "在庫データ",
+    "customer_data": "顧客データ",
+    "hr_data": "人事データ",
+    "marketing_data": "マーケティングデータ",
+    "financial_data": "財務データ",
+    "document_data": "書類画像データ",
+    "unknown": "不明なデータ"
+})
+
 def _get_data_type_name(data_type: str) -> str:
     """データタイプの日本語名を返す"""
-    type_names = {
-        "pl_statement": "損益計算書（PL表）",
-        "balance_sheet": "貸借対照表（BS）",
-        "cashflow_statement": "キャッシュフロー計算書",
-        "sales_data": "売上データ",
-        "inventory_data": "在庫データ",
-        "customer_data": "顧客データ",
-        "hr_data": "人事データ",
-        "marketing_data": "マーケティングデータ",
-        "financial_data": "財務データ",
-        "document_data": "書類画像データ",
-        "unknown": "不明なデータ"
-    }
-    return type_names.get(data_type, "財務データ")
+    return _DATA_TYPE_NAMES.get(data_type, "財務データ")
 
 def validate_analysis_compatibility(detected_data_type: str, requested_analysis_type: str) -> Tuple[bool, str]:
     """データタイプと分析タイプの適合性をチェック（使いやすさ重視）"""
@@ -463,28 +2341,27 @@ def validate_analysis_compatibility(detected_data_type: str, requested_analysis_
     
     return True, ""
 
-def _get_analysis_instructions(data_type: str) -> str:
-    """データタイプ別の分析指示を返す"""
-    instructions = {
-        "pl_statement": """
+# データタイプ別の分析指示（読み込み時に1回だけ構築）
+_ANALYSIS_INSTRUCTIONS = MappingProxyType({
+    "pl_statement": """
 - 売上高、売上原価、粗利率を確認してください
 - 販管費の内訳と売上高に占める割合を分析してください
 - 営業利益、経常利益、当期純利益の推移を確認してください
 - 収益性の健全性と改善点を指摘してください""",
-        
-        "balance_sheet": """
+    
+    "balance_sheet": """
 - 総資産、流動資産、固定資産の構成を確認してください
 - 負債と純資産のバランスを分析してください
 - 流動比率、自己資本比率などの安全性指標を計算してください
 - 財務の健全性と資金繰りについて評価してください""",
-        
-        "cashflow_statement": """
+    
+    "cashflow_statement": """
 - 営業キャッシュフロー、投資キャッシュフロー、財務キャッシュフローを確認してください
 - 現金創出能力と資金の使い道を分析してください
 - キャッシュフローの健全性と持続可能性を評価してください
 - 資金繰りの改善点があれば指摘してください""",
-        
-        "sales_data": """
+    
+    "sales_data": """
 【売上戦略コンサルタントレベルの収益分析を実行】
 
 **1. 多次元売上分析・トレンド診断**
@@ -516,14 +2393,8 @@ def _get_analysis_instructions(data_type: str) -> str:
 - 重点管理すべき先行指標・遅行指標の特定と目標値設定
 - 競合対策・市場変化対応のための機動的戦略オプションの準備
 - 売上成長を支える組織・システム投資計画と期待ROI算出""",
-        
-        "inventory_data": """
-- 在庫の総額、商品別構成を確認してください
-- 在庫回転率や滞留在庫があれば指摘してください
-- 適正在庫レベルと過剰在庫のリスクを評価してください
-- 在庫管理の改善点があれば提案してください""",
-        
-        "hr_data": """
+    
+    "hr_data": """
 【人事戦略コンサルタントレベルの組織分析を実行】
 
 **1. 包括的人件費・生産性分析**
@@ -555,8 +2426,8 @@ def _get_analysis_instructions(data_type: str) -> str:
 - 人材採用・育成の中期計画（3年スパンでの投資計画）
 - デジタル化・AI導入による人員配置変化への対応戦略
 - 次世代リーダー育成プログラムの設計と投資効果予測""",
-        
-        "marketing_data": """
+    
+    "marketing_data": """
 【戦略コンサルタントレベルのマーケティング分析を実行】
 
 **1. 詳細データ分析（数値根拠重視）**
@@ -586,7 +2457,7 @@ def _get_analysis_instructions(data_type: str) -> str:
 - 月次追跡すべき重要指標の特定と目標値設定
 - 実行優先順位付きのアクションプラン（具体的な実施時期と担当者想定）""",
 
-        "inventory_data": """
+    "inventory_data": """
 【サプライチェーン戦略コンサルタントレベルの在庫分析を実行】
 
 **1. 多角的在庫効率性分析**
@@ -619,7 +2490,7 @@ def _get_analysis_instructions(data_type: str) -> str:
 - データドリブン在庫戦略による競争優位性構築提案
 - サプライチェーン全体最適化のための中期投資計画""",
 
-        "customer_data": """
+    "customer_data": """
 【CRM戦略コンサルタントレベルの顧客分析を実行】
 
 **1. 高度顧客セグメンテーション分析**
@@ -651,8 +2522,8 @@ def _get_analysis_instructions(data_type: str) -> str:
 - カスタマーサクセス指標の設定と改善ロードマップ
 - 競合対策・差別化要因の強化による顧客維持戦略
 - 次世代顧客獲得チャネル開拓の戦略設計と投資効果予測""",
-        
-        "financial_data": """
+    
+    "financial_data": """
 【統合戦略コンサルタントレベルの財務・経営分析を実行】
 
 **1. 包括的財務健全性分析**
@@ -685,13 +2556,334 @@ def _get_analysis_instructions(data_type: str) -> str:
 - ESG経営・持続可能性経営の財務インパクト分析
 - 経営危機・業界変化に対する耐性評価とリスク管理強化策
 - デジタル変革・DX投資による競争力向上と収益性改善シナリオ"""
-    }
-    return instructions.get(data_type, instructions["financial_data"])
+})
+
+def _get_analysis_instructions(data_type: str) -> str:
+    """データタイプ別の分析指示を返す"""
+    return _ANALYSIS_INSTRUCTIONS.get(data_type, _ANALYSIS_INSTRUCTIONS["financial_data"])
+
+# JSON 用プロンプトの前半（指示文・スキーマ）をデータタイプごとに事前生成
+_JSON_PROMPT_HEADS = MappingProxyType({
+    dt: _json_prompt_head(_get_data_type_name(dt), _get_analysis_instructions(dt))
+    for dt in (*_DATA_TYPE_NAMES, *_ANALYSIS_INSTRUCTIONS)
+})
+
+# ====== AWS clients ======
+# boto3 クライアントはモジュール単位で遅延生成し、ウォームコンテナの以降の呼び出しで再利用する
+# （クライアント生成・エンドポイント解決・TLS接続のコストを初回だけにする。接続は keep-alive で維持）
+_BOTO_CONFIG = BotoConfig(
+    connect_timeout=5,
+    read_timeout=AWS_READ_TIMEOUT,
+    max_pool_connections=AWS_MAX_POOL,
+    retries={"total_max_attempts": AWS_MAX_ATTEMPTS, "mode": "standard"},
+    tcp_keepalive=True,
+)
+_CLIENTS: Dict[Tuple[Any, ...], Any] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+def _aws_client(service: str, region: str, no_retry: bool = False) -> Any:
+    """no_retry=True は期限付きの呼び出し用（再試行分で期限を超えないようにリトライしない）。
+    クライアントはサービス・リージョンごとに通常用とリトライなし用の2つだけ（接続プールを使い回す）。
+    期限そのものは呼び出しごとに maxTokens（_Deadline.output_tokens）とストリーム受信の打ち切りで守る"""
+    key: Tuple[Any, ...] = (service, region)
+    config = _BOTO_CONFIG
+    if no_retry:
+        key = (service, region, "no_retry")
+        config = _BOTO_CONFIG.merge(BotoConfig(retries={"total_max_attempts": 1, "mode": "standard"}))
+    client = _CLIENTS.get(key)
+    if client is None:
+        with _CLIENTS_LOCK:  # boto3 のクライアント生成はスレッドセーフではない
+            client = _CLIENTS.get(key)
+            if client is None:
+                client = _CLIENTS[key] = boto3.client(service, region_name=region, config=config)
+    return client
+
+# ====== Generation profiles ======
+# 形式（json/markdown/text）・分析タイプ（sales/hr/marketing/strategic/document）ごとの生成設定。
+# 読み込み時に GENERATION_PROFILES を1回だけ解釈し、既定値に重ねる。適用順は
+#   default < 形式 < 分析タイプ < "形式:分析タイプ"（例: "text", "strategic", "json:strategic"）
+# 例: {"text": {"model_id": "us.amazon.nova-micro-v1:0", "max_tokens": 400, "latency_target_ms": 3000}}
+_PROFILE_FIELDS: Dict[str, Callable[[Any], Any]] = {
+    "model_id": str,
+    "max_tokens": int,
+    "temperature": float,
+    "stop_sequences": lambda v: [str(x) for x in (v if isinstance(v, list) else [v])],
+    "latency_target_ms": int,  # 目標レイテンシ（超えたらログに残す。0で無し）
+    "price_input_per_1k": float,   # コスト見積もり用の単価（USD/1Kトークン）。省略時は _model_prices
+    "price_output_per_1k": float,
+}
+
+# プロファイルで単価を指定しない場合の参考単価（USD/1Kトークン、オンデマンド）。モデルIDの部分一致
+_MODEL_PRICES: Tuple[Tuple[str, float, float], ...] = (
+    ("deepseek.r1", 0.00135, 0.0054),
+    ("amazon.nova-micro", 0.000035, 0.00014),
+    ("amazon.nova-lite", 0.00006, 0.00024),
+    ("amazon.nova-pro", 0.0008, 0.0032),
+    ("anthropic.claude-3-5-haiku", 0.0008, 0.004),
+    ("anthropic.claude-haiku-4-5", 0.001, 0.005),
+    ("anthropic.claude-3-7-sonnet", 0.003, 0.015),
+    ("anthropic.claude-sonnet-4", 0.003, 0.015),
+    ("anthropic.claude-opus-4", 0.015, 0.075),
+)
+
+_DEFAULT_GENERATION_PROFILES: Dict[str, Dict[str, Any]] = {
+    "default": {"model_id": MODEL_ID, "max_tokens": MAX_TOKENS, "temperature": TEMPERATURE,
+                "stop_sequences": [], "latency_target_ms": 0},
+    # 3行の要約・短いレポートに戦略分析用の上限は不要（DeepSeek-R1 は推論にも出力トークンを使うため余裕は残す）
+    "text": {"max_tokens": min(MAX_TOKENS, 2000)},
+    "markdown": {"max_tokens": min(MAX_TOKENS, 4000)},
+}
+
+def _load_generation_profiles(raw: str) -> Dict[str, Dict[str, Any]]:
+    profiles = {name: dict(fields) for name, fields in _DEFAULT_GENERATION_PROFILES.items()}
+    raw = raw.strip()
+    if not raw:
+        return profiles
+    try:
+        if not raw.startswith("{"):
+            with open(raw, encoding="utf-8") as f:
+                raw = f.read()
+        custom = json.loads(raw)
+    except (OSError, ValueError) as e:
+        logger.warning(f"GENERATION_PROFILES ignored: {str(e)}")
+        return profiles
+    for name, fields in (custom.items() if isinstance(custom, dict) else ()):
+        if not isinstance(fields, dict):
+            continue
+        profile = profiles.setdefault(str(name).lower(), {})
+        for key, value in fields.items():
+            try:
+                profile[key] = _PROFILE_FIELDS[key](value)
+            except (KeyError, TypeError, ValueError):
+                logger.warning(f"GENERATION_PROFILES: ignored {name}.{key}={value!r}")
+    return profiles
+
+_GENERATION_PROFILES = _load_generation_profiles(GENERATION_PROFILES)
+
+def _generation_profile(fmt: str = "", analysis_type: str = "") -> Dict[str, Any]:
+    """形式・分析タイプに対応する生成設定（model_id / max_tokens / temperature / stop_sequences / latency_target_ms）"""
+    fmt, analysis_type = (fmt or "").lower(), (analysis_type or "").lower()
+    profile: Dict[str, Any] = {}
+    for name in ("default", fmt, analysis_type, f"{fmt}:{analysis_type}"):
+        profile.update(_GENERATION_PROFILES.get(name, {}))
+    return profile
+
+def _model_prices(profile: Dict[str, Any]) -> Tuple[float, float]:
+    """コスト見積もりの単価 (入力, 出力)。プロファイルの指定 > 既定モデルは PRICE_*_PER_1K > _MODEL_PRICES"""
+    model_id = profile.get("model_id") or MODEL_ID
+    if model_id == MODEL_ID:
+        price_in, price_out = PRICE_INPUT_PER_1K, PRICE_OUTPUT_PER_1K
+    else:
+        known = next(((i, o) for family, i, o in _MODEL_PRICES if family in model_id), None)
+        if known is None:
+            logger.warning(f"No price for {model_id}; estimating cost with PRICE_*_PER_1K")
+            known = (PRICE_INPUT_PER_1K, PRICE_OUTPUT_PER_1K)
+        price_in, price_out = known
+    return (float(profile.get("price_input_per_1k", price_in)), float(profile.get("price_output_per_1k", price_out)))
+
+# ====== LLM result cache ======
+# 同じデータ・形式・分析タイプでの再実行（ボタンの再クリック等）は同一プロンプトになるため、
+# モデルID・システムプロンプト・プロンプト・temperature・maxTokens のハッシュをキーに応答テキストを
+# キャッシュする。メモリ層（LRU+TTL）の後ろに永続層（SQLite または DynamoDB）を任意で置ける。
+def _llm_cache_key(model_id: str, prompt: str, temperature: float, max_tokens: int, tool_name: str = "",
+                   stop_sequences: Optional[List[str]] = None) -> str:
+    parts: List[Any] = [model_id, _SYSTEM_JA, prompt, temperature, max_tokens]
+    if tool_name:  # tool use の応答はツール入力のJSONなので別エントリにする
+        parts.append(tool_name)
+    if stop_sequences:
+        parts.append(stop_sequences)
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class _MemoryCacheTier:
+    """プロセス内LRU（有効期限付き）"""
+    name = "memory"
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[str]:
+        hit = self.entries.get(key)
+        if hit is None:
+            return None
+        if hit[0] <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return hit[1]
+
+    def put(self, key: str, value: str, expires_at: float) -> None:
+        self.entries[key] = (expires_at, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+class _SQLiteCacheTier:
+    """ローカルSQLiteファイル（テスト・単一コンテナ用）。件数超過時は最終アクセスの古い順に削除"""
+    name = "sqlite"
+
+    def __init__(self, path: str, maxsize: int):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS llm_cache ("
+                          "cache_key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT value, expires_at FROM llm_cache WHERE cache_key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                self.conn.execute("DELETE FROM llm_cache WHERE cache_key = ?", (key,))
+                return None
+            self.conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE cache_key = ?", (now, key))
+            return row[0]
+
+    def put(self, key: str, value: str, expires_at: float) -> None:
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?)", (key, value, expires_at, now))
+            self.conn.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (now,))
+            self.conn.execute("DELETE FROM llm_cache WHERE cache_key IN (SELECT cache_key FROM llm_cache "
+                              "ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)", (self.maxsize,))
+
+class _DynamoCacheTier:
+    """DynamoDB（GetItem/PutItem のみ使用）。client は boto3 の dynamodb クライアント、または同じ
+    インターフェースを持つローカル代替（DynamoDB Local なら AWS_ENDPOINT_URL_DYNAMODB で向け先を変更）。
+    期限切れの削除はテーブルのTTL設定（expires_at）に任せ、読み出し時にも期限を確認する。"""
+    name = "dynamodb"
+    MAX_ITEM_CHARS = 300_000  # DynamoDBの1項目上限（400KB）に余裕を持たせる
+
+    def __init__(self, table: str, client: Any = None):
+        self.table = table
+        self.client = client
+
+    def _client(self) -> Any:
+        if self.client is None:
+            self.client = _aws_client("dynamodb", REGION)
+        return self.client
+
+    def get(self, key: str) -> Optional[str]:
+        item = self._client().get_item(TableName=self.table, Key={"cache_key": {"S": key}}).get("Item")
+        if not item or float(item["expires_at"]["N"]) <= time.time():
+            return None
+        return item["value"]["S"]
+
+    def put(self, key: str, value: str, expires_at: float) -> None:
+        if len(value) > self.MAX_ITEM_CHARS:
+            return
+        self._client().put_item(TableName=self.table, Item={
+            "cache_key": {"S": key},
+            "value": {"S": value},
+            "expires_at": {"N": str(int(expires_at))},
+        })
+
+class _LLMCache:
+    """メモリ層 + 任意の永続層。永続層でヒットした値はメモリ層にも載せる。
+    永続層の障害はキャッシュミスとして扱い、分析自体は止めない。"""
+
+    def __init__(self, ttl: int, memory: _MemoryCacheTier, persistent: Any = None):
+        self.ttl = ttl
+        self.memory = memory
+        self.persistent = persistent
+
+    def get(self, key: str) -> Tuple[Optional[str], Optional[str]]:
+        """(値, ヒットした層の名前) を返す。ミスなら (None, None)"""
+        value = self.memory.get(key)
+        if value is not None:
+            return value, self.memory.name
+        if self.persistent is not None:
+            try:
+                value = self.persistent.get(key)
+            except Exception as e:
+                logger.warning(f"LLM cache ({self.persistent.name}) get failed: {str(e)}")
+                value = None
+            if value is not None:
+                self.memory.put(key, value, time.time() + self.ttl)
+                return value, self.persistent.name
+        return None, None
+
+    def put(self, key: str, value: str) -> None:
+        expires_at = time.time() + self.ttl
+        self.memory.put(key, value, expires_at)
+        if self.persistent is not None:
+            try:
+                self.persistent.put(key, value, expires_at)
+            except Exception as e:
+                logger.warning(f"LLM cache ({self.persistent.name}) put failed: {str(e)}")
 
-def _bedrock_converse(model_id: str, region: str, prompt: str) -> str:
-    client = boto3.client("bedrock-runtime", region_name=region)
-    system_ja = [{
-        "text": """【戦略コンサルタント級AIプラットフォーム - エンタープライズ仕様】
+def _make_llm_cache() -> _LLMCache:
+    persistent: Any = None
+    try:
+        if LLM_CACHE_BACKEND == "sqlite":
+            persistent = _SQLiteCacheTier(LLM_CACHE_SQLITE, LLM_CACHE_SIZE)
+        elif LLM_CACHE_BACKEND == "dynamodb" and LLM_CACHE_TABLE:
+            persistent = _DynamoCacheTier(LLM_CACHE_TABLE)
+    except Exception as e:
+        logger.warning(f"LLM cache backend '{LLM_CACHE_BACKEND}' unavailable, using memory only: {str(e)}")
+    return _LLMCache(LLM_CACHE_TTL, _MemoryCacheTier(LLM_CACHE_SIZE), persistent)
+
+_LLM_CACHE = _make_llm_cache()
+
+# 最後まで生成された応答だけをキャッシュする（max_tokens で切れた応答などは再実行のたびに返さない）
+_CACHEABLE_STOP_REASONS = ("end_turn", "tool_use", "stop_sequence")
+
+def _cache_store(status: Dict[str, Any], text: str) -> None:
+    """_converse_cached(defer_store=True) で保留した応答を、呼び出し側の検証後に保存する"""
+    key = status.pop("store", None)
+    if key and text:
+        _LLM_CACHE.put(key, text)
+
+def _converse_cached(model_id: str, region: str, prompt: str,
+                     on_text: Optional[Callable[[str], None]] = None,
+                     use_cache: bool = True, max_tokens: Optional[int] = None,
+                     tool: Optional[Dict[str, Any]] = None,
+                     profile: Optional[Dict[str, Any]] = None,
+                     timeout_s: Optional[float] = None,
+                     defer_store: bool = False,
+                     key_max_tokens: Optional[int] = None) -> Tuple[str, Dict[str, Any]]:
+    """_bedrock_converse（on_text 指定時は _bedrock_converse_stream）の前段キャッシュ
+    戻り値は (応答テキスト, キャッシュ状況)。ストリーミングでヒットした場合は全文を1つの差分として渡す
+    defer_store=True なら保存せず status["store"] にキーを残す（JSONの検証後に _cache_store で保存）
+    key_max_tokens はキャッシュキーに使う出力上限（期限で max_tokens を下げてもキーを変えない）"""
+    if not use_cache or LLM_CACHE_TTL <= 0:
+        status = {"status": "bypass"}
+    else:
+        p = profile or {}
+        key = _llm_cache_key(model_id, prompt, p.get("temperature", TEMPERATURE),
+                             key_max_tokens or max_tokens or p.get("max_tokens") or MAX_TOKENS,
+                             tool["toolSpec"]["name"] if tool else "", p.get("stop_sequences"))
+        value, tier = _LLM_CACHE.get(key)
+        if value is not None:
+            if on_text is not None:
+                on_text(value)
+            return value, {"status": "hit", "tier": tier, "key": key[:16]}
+        status = {"status": "miss", "key": key[:16]}
+    usage: Dict[str, Any] = {}
+    if on_text is not None:
+        text = _bedrock_converse_stream(model_id, region, prompt, on_text, max_tokens, usage, tool, profile, timeout_s)
+    else:
+        text = _bedrock_converse(model_id, region, prompt, max_tokens, usage, tool, profile, timeout_s)
+    stop_reason = usage.pop("stop_reason", "")
+    if usage.pop("deadline_cut", 0):
+        status["deadline_cut"] = True  # 途中までの応答はキャッシュしない
+    elif stop_reason not in _CACHEABLE_STOP_REASONS:
+        status["stop_reason"] = stop_reason or "unknown"
+    if usage:
+        status["usage"] = usage
+        logger.info(f"Bedrock usage: {usage}")
+    if status["status"] == "miss" and text and not status.get("deadline_cut") and "stop_reason" not in status:
+        status["store"] = key
+        if not defer_store:
+            _cache_store(status, text)
+    return text, status
+
+# Bedrock に渡すシステムプロンプト（converse / converse_stream 共通）
+_SYSTEM_JA = [{
+    "text": """【戦略コンサルタント級AIプラットフォーム - エンタープライズ仕様】
 
 あなたはマッキンゼー・BCG・ベインレベルの戦略コンサルタントです。日本企業の経営課題に対して、以下の専門性で最高水準の分析を提供してください：
 
@@ -725,25 +2917,161 @@ def _bedrock_converse(model_id: str, region: str, prompt: str) -> str:
 • 日本企業特有の組織文化・商慣習を考慮した現実的提案
 
 あなたの分析は経営陣の戦略意思決定に直接影響する重要な成果物です。妥協のない最高水準の品質で応答してください。"""
-    }]
-    resp = client.converse(
-        modelId=model_id,
-        system=system_ja,
-        messages=[{"role": "user", "content": [{"text": prompt}]}],
-        inferenceConfig={"maxTokens": MAX_TOKENS, "temperature": TEMPERATURE}
-    )
+}]
+
+# プロンプトのうち、統計・サンプルより前（指示文・スキーマ）はデータタイプと出力形式ごとに固定。
+# その境界に Bedrock のキャッシュポイントを置き、固定部分の再処理を省く（対応モデルのみ）。
+_PROMPT_DATA_ANCHORS = ("【ANALYSIS TARGET DATA】", "# 統計要約", "[統計要約]")
+_CACHE_POINT = {"cachePoint": {"type": "default"}}
+
+# auto 設定時に Converse の各機能を使うモデル（モデルIDの部分一致）。DeepSeek-R1 はどちらも非対応
+# プロンプトキャッシュは対応モデルのIDを列挙する（claude-3-haiku / claude-3-sonnet などは cachePoint を送ると失敗する）
+_PROMPT_CACHE_MODELS = (
+    "anthropic.claude-3-5-haiku-20241022-v1:0",
+    "anthropic.claude-3-7-sonnet-20250219-v1:0",
+    "anthropic.claude-sonnet-4-20250514-v1:0",
+    "anthropic.claude-sonnet-4-5-20250929-v1:0",
+    "anthropic.claude-haiku-4-5-20251001-v1:0",
+    "anthropic.claude-opus-4-20250514-v1:0",
+    "anthropic.claude-opus-4-1-20250805-v1:0",
+    "amazon.nova-micro-v1:0",
+    "amazon.nova-lite-v1:0",
+    "amazon.nova-pro-v1:0",
+    "amazon.nova-premier-v1:0",
+)
+# toolChoice any（ツール呼び出しの強制）を受け付けるのは Claude / Nova / Mistral Large のみ
+# （Llama 3.1・Command R はツール自体は使えるが any を指定すると ValidationException になる）
+_TOOL_USE_MODELS     = ("anthropic.claude", "amazon.nova", "mistral.mistral-large")
+
+def _converse_feature_enabled(setting: str, model_id: str, families: Tuple[str, ...]) -> bool:
+    if setting in ("1", "true", "on"):
+        return True
+    if setting in ("0", "false", "off"):
+        return False
+    return any(f in model_id for f in families)
+
+def _prompt_cache_enabled(model_id: str) -> bool:
+    return _converse_feature_enabled(PROMPT_CACHE, model_id, _PROMPT_CACHE_MODELS)
+
+def _structured_output_enabled(model_id: str) -> bool:
+    return _converse_feature_enabled(STRUCTURED_OUTPUT, model_id, _TOOL_USE_MODELS)
+
+def _split_prompt(prompt: str) -> Tuple[str, str]:
+    """(固定の前半, リクエストごとの後半) に分ける。境界が見つからなければ全体を後半とする
+    境界は最初の出現位置（アップロードデータ中に同じ文字列があっても境界をデータ側へずらさない）"""
+    for anchor in _PROMPT_DATA_ANCHORS:
+        i = prompt.find(anchor)
+        if i > 0:
+            return prompt[:i], prompt[i:]
+    return "", prompt
+
+def _converse_request(model_id: str, prompt: str, max_tokens: Optional[int] = None,
+                      tool: Optional[Dict[str, Any]] = None, profile: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """converse / converse_stream に渡す引数（クライアントなしで組み立て・検証できる）
+    tool を指定するとそのツールの呼び出しを強制し、応答をツール入力（JSONスキーマ準拠）として受け取る。
+    profile（_generation_profile）の max_tokens / temperature / stop_sequences を推論設定に使う"""
+    profile = profile or {}
+    system: List[Dict[str, Any]] = list(_SYSTEM_JA)
+    content: List[Dict[str, Any]] = [{"text": prompt}]
+    if _prompt_cache_enabled(model_id):
+        static, dynamic = _split_prompt(prompt)
+        system.append(_CACHE_POINT)
+        if static:
+            content = [{"text": static}, _CACHE_POINT, {"text": dynamic}]
+    req = {
+        "modelId": model_id,
+        "system": system,
+        "messages": [{"role": "user", "content": content}],
+        "inferenceConfig": {"maxTokens": max_tokens or profile.get("max_tokens") or MAX_TOKENS,
+                            "temperature": profile.get("temperature", TEMPERATURE)},
+    }
+    if profile.get("stop_sequences"):
+        req["inferenceConfig"]["stopSequences"] = list(profile["stop_sequences"])
+    if tool is not None:
+        req["toolConfig"] = {"tools": [tool], "toolChoice": {"any": {}}}
+    return req
+
+def _usage_summary(usage: Dict[str, Any]) -> Dict[str, int]:
+    """Bedrock の usage から入出力とプロンプトキャッシュの読み書きトークン数を取り出す"""
+    keys = ("inputTokens", "outputTokens", "cacheReadInputTokens", "cacheWriteInputTokens")
+    return {k: int(usage.get(k, 0) or 0) for k in keys}
+
+def _tool_input_text(raw: Any) -> str:
+    """ツール入力を JSON 文字列にそろえる（converse は dict、converse_stream は文字列の断片で届く）"""
+    if isinstance(raw, str):
+        try:
+            raw = json.loads(raw)
+        except ValueError:
+            return raw.strip()
+    return json.dumps(raw, ensure_ascii=False)
+
+def _bedrock_converse(model_id: str, region: str, prompt: str, max_tokens: Optional[int] = None,
+                      usage: Optional[Dict[str, Any]] = None, tool: Optional[Dict[str, Any]] = None,
+                      profile: Optional[Dict[str, Any]] = None, timeout_s: Optional[float] = None) -> str:
+    client = _aws_client("bedrock-runtime", region, timeout_s is not None)
+    resp = client.converse(**_converse_request(model_id, prompt, max_tokens, tool, profile))
+    if usage is not None:
+        usage.update(_usage_summary(resp.get("usage") or {}))
+        usage["stop_reason"] = resp.get("stopReason", "")
     msg = resp.get("output", {}).get("message", {})
     parts = msg.get("content", [])
+    tool_inputs = [p["toolUse"].get("input", {}) for p in parts if "toolUse" in p]
+    if tool_inputs:
+        return _tool_input_text(tool_inputs[0])
     txts = []
     for p in parts:
         if "text" in p:  # DeepSeekのreasoningContentは無視
             txts.append(p["text"])
     return "\n".join([t for t in txts if t]).strip()
 
+def _bedrock_converse_stream(model_id: str, region: str, prompt: str, on_text: Callable[[str], None],
+                             max_tokens: Optional[int] = None, usage: Optional[Dict[str, Any]] = None,
+                             tool: Optional[Dict[str, Any]] = None, profile: Optional[Dict[str, Any]] = None,
+                             timeout_s: Optional[float] = None) -> str:
+    """converse_stream 版。本文（tool 指定時はツール入力のJSON）の差分を届いた順に on_text へ渡し、
+    最後に _bedrock_converse と同じ形の全文を返す（DeepSeekのreasoningContentの差分は無視）
+    timeout_s を過ぎたら受信を打ち切り、それまでの部分を返す（usage に deadline_cut を立てる）"""
+    client = _aws_client("bedrock-runtime", region, timeout_s is not None)
+    resp = client.converse_stream(**_converse_request(model_id, prompt, max_tokens, tool, profile))
+    started = time.monotonic()
+    blocks: Dict[int, List[str]] = {}
+    tool_blocks: Dict[int, List[str]] = {}
+    expires = started + timeout_s if timeout_s is not None else None
+    for event in resp["stream"]:
+        if expires is not None and time.monotonic() > expires:
+            logger.warning(f"Bedrock stream: cut at deadline after {int((time.monotonic() - started) * 1000)} ms")
+            if usage is not None:
+                usage["deadline_cut"] = 1
+            if hasattr(resp["stream"], "close"):
+                resp["stream"].close()  # 残りの受信を打ち切る
+            break
+        if usage is not None and "metadata" in event:
+            usage.update(_usage_summary(event["metadata"].get("usage") or {}))
+        if usage is not None and "messageStop" in event:
+            usage["stop_reason"] = event["messageStop"].get("stopReason", "")
+        delta = event.get("contentBlockDelta")
+        if not delta:
+            continue
+        text = delta.get("delta", {}).get("text")
+        target = blocks
+        if text is None:
+            text = delta.get("delta", {}).get("toolUse", {}).get("input")
+            target = tool_blocks
+        if text:
+            if not blocks and not tool_blocks:
+                logger.info(f"Bedrock stream: first token after {int((time.monotonic() - started) * 1000)} ms")
+            target.setdefault(delta.get("contentBlockIndex", 0), []).append(text)
+            on_text(text)
+    logger.info(f"Bedrock stream: completed after {int((time.monotonic() - started) * 1000)} ms")
+    if tool_blocks:
+        return _tool_input_text("".join(tool_blocks[min(tool_blocks)]))
+    txts = ["".join(blocks[i]) for i in sorted(blocks)]
+    return "\n".join([t for t in txts if t]).strip()
+
 def _process_image_with_textract(image_data: str, mime_type: str) -> str:
     """AWS Textractを使用して画像からテキストを抽出"""
     try:
-        textract = boto3.client('textract', region_name=REGION)
+        textract = _aws_client("textract", REGION)
         
         # Base64デコード
         image_bytes = base64.b64decode(image_data)
@@ -803,7 +3131,8 @@ def _analyze_document_image(image_data: str, mime_type: str, analysis_type: str)
 """
         
         # Bedrockで分析実行
-        analysis_result = _bedrock_converse(MODEL_ID, REGION, prompt)
+        profile = _generation_profile("", analysis_type)
+        analysis_result = _bedrock_converse(profile["model_id"], REGION, prompt, profile=profile)
         
         return f"""📄 **書類画像分析結果**
 
@@ -937,6 +3266,9 @@ def process_sentry_webhook(data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
 
 # ====== Handler ======
 def lambda_handler(event, context):
+    # 各段階（解析・集計・プロンプト・LLM）の期限はLambdaの残り時間から決める
+    deadline = _Deadline(context)
+
     # Early echo（必要時のみ）
     echo = _early_echo(event)
     if echo is not None:
@@ -967,6 +3299,7 @@ def lambda_handler(event, context):
             "format": "json", "message": "INVALID_JSON", "engine": "bedrock", "model": MODEL_ID
         })
 
+    deadline.checkpoint("request")
     # デバッグ: 受信データの構造をログ出力
     logger.info(f"🔍 受信データの構造: {list(data.keys())}")
     
@@ -975,9 +3308,18 @@ def lambda_handler(event, context):
     if sentry_response is not None:
         return sentry_response
 
+    # SSE形式（stream=true）: 生成テキストの差分を delta イベント、最終的な応答本文（エラーを含む）を final イベントで返す
+    # Lambda側でバッファしてから返すため、逐次配信（最初のトークンまでの短縮）にはならない（response_sse 参照）
+    stream_events: Optional[List[str]] = [] if data.get("stream") else None
+
     # Inputs
     instruction = (data.get("instruction") or data.get("prompt") or "").strip()
     fmt = (data.get("responseFormat") or DEFAULT_FORMAT or "json").lower()
+    # 複数形式（responseFormats）: 1回のモデル呼び出しで各形式の応答をまとめて返す（先頭が主形式）
+    formats = _parse_response_formats(data.get("responseFormats"))
+    if formats:
+        fmt = formats[0]
+    multi = len(formats) > 1
     requested_analysis_type = data.get("analysisType", "").strip()
     
     # 画像処理の分岐（document分析 または fileType='image'）
@@ -986,16 +3328,16 @@ def lambda_handler(event, context):
         mime_type = data.get("mimeType", "image/jpeg")
         
         if not image_data:
-            return response_json(400, {
+            return _respond(400, {
                 "response": {"summary": "画像データが含まれていません", "key_insights": [], "recommendations": []},
                 "format": "json", "message": "Missing image data"
-            })
+            }, stream_events)
         
         try:
             logger.info("Starting image analysis")
             analysis_result = _analyze_document_image(image_data, mime_type, requested_analysis_type)
             
-            return response_json(200, {
+            return _respond(200, {
                 "response": {
                     "summary": analysis_result,
                     "key_insights": ["画像からテキスト抽出完了", "AI分析実行済み"],
@@ -1003,14 +3345,14 @@ def lambda_handler(event, context):
                     "data_analysis": {"total_records": 1, "document_type": "image"}
                 },
                 "format": "json", "message": "Image analysis completed", "engine": "bedrock+textract", "model": MODEL_ID
-            })
+            }, stream_events)
             
         except Exception as e:
             logger.error(f"Image analysis error: {str(e)}")
-            return response_json(500, {
+            return _respond(500, {
                 "response": {"summary": f"画像分析エラー: {str(e)}", "key_insights": [], "recommendations": []},
                 "format": "json", "message": "Image analysis failed"
-            })
+            }, stream_events)
     
     # FORCE_JA option
     force_ja = os.environ.get("FORCE_JA","false").lower() in ("1","true")
@@ -1018,22 +3360,75 @@ def lambda_handler(event, context):
         instruction = ("日本語のみで、数値は半角。KPI・要点・トレンドを簡潔に。" + (" " + instruction if instruction else ""))
 
     # Prefer salesData (array). Optionally accept csv.
-    sales: List[Dict[str, Any]] = []
+    # いずれも列指向テーブルへ格納し、以降は列単位で参照する（csvは行dictを作らない）
+    table: Optional[_ColumnarTable] = None
+    stats: Optional[Dict[str, Any]] = None
+    # 分布スケッチ（列別の概算ユニーク数・分位点）: 環境変数またはリクエストで有効化
+    want_sketches = STATS_SKETCHES or bool(data.get("statsSketches"))
+    # 時系列の粒度: リクエストの timeBucket（day/week/month/fiscal）を優先
+    ts_bucket = str(data.get("timeBucket") or TS_BUCKET).lower()
+    if ts_bucket not in TS_BUCKETS:
+        ts_bucket = "day"
+    head: List[Dict[str, Any]] = []
     if isinstance(data.get("salesData"), list):
-        sales = data["salesData"]
+        table = _ColumnarTable.from_rows(data["salesData"])
     elif isinstance(data.get("csv"), str):
-        sales = _parse_csv_simple(data["csv"])
+        csv_text = data["csv"]
+        if _should_parallelize(csv_text):
+            # 大きなcsvは複数コアで並列集計（サンプルはファイル全体の等間隔の候補から層別に選ぶ）
+            try:
+                candidates: List[Dict[str, Any]] = []
+                stats = _parallel_csv_stats(csv_text, sketches=want_sketches, bucket=ts_bucket,
+                                            timeout=deadline.timeout_s(),
+                                            sample=candidates if SAMPLE_MODE != "head" else None)
+                if candidates:
+                    head = _representative_sample(_ColumnarTable.from_rows(candidates), SAMPLE_ROWS)
+                else:
+                    head = list(islice(_iter_csv_rows(csv_text), SAMPLE_ROWS))
+                logger.info(f"Parallel stats: {stats['total_rows']} rows, workers={PARALLEL_WORKERS}")
+            except TimeoutError as e:
+                # 単一プロセスでやり直す時間は無い
+                logger.warning(f"Parallel stats hit the deadline: {str(e)}")
+                return _respond(504, {
+                    "response": {"summary": "DEADLINE_EXCEEDED: 時間内に集計を完了できませんでした", "key_insights": [],
+                                 "recommendations": [], "data_analysis": {"total_records": 0}},
+                    "format": fmt, "message": "DEADLINE_EXCEEDED", "engine": "bedrock", "model": MODEL_ID,
+                    "timing": deadline.info()
+                }, stream_events)
+            except Exception as e:
+                logger.warning(f"Parallel stats failed, falling back to single process: {str(e)}")
+                stats = None
+        if stats is None:
+            table = _ColumnarTable.from_csv(csv_text)
     # 最終フォールバック（稀に data/rows で来る場合）
     elif isinstance(data.get("rows"), list):
-        sales = data["rows"]
+        table = _ColumnarTable.from_rows(data["rows"])
     elif isinstance(data.get("data"), list):
-        sales = data["data"]
-
-    columns = list(sales[0].keys()) if sales else []
-    total = len(sales)
+        table = _ColumnarTable.from_rows(data["data"])
+
+    deadline.checkpoint("parse")
+
+    if stats is None:
+        table = table if table is not None else _ColumnarTable([])
+        head = _representative_sample(table, SAMPLE_ROWS)
+        stats = _compute_stats(table, sketches=want_sketches, bucket=ts_bucket)
+    deadline.checkpoint("stats")
+    columns = list(head[0].keys()) if head else []
+    total = stats["total_rows"]
+    # 時系列はプロンプト・応答用に TS_MAX_POINTS 点まで縮約（fullTimeseries=true で全点）
+    full_timeseries = stats.get("timeseries", [])
+    if not data.get("fullTimeseries"):
+        try:
+            max_points = max(0, int(data.get("maxTimeseriesPoints") or 0))
+        except (TypeError, ValueError):
+            max_points = 0  # 整数でなければ TS_MAX_POINTS
+        trend_view, ts_info = _downsample_timeseries(full_timeseries, max_points)
+        if ts_info is not None:
+            stats = {**stats, "timeseries": trend_view, "timeseries_downsampled": ts_info}
 
     # まずデータタイプを自動判別
-    detected_data_type = _identify_data_type(columns, sales[:5] if sales else [])
+    detected_data_type = _identify_data_type_cached(columns, head[:5])
+    logger.info(f"Header cache: {_HEADER_CACHE.info()}")
     
     # 適合性チェック（フロントエンドから分析タイプが指定されている場合）
     if requested_analysis_type:
@@ -1041,7 +3436,7 @@ def lambda_handler(event, context):
         
         if not is_compatible:
             # 不適合の場合はエラーレスポンスを返す
-            return response_json(200, {
+            return _respond(200, {
                 "response": {
                     "summary_ai": error_message,
                     "presentation_md": error_message,
@@ -1055,7 +3450,7 @@ def lambda_handler(event, context):
                 "format": fmt,
                 "message": "DATA_TYPE_MISMATCH",
                 "model": MODEL_ID
-            })
+            }, stream_events)
         
         # 適合している場合は要求された分析タイプを使用
         type_mapping = {
@@ -1069,50 +3464,107 @@ def lambda_handler(event, context):
         # 分析タイプが指定されていない場合は自動判別結果を使用
         data_type = detected_data_type
     
-    stats = _compute_stats(sales)
-    sample = sales[:50] if sales else []
+    sample = head
 
-    # データタイプ別プロンプト構築
-    if fmt == "markdown":
-        prompt = _build_prompt_markdown(stats, sample, data_type)
+    # データタイプ別プロンプト構築（入力トークン予算に収まるよう低優先の要素から縮約）
+    if multi:
+        build_prompt = lambda st, sa, dt, enc: _build_prompt_json(st, sa, dt, enc, formats)
+    elif fmt == "markdown":
+        build_prompt = _build_prompt_markdown
     elif fmt == "text":
-        prompt = _build_prompt_text(stats, sample, data_type)
+        build_prompt = _build_prompt_text
     else:
-        prompt = _build_prompt_json(stats, sample, data_type)
-
-    # LLM call
+        build_prompt = _build_prompt_json
+    # サンプル・時系列の埋め込み形式（リクエストの promptDataFormat を優先）
+    encoding = str(data.get("promptDataFormat") or PROMPT_DATA_FORMAT).lower()
+    if encoding not in PROMPT_DATA_FORMATS:
+        encoding = "json"
+    prompt, prompt_budget = _assemble_prompt(build_prompt, stats, sample, data_type, encoding=encoding)
+    # モデルへの出力形式（複数形式は JSON で受け取って振り分ける）と、それに応じた生成設定
+    call_fmt = "json" if multi else fmt
+    profile = _generation_profile(call_fmt, requested_analysis_type)
+    model_id = profile["model_id"]
+    deadline.checkpoint("prompt")
+    preflight = _preflight(prompt_budget["input_tokens"], profile["max_tokens"], _model_prices(profile))
+    # 出力上限は残り時間でも抑える（Bedrock に送る値だけ。キャッシュキーは残り時間に依らない requested_tokens）
+    # 最低限の出力も間に合わなければLLMを呼ばず集計結果だけを返す
+    requested_tokens = preflight["max_output_tokens"]
+    max_tokens = deadline.output_tokens(requested_tokens)
+    stats_only = "deadline" if max_tokens < min(MIN_OUTPUT_TOKENS, requested_tokens) else ""
+    if max_tokens < requested_tokens:
+        preflight.update(max_output_tokens=max_tokens, limited_by_deadline=True,
+                         cost_usd_est=_preflight(prompt_budget["input_tokens"], max_tokens,
+                                                 _model_prices(profile))["cost_usd_est"])
+    preflight["prompt"] = prompt_budget
+    logger.info(f"Preflight: {json.dumps(preflight, ensure_ascii=False)}")
+    if not stats_only and (not prompt_budget["within_budget"] or preflight["decision"] == "reject"):
+        reason = "PROMPT_TOO_LARGE" if not prompt_budget["within_budget"] else "COST_LIMIT_EXCEEDED"
+        return _respond(413, {
+            "response": {"summary": f"{reason}: 推定入力 {prompt_budget['input_tokens']} トークン / 推定コスト ${preflight['cost_usd_est']}",
+                         "key_insights": [], "recommendations": [], "data_analysis": {"total_records": total}},
+            "format": fmt, "message": reason, "engine": "bedrock", "model": model_id, "preflight": preflight
+        }, stream_events)
+
+    # LLM call（同一プロンプトはキャッシュから返す。noCache=true で無効化）
+    cache_status: Dict[str, Any] = {"status": "bypass" if data.get("noCache") else "miss"}
     summary_ai = ""
     findings: List[str] = []
     kpis  = {"total_sales": stats.get("total_sales", 0.0), "top_products": stats.get("top_products", [])}
     trend = stats.get("timeseries", [])
+    format_texts: Dict[str, str] = {}
+    # JSON形式は対応モデルなら tool use でスキーマ準拠の出力を受け取る
+    tool = _analysis_tool(formats) if call_fmt == "json" and _structured_output_enabled(model_id) else None
+    structured: Optional[Dict[str, Any]] = None
+    started = time.monotonic()
 
-    try:
-        ai_text = _bedrock_converse(MODEL_ID, REGION, prompt)
-        if fmt == "json":
-            # JSON想定。フェンス除去・部分抽出に軽く対応
-            text = ai_text.strip()
-            if text.startswith("```"):
-                # ```json ... ``` のケースを剥がす
-                text = text.strip("`").lstrip("json").strip()
-            try:
-                ai_json = json.loads(text)
-            except Exception:
-                # 最後の手段：先頭～末尾の最初の{}を探す
-                start = text.find("{"); end = text.rfind("}")
-                if start != -1 and end != -1 and end > start:
-                    try: ai_json = json.loads(text[start:end+1])
-                    except Exception: ai_json = {"overview": ai_text}
-                else:
-                    ai_json = {"overview": ai_text}
-            summary_ai = ai_json.get("overview", "")
-            findings   = ai_json.get("findings", [])
-            kpis       = ai_json.get("kpis", kpis)
-            trend      = ai_json.get("trend", trend)
-        else:
-            summary_ai = ai_text
-    except Exception as e:
-        logger.exception("Bedrock error")
-        summary_ai = f"(Bedrock error: {str(e)})"
+    if not stats_only:
+        try:
+            parser = _TolerantJsonParser() if call_fmt == "json" and stream_events is not None else None
+
+            def on_delta(t: str) -> None:
+                stream_events.append(_sse_event("delta", {"text": t}))
+                if parser is not None:
+                    parser.feed(t)  # 受信しながら解析し、終了後に全文を読み直さない
+            on_text = on_delta if stream_events is not None else None
+            ai_text, cache_status = _converse_cached(model_id, REGION, prompt, on_text, use_cache=not data.get("noCache"),
+                                                     max_tokens=preflight["max_output_tokens"], tool=tool, profile=profile,
+                                                     timeout_s=deadline.timeout_s(), defer_store=call_fmt == "json",
+                                                     key_max_tokens=requested_tokens)
+            if call_fmt == "json":
+                ai_json, structured = _structured_analysis(model_id, REGION, ai_text, tool, preflight["max_output_tokens"],
+                                                           use_cache=not data.get("noCache"), parser=parser,
+                                                           formats=formats, profile=profile, deadline=deadline)
+                logger.info(f"Structured output: {structured} / totals {_OUTPUT_STATS.info()}")
+                if structured["valid"] and not structured["repairs"]:
+                    _cache_store(cache_status, ai_text)  # JSONは解析・検証を通った応答だけをキャッシュする
+                summary_ai = ai_json.get("overview", "")
+                findings   = ai_json.get("findings", [])
+                kpis       = ai_json.get("kpis", kpis)
+                trend      = ai_json.get("trend", trend)
+                for f in formats:
+                    if f in _FORMAT_FIELDS:
+                        text = ai_json.get(_FORMAT_FIELDS[f][0])
+                        if not isinstance(text, str) or not text.strip():
+                            text = _derive_format_text(f, ai_json)
+                            structured.setdefault("derived", []).append(f)
+                        format_texts[f] = text
+            else:
+                summary_ai = ai_text
+        except ReadTimeoutError as e:
+            logger.warning(f"Bedrock timed out: {str(e)}")
+            stats_only = "timeout"
+        except Exception as e:
+            logger.exception("Bedrock error")
+            summary_ai = f"(Bedrock error: {str(e)})"
+    deadline.checkpoint("llm")
+    # 生成設定と実測レイテンシ（修正ターンを含む）。目標を超えたらログに残す
+    generation = {"model": model_id, "max_tokens": preflight["max_output_tokens"], "temperature": profile["temperature"],
+                  "latency_ms": int((time.monotonic() - started) * 1000)}
+    if profile.get("latency_target_ms"):
+        generation["latency_target_ms"] = profile["latency_target_ms"]
+        generation["slo_met"] = generation["latency_ms"] <= profile["latency_target_ms"]
+        if not generation["slo_met"]:
+            logger.warning(f"Generation latency over target: {generation} ({call_fmt}/{requested_analysis_type or '-'})")
 
     # presentation_md for enhanced readability
     def _fmt_yen(n):
@@ -1120,7 +3572,7 @@ def lambda_handler(event, context):
         except: return str(n)
 
     # 自然な日本語レポート（presentation_md） - 記号除去
-    trend_list = stats.get('timeseries',[])[:3]
+    trend_list = full_timeseries[:3]
     trend_text = ""
     if trend_list:
         trend_parts = []
@@ -1135,35 +3587,29 @@ def lambda_handler(event, context):
     avg_sales = stats.get('avg_row_sales',0)
     
     presentation_md = f"""{total}件のデータを分析しました。売上合計は{int(total_sales):,}円で、1件あたり平均{int(avg_sales):,}円でした。主な売上は{trend_text}となっています。"""
-
-    # Response - 技術的な部分を最小化
-    if fmt == "markdown" or fmt == "text":
-        # Markdown/Text形式は純粋な日本語のみ
-        body = {
-            "response": {
-                "summary_ai": summary_ai
-            },
-            "format": fmt,
-            "message": "OK",
-            "model": MODEL_ID
-        }
-    else:
-        # JSON形式: 自然な説明群 + 区切り線 + データ証拠
-        separator_line = "---以下は読み込んだデータの証拠です---"
-        body = {
-            "response": {
-                "summary_ai": summary_ai,
-                "presentation_md": presentation_md,
-                "key_insights": findings,
-                "separator": separator_line,
-                "data_analysis": {
-                    "total_records": total,
-                    "kpis": kpis,
-                    "trend": trend
-                }
-            },
-            "format": fmt,
-            "message": "OK",
-            "model": MODEL_ID
-        }
-    return response_json(200, body)
\ No newline at end of file
+    if stats_only:
+        # 時間内にAI分析できなかった場合は集計結果（KPI・トレンド・presentation_md）だけを返す
+        summary_ai, findings, format_texts = presentation_md, [], {}
+
+    # Response
+    responses = {
+        f: _format_response(f, format_texts.get(f, summary_ai), presentation_md, findings, total, kpis, trend, stats)
+        for f in (formats if multi else (fmt,))
+    }
+    body = {"response": responses[fmt], "format": fmt, "message": "STATS_ONLY" if stats_only else "OK", "model": model_id}
+    if multi:
+        body["formats"] = list(formats)
+        body["responses"] = responses
+    usage = cache_status.pop("usage", None)
+    cache_status.pop("store", None)
+    body["cache"] = cache_status
+    body["preflight"] = preflight
+    body["generation"] = generation
+    body["timing"] = deadline.info()
+    if stats_only:
+        body["degraded"] = {"reason": stats_only}
+    if usage:
+        body["usage"] = usage
+    if structured is not None:
+        body["structured_output"] = structured
+    return _respond(200, body, stream_events)
\ No newline at end of file
@@ -0,0 +1,265 @@
+# test_lambda_function.py
+# sap-claude-handler/lambda_function.py の回帰テスト（Bedrock・AWSは呼ばない）
+#   python -m pytest lambda/tests
+
+import json, os, sys
+
+import pytest
+
+HANDLER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sap-claude-handler")
+if HANDLER_DIR not in sys.path:
+    sys.path.insert(0, HANDLER_DIR)
+
+import lambda_function as lf  # noqa: E402
+
+BIG = "99999999999999999999"  # int64 を超える20桁の値
+
+
+def _table(id3: str = "3", sales3: str = "100") -> "lf._ColumnarTable":
+    rows = [{"id": str(i), "product": f"商品{i % 2}", "sales": "100"} for i in range(1, 7)]
+    rows[2].update(id=id3, sales=sales3)
+    return lf._ColumnarTable.from_rows(rows)
+
+
+def test_int_column_overflow_keeps_column_length():
+    table = _table(id3=BIG)
+    assert len(table) == 6
+    assert [r["id"] for r in table.rows()] == ["1", "2", BIG, "4", "5", "6"]
+
+
+def test_int_column_overflow_in_sales_stats():
+    stats = lf._compute_stats(_table(sales3=BIG))
+    assert stats["total_rows"] == 6
+    assert stats["total_sales"] == pytest.approx(sum(p["sales"] for p in stats["top_products"]))
+
+
+def test_tolerant_json_parser_skips_unicode_whitespace():
+    parsed = lf._parse_analysis_json('{"overview": "a",　"findings": ["b"],\f"kpis": {}}')
+    assert parsed.value == {"overview": "a", "findings": ["b"], "kpis": {}}
+    assert not parsed.truncated
+
+
+def test_stream_request_errors_are_sse():
+    event = {"requestContext": {"http": {"method": "POST"}},
+             "body": json.dumps({"stream": True, "analysisType": "document"})}
+    r = lf.lambda_handler(event, None)
+    assert r["statusCode"] == 400
+    assert r["headers"]["Content-Type"].startswith("text/event-stream")
+    assert r["body"].startswith("event: final\ndata: ")
+
+
+def test_prompt_cache_only_for_supported_models():
+    prompt = lf._assemble_prompt(lf._build_prompt_json, {"total_rows": 1}, [{"メモ": "【ANALYSIS TARGET DATA】"}],
+                                 "sales_data")[0]
+    req = lf._converse_request("us.anthropic.claude-3-7-sonnet-20250219-v1:0", prompt)
+    static, _ = lf._split_prompt(prompt)
+    assert req["messages"][0]["content"][0]["text"] == static
+    assert "メモ" not in static
+    req = lf._converse_request("anthropic.claude-3-haiku-20240307-v1:0", prompt)
+    assert "cachePoint" not in json.dumps(req)
+
+
+def test_llm_cache_skips_incomplete_answers(monkeypatch):
+    monkeypatch.setattr(lf, "_LLM_CACHE", lf._LLMCache(60, lf._MemoryCacheTier(8)))
+    cache = lf._LLM_CACHE.memory.entries
+    answers = [("{\"overview\": \"cut", "max_tokens"), ("{}", "end_turn")]
+
+    def fake_converse(model_id, region, prompt, max_tokens=None, usage=None, *args):
+        text, usage["stop_reason"] = answers.pop(0)
+        return text
+    monkeypatch.setattr(lf, "_bedrock_converse", fake_converse)
+    assert lf._converse_cached("m", "r", "p")[1]["stop_reason"] == "max_tokens"
+    assert not cache
+    text, status = lf._converse_cached("m", "r", "p", defer_store=True)
+    assert "store" in status and not cache
+    lf._cache_store(status, text)
+    assert lf._converse_cached("m", "r", "p") == ("{}", {"status": "hit", "tier": "memory", "key": status["key"]})
+
+
+def test_invalid_max_timeseries_points_falls_back(monkeypatch):
+    monkeypatch.setattr(lf, "_bedrock_converse", lambda *args, **kwargs: "OK")
+    rows = [{"日付": f"2025-01-{d:02d}", "商品": "A", "売上": "100"} for d in range(1, 11)]
+    for value in ("abc", "12.5", [3], -1):
+        event = {"requestContext": {"http": {"method": "POST"}},
+                 "body": json.dumps({"salesData": rows, "responseFormat": "text", "noCache": True,
+                                     "maxTimeseriesPoints": value})}
+        assert lf.lambda_handler(event, None)["statusCode"] == 200
+
+
+def test_preflight_prices_follow_profile_model():
+    nova = {"model_id": "us.amazon.nova-micro-v1:0"}
+    assert lf._model_prices({"model_id": lf.MODEL_ID}) == (lf.PRICE_INPUT_PER_1K, lf.PRICE_OUTPUT_PER_1K)
+    assert lf._model_prices(nova) == (0.000035, 0.00014)
+    assert lf._model_prices({**nova, "price_output_per_1k": 0.001}) == (0.000035, 0.001)
+    assert lf._preflight(10_000, 1_000, lf._model_prices(nova))["cost_usd_est"] == 0.00049
+
+
+class _Context:
+    def __init__(self, remaining_ms: int):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self) -> int:
+        return self.remaining_ms
+
+
+def test_llm_cache_hits_across_remaining_times(monkeypatch):
+    monkeypatch.setattr(lf, "_LLM_CACHE", lf._LLMCache(60, lf._MemoryCacheTier(8)))
+    sent = []
+
+    def fake_converse(model_id, region, prompt, max_tokens=None, usage=None, *args):
+        sent.append(max_tokens)
+        usage["stop_reason"] = "end_turn"
+        return "# 分析"
+    monkeypatch.setattr(lf, "_bedrock_converse", fake_converse)
+    rows = [{"日付": "2025-01-01", "商品": "A", "売上": "100"}]
+    event = {"requestContext": {"http": {"method": "POST"}},
+             "body": json.dumps({"salesData": rows, "responseFormat": "markdown"})}
+    first = json.loads(lf.lambda_handler(event, _Context(60_000))["body"])
+    second = json.loads(lf.lambda_handler(event, _Context(50_000))["body"])
+    assert first["preflight"]["limited_by_deadline"]
+    assert sent == [first["preflight"]["max_output_tokens"]] and sent[0] < lf._generation_profile("markdown")["max_tokens"]
+    assert first["cache"]["status"] == "miss"
+    assert second["cache"]["status"] == "hit"
+
+
+def test_deadline_clients_are_reused(monkeypatch):
+    monkeypatch.setattr(lf, "_CLIENTS", {})
+    clients = {id(lf._aws_client("bedrock-runtime", "us-east-1", no_retry=True)) for _ in range(3)}
+    assert len(clients) == 1 and len(lf._CLIENTS) == 1
+    assert lf._aws_client("bedrock-runtime", "us-east-1", no_retry=True).meta.config.retries["total_max_attempts"] == 1
+
+
+def test_stratified_sample_prefix_stays_spread():
+    months = [f"{2024 + m // 12}-{m % 12 + 1:02d}" for m in range(22)]
+    rows = [{"日付": f"{months[i * 22 // 20_000]}-{i % 28 + 1:02d}", "商品": f"P{i % 7}", "地域": f"R{i % 3}",
+             "売上": str(100 + i % 50)} for i in range(20_000)]
+    sample = lf._representative_sample(lf._ColumnarTable.from_rows(rows), 50)
+    for n in (5, 20, 50):
+        seen = {r["日付"][:7] for r in sample[:n]}
+        assert months[0] in seen and months[-1] in seen, n
+
+
+def test_parallel_path_sample_covers_whole_file():
+    months = [f"{2024 + m // 12}-{m % 12 + 1:02d}" for m in range(22)]
+    lines = ["日付,商品,地域,売上"] + [f"{months[i * 22 // 5_000]}-{i % 28 + 1:02d},P{i % 7},R{i % 3},{100 + i % 50}"
+                                  for i in range(5_000)]
+    candidates = []
+    stats = lf._parallel_csv_stats("\n".join(lines), workers=2, sample=candidates)
+    assert stats["total_rows"] == 5_000
+    sample = lf._representative_sample(lf._ColumnarTable.from_rows(candidates), 50)
+    seen = {r["日付"][:7] for r in sample[:5]}
+    assert months[0] in seen and months[-1] in seen
+
+
+_NOTES = ('"改行\n入り"', '"引用符""付き"', "", "通常")
+QUOTED_CSV = "\n".join(
+    ["日付,商品名,売上金額,数量,顧客名,備考"]
+    + [f'2025-{i % 12 + 1:02d}-{i % 28 + 1:02d},"商品{i % 9}, 特価","{(i * 37) % 9000 + 100:,}",{i % 5},顧客{i % 13},'
+       + _NOTES[i % 4] for i in range(600)]
+) + "\n"
+
+
+@pytest.mark.parametrize("workers", [2, 3])
+def test_parallel_stats_match_single_process(workers):
+    path = lf._spool_csv_to_tmp(QUOTED_CSV)
+    try:
+        acc = lf._parallel_csv_stats_file(path, workers)
+    finally:
+        os.remove(path)
+    assert acc.finalize() == lf._compute_stats(lf._ColumnarTable.from_csv(QUOTED_CSV))
+
+
+def test_handler_uses_parallel_path(monkeypatch):
+    monkeypatch.setattr(lf, "PARALLEL_WORKERS", 2)
+    monkeypatch.setattr(lf, "PARALLEL_MIN_BYTES", 0)
+    monkeypatch.setattr(lf, "_bedrock_converse", lambda *args, **kwargs: '{"overview": "OK"}')
+    calls = []
+    parallel = lf._parallel_csv_stats
+    monkeypatch.setattr(lf, "_parallel_csv_stats", lambda *a, **k: calls.append(1) or parallel(*a, **k))
+    event = {"requestContext": {"http": {"method": "POST"}},
+             "body": json.dumps({"csv": QUOTED_CSV, "noCache": True})}
+    body = json.loads(lf.lambda_handler(event, None)["body"])
+    assert calls and body["response"]["data_analysis"]["total_records"] == 600
+
+
+TEST_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "test-data")
+
+
+def _test_data_csvs():
+    params = []
+    for name in sorted(os.listdir(TEST_DATA)):
+        if name.endswith(".csv"):
+            with open(os.path.join(TEST_DATA, name), "rb") as f:
+                raw = f.read()
+            try:
+                text = raw.decode("utf-8-sig")
+            except UnicodeDecodeError:
+                text = raw.decode("cp932")
+            params.append(pytest.param(text, id=name))
+    return params
+
+
+@pytest.mark.skipif(not lf.NUMPY_AVAILABLE, reason="numpy is not installed")
+@pytest.mark.parametrize("text", _test_data_csvs())
+def test_numpy_and_python_stats_match(monkeypatch, text):
+    results = []
+    for backend in ("numpy", "python"):
+        monkeypatch.setattr(lf, "STATS_BACKEND", backend)
+        results.append(lf._compute_stats(lf._ColumnarTable.from_csv(text), sketches=True))
+    assert results[0] == results[1]
+
+
+@pytest.mark.parametrize("text", _test_data_csvs())
+def test_accumulator_split_merge_equals_single_pass(text):
+    rows = lf._parse_csv_simple(text)
+    single = lf._compute_stats(rows)
+    for chunk in (1, 3, 7):
+        merged = lf._StatsAccumulator()
+        for i in range(0, len(rows), chunk):
+            part = lf._StatsAccumulator().add_rows(rows[i:i + chunk])
+            merged.merge(lf._StatsAccumulator.from_state(json.loads(json.dumps(part.to_state()))))
+        assert merged.finalize() == single, chunk
+
+
+@pytest.mark.parametrize("text", _test_data_csvs())
+def test_columnar_table_matches_row_path(text):
+    rows = lf._parse_csv_simple(text)
+    table = lf._ColumnarTable.from_csv(text)
+    assert table.rows() == rows
+    assert lf._compute_stats(table) == lf._compute_stats(iter(rows))
+    assert lf._compute_stats(table, sketches=True) == lf._compute_stats(iter(rows), sketches=True)
+
+
+
+def test_dict_column_keeps_mixed_json_types():
+    rows = [{"flag": True, "v": 0}, {"flag": 1, "v": False}, {"flag": 1.0, "v": 0.0}, {"flag": "1", "v": [0]}]
+    got = lf._ColumnarTable.from_rows(rows).rows()
+    assert [(type(r["flag"]), r["flag"]) for r in got] == [(bool, True), (int, 1), (float, 1.0), (str, "1")]
+    assert [type(r["v"]) for r in got] == [int, bool, float, str]
+
+
+# ====== 時系列の縮約 ======
+@pytest.mark.parametrize("n_out", [1, 2])
+def test_lttb_small_outputs_keep_extremes(n_out):
+    ys = [3.0, 1.0, 9.0, 2.0, 5.0]
+    idx = lf._lttb_indices(ys, n_out)
+    assert idx == ([2] if n_out == 1 else [0, len(ys) - 1])
+
+
+def test_weekly_series_rolls_up_to_month():
+    weeks = [f"2025-W{w:02d}" for w in range(1, 53)]
+    trend = [{"date": w, "sales": 10} for w in weeks]
+    out, info = lf._downsample_timeseries(trend, max_points=12, method="auto")
+    assert info["method"] == "rollup" and info["bucket"] == "month"
+    assert [t["date"] for t in out] == [f"2025-{m:02d}" for m in range(1, 13)]
+    assert sum(t["sales"] for t in out) == 520
+
+
+# ====== CSV の空行 ======
+@pytest.mark.parametrize("tail", ["", '\n"x",,'])
+def test_delimiter_only_rows_are_counted_like_baseline(tail):
+    text = "a,b,c\n1,2,3\n\n   \n,,,\n,,\n" + tail
+    rows = lf._parse_csv_simple(text)
+    assert rows[1:3] == [{"a": "", "b": "", "c": ""}] * 2
+    assert len(rows) == (4 if tail else 3)
+    assert lf._ColumnarTable.from_csv(text).rows() == rows